@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import time
@@ -14,8 +15,9 @@ from sleepmate.config import (
     SLEEPMATE_DISCORD_CHANNEL_EXCLUDE,
     SLEEPMATE_NUDGE_TIME,
 )
-from sleepmate.executor import X
+from sleepmate.executor import get_x
 from sleepmate.nudge import get_or_create_nudge, set_nudge
+from sleepmate.structured import ensure_indexes
 from sleepmate.user import get_user_from_username
 
 TOKEN = os.getenv("DISCORD_TOKEN")
@@ -60,8 +62,9 @@ async def on_message(message):
         return
 
     async with message.channel.typing():
-        db_user = get_db_user(message.author)
-        x = X(username=db_user.username, hello=None, log_=log)
+        # both hit the database, and get_x may build a new agent
+        db_user = await asyncio.to_thread(get_db_user, message.author)
+        x = await asyncio.to_thread(get_x, db_user, log_=log)
         await message.channel.send(await x.arun(message.content))
         # db_nudge = get_or_create_nudge(x, seen=True)
         # log.debug(f"on_message {db_user.username=} {db_nudge.to_mongo().to_dict()=}")
@@ -81,4 +84,5 @@ async def on_message(message):
 
 
 if __name__ == "__main__":
+    ensure_indexes()
     client.run(TOKEN, root_logger=True)
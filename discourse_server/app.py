@@ -7,8 +7,9 @@ from pydiscourse import DiscourseClient
 load_dotenv()
 
 from sleepmate.config import DISCOURSE_API_KEY, DISCOURSE_BASE_URL, DISCOURSE_USERNAME
-from sleepmate.executor import X
 from sleepmate.helpful_scripts import setup_logging
+from sleepmate.structured import ensure_indexes
+from sleepmate.turns import enqueue_turn
 from sleepmate.user import get_user_from_username
 
 app = Flask(__name__)
@@ -17,8 +18,12 @@ setup_logging()
 
 log = logging.getLogger("discourse.bot")
 
+QUEUE_NAME = "discourse"
+
 log.info(f"starting discourse bot {DISCOURSE_BASE_URL=} {DISCOURSE_USERNAME=}")
 
+ensure_indexes()
+
 
 def get_discourse_client():
     return DiscourseClient(
@@ -44,7 +49,7 @@ def was_tagged(content):
 
 
 @app.route("/discourse", methods=["POST"])
-def discourse():
+async def discourse():
     data = request.get_json()
     log.info(f"received webhook {data=}")
 
@@ -63,23 +68,14 @@ def discourse():
     ):
         db_user = get_db_user(post)
         log.info(f"{db_user.to_mongo()=}")
-        x = X(username=db_user.username, hello=None, log_=log)
-        # The specific user has been mentioned (tagged) in the post
-        topic_id = post.get("topic_id")
-        post_number = post.get("post_number")
-        try:
-            reply_content = x.run(get_utterance(content))
-        except Exception as e:
-            log.exception(f"{e}")
-            reply_content = (
-                "Whoops, I had a problem answering that question. Try again later."
-            )
-
-        # print(f"{topic_id=}")
-        discourse_client = get_discourse_client()
-        r = discourse_client.create_post(
-            reply_content, reply_to_post_number=post_number, topic_id=topic_id
+        # The specific user has been mentioned (tagged) in the post, acknowledge
+        # straight away and reply from a worker, see worker.py
+        await enqueue_turn(
+            QUEUE_NAME,
+            db_user.id,
+            topic_id=post.get("topic_id"),
+            post_number=post.get("post_number"),
+            utterance=get_utterance(content),
         )
-        log.info(f"{r=}")
 
     return jsonify({"status": "success"})
@@ -0,0 +1,50 @@
+import asyncio
+
+from app import QUEUE_NAME, get_discourse_client, log
+from saq import CronJob, Queue
+
+from sleepmate.config import REDIS_URL
+from sleepmate.executor import get_x
+from sleepmate.turns import drain_turns, get_queue_depths
+from sleepmate.user import get_user_from_id
+
+# run with `saq worker.settings` from this directory
+queue = Queue.from_url(REDIS_URL, name=QUEUE_NAME)
+
+
+async def process_turns(ctx, *, db_user_id):
+    async def handle(message):
+        db_user = await asyncio.to_thread(get_user_from_id, db_user_id)
+        x = await asyncio.to_thread(get_x, db_user, log_=log)
+        try:
+            reply_content = await x.arun(message["utterance"])
+        except Exception as e:
+            log.exception(f"{e}")
+            reply_content = (
+                "Whoops, I had a problem answering that question. Try again later."
+            )
+        r = await asyncio.to_thread(
+            get_discourse_client().create_post,
+            reply_content,
+            reply_to_post_number=message["post_number"],
+            topic_id=message["topic_id"],
+        )
+        log.info(f"{r=}")
+
+    await drain_turns(queue, db_user_id, handle)
+
+
+async def log_queue_depths(ctx):
+    depths = await get_queue_depths(queue)
+    log.info(
+        f"log_queue_depths users={len(depths)} messages={sum(depths.values())} "
+        f"max={max(depths.values(), default=0)}"
+    )
+
+
+settings = {
+    "queue": queue,
+    "functions": [process_turns],
+    "cron_jobs": [CronJob(log_queue_depths, cron="* * * * *")],
+    "concurrency": 10,
+}
@@ -7,7 +7,7 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_confirmation_str,
     get_date_fields,
@@ -157,7 +157,7 @@ def get_vlq_entry_from_memory(x: BaseAgent) -> VLQEntry:
 
 
 def save_vlq_entry_to_db(user: str, entry: VLQEntry) -> DBVLQEntry:
-    return DBVLQEntry(**{"user": user, **entry.dict()}).save()
+    return record_progress(user, DBVLQEntry(**{"user": user, **entry.dict()}).save())
 
 
 def get_json_vlq_entry(entry: dict) -> str:
@@ -215,7 +215,7 @@ the steps at once. Wait for them to complete each step.
 def exercise_time(name: str, db_user_id: str) -> bool:
     start = datetime.now() - timedelta(days=5)
     return (
-        not goal_refused(db_user_id, name)
+        not get_goal_state(db_user_id).refused(name)
         and DBExerciseEntry.objects(
             name__icontains=name.replace("_", " "),
             user=db_user_id,
@@ -228,10 +228,11 @@ def exercise_time(name: str, db_user_id: str) -> bool:
 def valued_living(db_user_id: str) -> bool:
     start = datetime.now() - timedelta(days=7)
 
-    return not goal_refused(db_user_id, "valued_living") and (
-        DBVLQEntry.objects(user=db_user_id, date__gte=start).count() == 0
-    )
+    state = get_goal_state(db_user_id)
+    return not state.refused("valued_living") and not state.has(DBVLQEntry, since=start)
+
 
+GOAL_DOCUMENTS = [DBVLQEntry]
 
 GOAL_HANDLERS = [
     {
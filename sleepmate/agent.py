@@ -1,3 +1,4 @@
+from concurrent.futures import Future
 from typing import List
 
 from langchain.memory import ReadOnlySharedMemory
@@ -9,8 +10,12 @@ from .helpful_scripts import Goal
 class BaseAgent(object):
     db_user_id: str = None
     goal: Goal = None
+    # GOALS, GOAL_HANDLERS and GOAL_OPTIONS, see registry.py
+    goals: dict = None
     ro_memory: ReadOnlySharedMemory = None
     fixed_goal: bool = False
+    # the answer being captured this turn, see capture.py
+    capture: Future = None
 
     def get_latest_messages(self) -> List[BaseMessage]:
         assert False, "Must implement get_latest_messages"
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from .config import (
+    SLEEPMATE_ANSWER_CACHE_SIZE,
+    SLEEPMATE_ANSWER_CACHE_THRESHOLD,
+    SLEEPMATE_ANSWER_CACHE_TTL,
+)
+
+log = logging.getLogger(__name__)
+
+
+class SemanticCache(object):
+    """Answers keyed by the embedding of the question. A lookup returns the
+    answer to the most similar cached question if it's at least threshold
+    cosine similar, was answered from the same corpus version and is younger
+    than ttl seconds. Least recently used entries go first when it's full.
+
+    The normalised embeddings are rows of a matrix allocated for size entries
+    on the first put, with the versions and creation times alongside, so a
+    lookup is a single matrix-vector product."""
+
+    def __init__(
+        self,
+        threshold: float = SLEEPMATE_ANSWER_CACHE_THRESHOLD,
+        ttl: int = SLEEPMATE_ANSWER_CACHE_TTL,
+        size: int = SLEEPMATE_ANSWER_CACHE_SIZE,
+    ) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.allocate(None)
+
+    def allocate(self, dimension: Optional[int]) -> None:
+        self.matrix = None
+        if dimension is not None:
+            self.matrix = np.zeros((self.size, dimension), dtype=np.float32)
+        self.answers: List[Optional[str]] = [None] * self.size
+        self.versions = np.full(self.size, None, dtype=object)
+        # -inf marks a free row, it's always expired
+        self.created = np.full(self.size, float("-inf"))
+        # row -> None, least recently used first
+        self.rows = OrderedDict()
+        self.free_rows = list(reversed(range(self.size)))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def free(self, row: int) -> None:
+        del self.rows[row]
+        self.answers[row] = None
+        self.versions[row] = None
+        self.created[row] = float("-inf")
+        self.free_rows.append(row)
+
+    def get(self, embedding: List[float], version: str) -> Optional[str]:
+        query = normalise(embedding)
+        with self.lock:
+            best = None
+            if self.rows and self.matrix.shape[1] == len(query):
+                now = time.monotonic()
+                live = (self.versions == version) & (now - self.created <= self.ttl)
+                scores = np.where(live, self.matrix @ query, -np.inf)
+                i = int(np.argmax(scores))
+                if scores[i] >= self.threshold:
+                    best = i
+            if best is None:
+                self.misses += 1
+                log.debug(f"get miss {self.stats()=}")
+                return None
+            self.hits += 1
+            self.rows.move_to_end(best)
+            log.debug(f"get hit {self.stats()=}")
+            return self.answers[best]
+
+    def take_row(self) -> int:
+        """A free row, making room by dropping the expired entries, or else the
+        least recently used one."""
+        if not self.free_rows:
+            expired = time.monotonic() - self.created > self.ttl
+            for row in np.flatnonzero(expired).tolist():
+                self.free(row)
+            if not self.free_rows:
+                self.free(next(iter(self.rows)))
+        return self.free_rows.pop()
+
+    def put(self, embedding: List[float], version: str, answer: str) -> None:
+        vector = normalise(embedding)
+        with self.lock:
+            if self.matrix is None or self.matrix.shape[1] != len(vector):
+                # first put, or the embedding model changed
+                self.allocate(len(vector))
+            row = self.take_row()
+            self.matrix[row] = vector
+            self.answers[row] = answer
+            self.versions[row] = version
+            self.created[row] = time.monotonic()
+            self.rows[row] = None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.allocate(None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.rows),
+        }
+
+
+def normalise(embedding: List[float]) -> np.ndarray:
+    vector = np.array(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -5,14 +5,16 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     get_start_end,
     mongo_to_json,
     set_attribute,
 )
-from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
+from .rules import parse_height, parse_weight
+from .structured import fix_schema, pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
@@ -43,9 +45,9 @@ DBBodyMeasures = pydantic_to_mongoengine(
 
 
 def get_body_measures_from_memory(x: BaseAgent) -> BodyMeasures:
-    return get_parsed_output(
+    return get_captured_output(
+        x,
         "summarise the answers the human gave for their body measures",
-        x.get_latest_messages,
         BodyMeasures,
     )
 
@@ -56,7 +58,9 @@ def save_body_measures_to_db(db_user_id: str, entry: BodyMeasures) -> DBBodyMeas
     (start, end) = get_start_end(entry["date"])
     DBBodyMeasures.objects(user=db_user_id, date__gte=start, date__lte=end).delete()
     # save the new entry
-    return DBBodyMeasures(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBBodyMeasures(**{"user": db_user_id, **entry}).save()
+    )
 
 
 def get_json_body_measures(entry: dict) -> str:
@@ -72,6 +76,7 @@ def save_body_measures(x: BaseAgent, utterance: str):
     if entry is not None:
         log.info(f"save_body_measures {entry=}")
         save_body_measures_to_db(x.db_user_id, entry)
+        commit_draft(x)
 
 
 @set_attribute("return_direct", False)
@@ -96,10 +101,13 @@ def get_last_body_measures(x: BaseAgent, utterance: str):
 
 def bmi(db_user_id: str):
     """Returns True if BodyMeasures should be collected."""
-    if goal_refused(db_user_id, "bmi"):
+    state = get_goal_state(db_user_id)
+    if state.refused("bmi"):
         return False
-    return DBBodyMeasures.objects(user=db_user_id).count() == 0
+    return not state.has(DBBodyMeasures)
+
 
+GOAL_DOCUMENTS = [DBBodyMeasures]
 
 GOAL_HANDLERS = [
     {
@@ -107,6 +115,16 @@ GOAL_HANDLERS = [
     },
 ]
 
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [
+    {
+        "bmi": {
+            "capture": BodyMeasures,
+            "rules": {"height": parse_height, "weight": parse_weight},
+        }
+    },
+]
+
 GOALS = [
     {
         "bmi": """
@@ -1,8 +1,244 @@
-from langchain.cache import SQLiteCache
-from langchain.globals import set_llm_cache
+import hashlib
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
 
+from langchain.globals import get_llm_cache, set_llm_cache
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import RETURN_VAL_TYPE, BaseCache
 
-def setup_cache():
-    set_llm_cache(
-        SQLiteCache(database_path="/Users/cck197/Downloads/virtual_greg/.langchain.db")
-    )
+from .config import (
+    REDIS_URL,
+    SLEEPMATE_LLM_CACHE,
+    SLEEPMATE_LLM_CACHE_MAX_ROWS,
+    SLEEPMATE_LLM_CACHE_PATH,
+    SLEEPMATE_LLM_CACHE_SIZE,
+    SLEEPMATE_LLM_CACHE_TTL,
+)
+
+log = logging.getLogger(__name__)
+
+_enabled = ContextVar("llm_cache_enabled", default=True)
+
+
+@contextmanager
+def no_cache():
+    """Bypass the LLM cache for calls made inside the block, e.g. for prompts
+    that should get a fresh answer every time."""
+    token = _enabled.set(False)
+    try:
+        yield
+    finally:
+        _enabled.reset(token)
+
+
+def get_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def dumps_generations(return_val: RETURN_VAL_TYPE) -> str:
+    return json.dumps([dumps(generation) for generation in return_val])
+
+
+def loads_generations(value: str) -> RETURN_VAL_TYPE:
+    return [loads(generation) for generation in json.loads(value)]
+
+
+class MemoryTier(object):
+    """In-process LRU with a TTL."""
+
+    def __init__(self, size: int, ttl: int) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        with self.lock:
+            self.entries[key] = (return_val, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class FileTier(object):
+    """Shared between the workers on a host, a SQLite file with a TTL and a cap
+    on the number of rows. Expired rows are never returned, they and the rows
+    over the cap are deleted every prune_every writes."""
+
+    def __init__(
+        self, path: str, ttl: int, max_rows: int, prune_every: int = 100
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self.writes = itertools.count()
+        self.local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connection as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created)"
+            )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        row = self.connection.execute(
+            "SELECT value FROM llm_cache WHERE key = ? AND created > ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        return None if row is None else loads_generations(row[0])
+
+    def set(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        with self.connection as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+                (key, dumps_generations(return_val), time.time()),
+            )
+        if next(self.writes) % self.prune_every == 0:
+            self.prune()
+
+    def prune(self) -> None:
+        """Both deletes are range scans, on the created index and on rowid,
+        which grows with every write (REPLACE inserts a new row), so only the
+        newest max_rows writes are kept."""
+        with self.connection as conn:
+            conn.execute(
+                "DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,)
+            )
+            conn.execute(
+                "DELETE FROM llm_cache WHERE rowid <= "
+                "(SELECT max(rowid) FROM llm_cache) - ?",
+                (self.max_rows,),
+            )
+
+    def clear(self) -> None:
+        with self.connection as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+
+class RedisTier(object):
+    """Shared across the fleet, size is left to the Redis eviction policy."""
+
+    prefix = "sleepmate:llm_cache:"
+
+    def __init__(self, url: str, ttl: int) -> None:
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self.redis.get(self.prefix + key)
+        return None if value is None else loads_generations(value)
+
+    def set(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.redis.set(self.prefix + key, dumps_generations(return_val), ex=self.ttl)
+
+    def clear(self) -> None:
+        for key in self.redis.scan_iter(self.prefix + "*"):
+            self.redis.delete(key)
+
+
+class TieredCache(BaseCache):
+    """LLM cache that checks an in-process LRU before a shared tier, and fills
+    the LRU from shared hits. Only deterministic, temperature 0, clients use
+    it, get_model turns it off for the others."""
+
+    def __init__(self, memory: MemoryTier, shared=None) -> None:
+        self.memory = memory
+        self.shared = shared
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if not _enabled.get():
+            return None
+        key = get_key(prompt, llm_string)
+        return_val = self.memory.get(key)
+        if return_val is None and self.shared is not None:
+            try:
+                return_val = self.shared.get(key)
+            except Exception as e:
+                log.error(f"lookup {e=}")
+            if return_val is not None:
+                self.memory.set(key, return_val)
+        return return_val
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if not _enabled.get():
+            return
+        key = get_key(prompt, llm_string)
+        self.memory.set(key, return_val)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, return_val)
+            except Exception as e:
+                log.error(f"update {e=}")
+
+    def clear(self, **kwargs) -> None:
+        self.memory.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+
+def get_cache(backend: str = SLEEPMATE_LLM_CACHE) -> TieredCache:
+    """backend is memory, file or redis, the last two add a shared tier."""
+    memory = MemoryTier(SLEEPMATE_LLM_CACHE_SIZE, SLEEPMATE_LLM_CACHE_TTL)
+    if backend == "file":
+        shared = FileTier(
+            SLEEPMATE_LLM_CACHE_PATH,
+            SLEEPMATE_LLM_CACHE_TTL,
+            SLEEPMATE_LLM_CACHE_MAX_ROWS,
+        )
+    elif backend == "redis":
+        shared = RedisTier(REDIS_URL, SLEEPMATE_LLM_CACHE_TTL)
+    elif backend == "memory":
+        shared = None
+    else:
+        raise ValueError(f"unknown LLM cache backend {backend}")
+    return TieredCache(memory, shared)
+
+
+_lock = threading.Lock()
+
+
+def setup_cache(backend: str = None):
+    """Install the process-wide LLM cache, once."""
+    with _lock:
+        if get_llm_cache() is None:
+            set_llm_cache(get_cache(backend or SLEEPMATE_LLM_CACHE or "file"))
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Dict, List
+
+from langchain.pydantic_v1 import BaseModel, Field
+from langchain.schema import AIMessage, BaseMessage, HumanMessage
+from mongoengine import DictField, ReferenceField
+
+from .agent import BaseAgent
+from .config import SLEEPMATE_CAPTURE_TTL, SLEEPMATE_CAPTURE_WORKERS
+from .rules import Rule, apply_rules
+from .structured import (
+    get_extractor,
+    get_parsed_output,
+    get_prompt,
+    pydantic_to_mongoengine,
+)
+from .user import DBUser, get_object_id
+
+log = logging.getLogger(__name__)
+
+CAPTURE_QUERY = (
+    "Record the answers the human gives in their last message, including any "
+    "corrections to earlier answers. Leave out anything they didn't answer."
+)
+
+# capturing runs alongside the agent, see start_capture
+_capturer = ThreadPoolExecutor(
+    max_workers=SLEEPMATE_CAPTURE_WORKERS, thread_name_prefix="capture"
+)
+
+
+class Draft(BaseModel):
+    date: datetime = Field(description="date of last update")
+    goal: str = Field(description="goal the answers are for")
+    day: str = Field(default="", description="day the answers are for")
+
+
+# values maps field -> answer for one questionnaire in progress, drafts that
+# aren't saved are dropped after SLEEPMATE_CAPTURE_TTL seconds. TTL indexes
+# expire by UTC, so date is stamped with utcnow. Goals that recur keep one
+# draft per day, see get_draft_day
+DBDraft = pydantic_to_mongoengine(
+    Draft,
+    extra_fields={
+        "user": ReferenceField(DBUser, required=True),
+        "values": DictField(),
+    },
+    indexes=[
+        {"fields": ["user", "goal"], "unique": True},
+        {"fields": ["date"], "expireAfterSeconds": SLEEPMATE_CAPTURE_TTL},
+    ],
+)
+
+
+def get_draft_day(x: BaseAgent) -> str:
+    """The day the draft for the current goal is for. Goals that recur, e.g.
+    the daily sleep diary, start afresh each day rather than picking up
+    yesterday's unfinished answers."""
+    options = x.goals["GOAL_OPTIONS"].get(x.goal.key, {}) if x.goals else {}
+    return date.today().isoformat() if options.get("recurs") else ""
+
+
+def get_draft(db_user_id: str, goal: str, day: str = "") -> dict:
+    """The answers captured so far for goal."""
+    draft = DBDraft.objects(user=db_user_id, goal=goal, day=day).first()
+    return dict(draft["values"]) if draft is not None else {}
+
+
+def update_draft(db_user_id: str, goal: str, values: dict, day: str = "") -> None:
+    # there's one draft per goal, drop any left over from another day
+    DBDraft.objects(user=db_user_id, goal=goal, day__ne=day).delete()
+    update = {f"values.{key}": value for key, value in values.items()}
+    DBDraft._get_collection().update_one(
+        {"user": get_object_id(db_user_id), "goal": goal, "day": day},
+        {"$set": {**update, "date": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def clear_draft(db_user_id: str, goal: str) -> None:
+    """Drop the draft for goal, whatever day it's for."""
+    DBDraft.objects(user=db_user_id, goal=goal).delete()
+
+
+def get_rule_values(
+    cls: BaseModel, rules: Dict[str, Rule], messages: List[BaseMessage]
+) -> dict:
+    """Fill what the last message answers with rules, if they can do all of
+    it."""
+    question = next(
+        (m.content for m in reversed(messages[:-1]) if isinstance(m, AIMessage)), ""
+    )
+    descriptions = {
+        name: field.field_info.description for name, field in cls.__fields__.items()
+    }
+    return apply_rules(rules, descriptions, question, messages[-1].content)
+
+
+def capture_answer(
+    db_user_id: str,
+    goal: str,
+    cls: BaseModel,
+    messages: List[BaseMessage],
+    rules: Dict[str, Rule] = None,
+    day: str = "",
+) -> dict:
+    """Extract whatever the last message in messages answers and add it to the
+    draft, with the rules if they can, otherwise with the model. Returns the
+    captured values."""
+    values = get_rule_values(cls, rules, messages) if rules else {}
+    if values:
+        log.info(f"capture_answer rules {goal=} {values=}")
+        update_draft(db_user_id, goal, values, day)
+        return values
+    extractor = get_extractor(cls)
+    values = extractor.call(
+        get_prompt(CAPTURE_QUERY, messages), extractor.partial_function
+    )
+    values = {
+        key: value
+        for key, value in values.items()
+        if key in cls.__fields__ and value is not None
+    }
+    if values:
+        log.info(f"capture_answer {goal=} {values=}")
+        update_draft(db_user_id, goal, values, day)
+    return values
+
+
+def start_capture(
+    x: BaseAgent, cls: BaseModel, utterance: str, rules: Dict[str, Rule] = None
+) -> Future:
+    """Capture the answer in utterance in the background. The question it
+    answers is in the last couple of messages, read now before the turn adds
+    to them."""
+    messages = x.memory.chat_memory.get_messages(2) + [HumanMessage(content=utterance)]
+    x.capture = _capturer.submit(
+        capture_answer,
+        x.db_user_id,
+        x.goal.key,
+        cls,
+        messages,
+        rules,
+        get_draft_day(x),
+    )
+    return x.capture
+
+
+def wait_for_capture(x: BaseAgent) -> None:
+    """Wait for the answer from this turn to reach the draft. Capturing is best
+    effort, the final save repairs anything that's missing."""
+    if x.capture is None:
+        return
+    try:
+        x.capture.result()
+    except Exception as e:
+        log.error(f"wait_for_capture {e=}")
+    x.capture = None
+
+
+async def await_capture(x: BaseAgent) -> None:
+    if x.capture is not None:
+        await asyncio.to_thread(wait_for_capture, x)
+
+
+def get_captured_output(x: BaseAgent, query: str, cls: BaseModel) -> BaseModel:
+    """Validate the answers captured for the current goal, only going back to
+    the chat history for fields that are missing or invalid. Without a draft
+    the whole thing is extracted from the chat history."""
+    wait_for_capture(x)
+    values = get_draft(x.db_user_id, x.goal.key, get_draft_day(x)) if x.goal else {}
+    return get_parsed_output(query, x.get_latest_messages, cls, values=values or None)
+
+
+def commit_draft(x: BaseAgent) -> None:
+    """Call once the entry built from the draft has been saved."""
+    if x.goal:
+        clear_draft(x.db_user_id, x.goal.key)
@@ -0,0 +1,239 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+import zstandard
+from bson import Binary
+from langchain.schema import BaseChatMessageHistory, BaseMessage
+from langchain.schema.messages import message_to_dict, messages_from_dict
+from pymongo import DESCENDING
+from pymongo.collection import Collection
+
+from .config import (
+    MONGODB_NAME,
+    SLEEPMATE_CHAT_ARCHIVE_TTL,
+    SLEEPMATE_CHAT_COMPRESS_OVER,
+    SLEEPMATE_MEMORY_LENGTH,
+)
+from .db import db
+
+log = logging.getLogger(__name__)
+
+COLLECTION_NAME = "message_store"
+
+# Version 1 is langchain's format, the message as a JSON string in History.
+# Version 2 stores it as a BSON subdocument in Message, with the content of long
+# messages zstd compressed into Content. Goal is the goal the message belongs
+# to, Archived when it was archived, see archive().
+SCHEMA_VERSION = 2
+
+# archiving happens off the user's critical path
+_archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-archive")
+
+
+def to_document(session_id, message: BaseMessage, goal: str = "") -> dict:
+    message = message_to_dict(message)
+    doc = {
+        "SessionId": session_id,
+        "v": SCHEMA_VERSION,
+        "Goal": goal,
+        "Message": message,
+    }
+    content = message["data"].get("content")
+    if isinstance(content, str) and len(content) > SLEEPMATE_CHAT_COMPRESS_OVER:
+        message["data"] = {k: v for k, v in message["data"].items() if k != "content"}
+        doc["Content"] = Binary(
+            zstandard.ZstdCompressor().compress(content.encode("utf-8"))
+        )
+    return doc
+
+
+def from_document(doc: dict) -> dict:
+    """Returns the langchain message dict from a stored message, any version."""
+    if doc.get("v", 1) == 1:
+        return json.loads(doc["History"])
+    message = doc["Message"]
+    if "Content" in doc:
+        content = zstandard.ZstdDecompressor().decompress(doc["Content"])
+        message["data"]["content"] = content.decode("utf-8")
+    return message
+
+
+def get_collection() -> Collection:
+    return db.get_database(MONGODB_NAME)[COLLECTION_NAME]
+
+
+def ensure_chat_indexes() -> None:
+    """The windowed loads read the newest messages of one session and goal,
+    archived messages are removed by MongoDB after SLEEPMATE_CHAT_ARCHIVE_TTL
+    seconds."""
+    collection = get_collection()
+    collection.create_index([("SessionId", 1), ("_id", DESCENDING)])
+    collection.create_index([("SessionId", 1), ("Goal", 1), ("_id", DESCENDING)])
+    collection.create_index("Archived", expireAfterSeconds=SLEEPMATE_CHAT_ARCHIVE_TTL)
+
+
+def archive_messages(session_id, goal: str) -> None:
+    """Mark the session's messages that don't belong to goal as archived. The
+    TTL index expires by UTC, hence utcnow."""
+    result = get_collection().update_many(
+        {"SessionId": session_id, "Goal": {"$ne": goal}, "Archived": None},
+        {"$set": {"Archived": datetime.utcnow()}},
+    )
+    log.info(f"archive_messages {session_id=} {goal=} {result.modified_count=}")
+
+
+def log_archive_error(future: Future) -> None:
+    if future.exception() is not None:
+        log.error("archive_messages failed", exc_info=future.exception())
+
+
+def submit_archive(session_id, goal: str) -> Future:
+    future = _archiver.submit(archive_messages, session_id, goal)
+    future.add_done_callback(log_archive_error)
+    return future
+
+
+def adopt_untagged_messages(session_id, goal: str) -> None:
+    """Tag the session's messages written before they were tagged with a goal
+    as goal's. The old history was cleared on every goal change, so they belong
+    to the goal the user is on."""
+    result = get_collection().update_many(
+        {"SessionId": session_id, "Goal": None, "Archived": None},
+        {"$set": {"Goal": goal}},
+    )
+    if result.modified_count:
+        log.info(f"adopt_untagged_messages {session_id=} {result.modified_count=}")
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """Chat history in the same collection and format as langchain's
+    MongoDBChatMessageHistory, but only the newest messages are read, using the
+    (SessionId, -_id) index. They're cached until the next turn starts and new
+    messages are appended to the cache rather than re-read.
+
+    The cache is the turn's snapshot of the conversation: the agent prompt, the
+    read-only memory the tools use and the structured output extractors (via
+    X.get_latest_messages) all read from it, so a turn deserialises the history
+    once. version changes whenever the snapshot does.
+
+    Only the messages of the current goal are visible, the others are archived
+    when the goal changes. Messages written before they were tagged with a goal
+    are adopted by the goal set with set_goal, see adopt_untagged_messages."""
+
+    def __init__(
+        self, session_id, window: int = SLEEPMATE_MEMORY_LENGTH * 2, goal: str = ""
+    ) -> None:
+        self.session_id = session_id
+        self.window = window
+        self.goal = goal
+        self.collection = get_collection()
+        self._messages: Optional[List[BaseMessage]] = None
+        # True when _messages holds the whole session
+        self._complete = False
+        self.version = 0
+        # tools run in worker threads
+        self.lock = threading.RLock()
+
+    def get_filter(self) -> dict:
+        return {
+            "SessionId": self.session_id,
+            "Goal": self.goal,
+            "Archived": None,
+        }
+
+    def load(self, n: int) -> None:
+        cursor = (
+            self.collection.find(self.get_filter(), {"SessionId": 0})
+            .sort("_id", DESCENDING)
+            .limit(n)
+        )
+        docs = list(cursor)[::-1]
+        self._messages = messages_from_dict([from_document(d) for d in docs])
+        self._complete = len(docs) < n
+        self.version += 1
+        log.debug(f"load {self.session_id=} {n=} {len(docs)=}")
+
+    def get_messages(self, k: int = None) -> List[BaseMessage]:
+        """Returns the last k messages, by default the last window. Only goes
+        to the database if the snapshot doesn't already cover them."""
+        k = self.window if k is None else k
+        if k <= 0:
+            return []
+        with self.lock:
+            if self._messages is None or (
+                len(self._messages) < k and not self._complete
+            ):
+                self.load(max(k, self.window))
+            return self._messages[-k:]
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.get_messages()
+
+    def start_turn(self) -> None:
+        """Forget the cached messages, another process may have written since
+        the last turn."""
+        with self.lock:
+            self._messages = None
+            self._complete = False
+            self.version += 1
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: List[BaseMessage]) -> None:
+        """Append all the messages of a turn in one round trip."""
+        if not messages:
+            return
+        self.collection.insert_many(
+            [to_document(self.session_id, message, self.goal) for message in messages]
+        )
+        with self.lock:
+            if self._messages is not None:
+                self._messages.extend(messages)
+            self.version += 1
+
+    def delete_last(self, n: int) -> None:
+        """Delete the last n messages."""
+        ids = [
+            doc["_id"]
+            for doc in self.collection.find(self.get_filter(), {"_id": 1})
+            .sort("_id", DESCENDING)
+            .limit(n)
+        ]
+        log.info(f"delete_last deleting {ids=}")
+        self.collection.delete_many({"_id": {"$in": ids}})
+        self.start_turn()
+
+    def set_goal(self, goal: str) -> Optional[Future]:
+        """Switch to goal's messages. The other goals' messages are archived in
+        the background, so they don't come back if a goal recurs."""
+        with self.lock:
+            if goal == self.goal:
+                return None
+            adopt_untagged_messages(self.session_id, goal)
+            self.goal = goal
+            self.start_turn()
+        return submit_archive(self.session_id, goal)
+
+    def archive(self, goal: str) -> Future:
+        """Move on to goal with an empty history. Nothing is deleted here: the
+        old goal's messages are hidden by the goal filter at once, and archived
+        in the background for the TTL index to remove."""
+        with self.lock:
+            self.goal = goal
+            self._messages = []
+            self._complete = True
+            self.version += 1
+        return submit_archive(self.session_id, goal)
+
+    def clear(self) -> None:
+        self.collection.delete_many({"SessionId": self.session_id})
+        with self.lock:
+            self._messages = []
+            self._complete = True
+            self.version += 1
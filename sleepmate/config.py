@@ -12,15 +12,73 @@ SLEEPMATE_DEFAULT_MODEL_NAME = os.environ.get(
 SLEEPMATE_PARSER_MODEL_NAME = os.environ.get(
     "SLEEPMATE_PARSER_MODEL_NAME", "gpt-4-1106-preview"
 )
+# follow up calls for fields that failed validation in structured output
+SLEEPMATE_EXTRACTION_REPAIRS = int(os.environ.get("SLEEPMATE_EXTRACTION_REPAIRS", 1))
+# schemas with more fields are extracted in concurrent groups
+SLEEPMATE_EXTRACTION_SPLIT_OVER = int(
+    os.environ.get("SLEEPMATE_EXTRACTION_SPLIT_OVER", 24)
+)
+SLEEPMATE_EXTRACTION_WORKERS = int(os.environ.get("SLEEPMATE_EXTRACTION_WORKERS", 8))
+# questionnaire answers captured per turn, see capture.py
+SLEEPMATE_CAPTURE_TTL = int(os.environ.get("SLEEPMATE_CAPTURE_TTL", 60 * 60 * 24))
+SLEEPMATE_CAPTURE_WORKERS = int(os.environ.get("SLEEPMATE_CAPTURE_WORKERS", 4))
 # fine tuned for selecting a function
 SLEEPMATE_AGENT_MODEL_NAME = os.environ.get(
     "SLEEPMATE_AGENT_MODEL_NAME", "gpt-4-1106-preview"
 )  # -0613")
 SLEEPMATE_MEMORY_LENGTH = int(os.environ.get("SLEEPMATE_MEMORY_LENGTH", 30))
+# how long chat messages from earlier goals are kept, see chat.py
+SLEEPMATE_CHAT_ARCHIVE_TTL = int(
+    os.environ.get("SLEEPMATE_CHAT_ARCHIVE_TTL", 60 * 60 * 24 * 7)
+)
+# chat messages longer than this are zstd compressed
+SLEEPMATE_CHAT_COMPRESS_OVER = int(
+    os.environ.get("SLEEPMATE_CHAT_COMPRESS_OVER", 2048)
+)
 SLEEPMATE_DATADIR = os.environ.get("SLEEPMATE_DATADIR", "data")
 SLEEPMATE_MAX_TOKENS = int(os.environ.get("SLEEPMATE_MAX_TOKENS", 8192))
+# chunks retrieved per knowledge question, packed into SLEEPMATE_MAX_TOKENS
+SLEEPMATE_KNOWLEDGE_TOP_K = int(os.environ.get("SLEEPMATE_KNOWLEDGE_TOP_K", 8))
+# near-identical knowledge questions are answered from cache, see answer_cache.py
+SLEEPMATE_ANSWER_CACHE_THRESHOLD = float(
+    os.environ.get("SLEEPMATE_ANSWER_CACHE_THRESHOLD", 0.95)
+)
+SLEEPMATE_ANSWER_CACHE_TTL = int(
+    os.environ.get("SLEEPMATE_ANSWER_CACHE_TTL", 60 * 60 * 24)
+)
+SLEEPMATE_ANSWER_CACHE_SIZE = int(os.environ.get("SLEEPMATE_ANSWER_CACHE_SIZE", 1024))
+# seconds between checks for a newly ingested corpus, see knowledge.py
+SLEEPMATE_CORPUS_VERSION_CHECK = int(
+    os.environ.get("SLEEPMATE_CORPUS_VERSION_CHECK", 60)
+)
+# knowledge base ingestion, see ingest.py
+SLEEPMATE_EMBEDDING_BATCH_SIZE = int(
+    os.environ.get("SLEEPMATE_EMBEDDING_BATCH_SIZE", 100)
+)
+SLEEPMATE_EMBEDDING_WORKERS = int(os.environ.get("SLEEPMATE_EMBEDDING_WORKERS", 4))
+# pinecone or local, see vectorstore.py
+SLEEPMATE_VECTORSTORE = os.environ.get("SLEEPMATE_VECTORSTORE", "pinecone")
+SLEEPMATE_INDEX_DIR = os.environ.get(
+    "SLEEPMATE_INDEX_DIR", f"{SLEEPMATE_DATADIR.rstrip('/')}_index"
+)
 DEBUG = os.environ.get("DEBUG", True)
 SLEEPMATE_STOP_SEQUENCE = os.environ.get("SLEEPMATE_STOP_SEQUENCE", "###")
+# warm agents kept per worker process, see pool.py
+SLEEPMATE_POOL_SIZE = int(os.environ.get("SLEEPMATE_POOL_SIZE", 256))
+SLEEPMATE_POOL_IDLE_SECONDS = int(
+    os.environ.get("SLEEPMATE_POOL_IDLE_SECONDS", 60 * 30)
+)
+# LLM response cache, memory, file or redis, empty to only cache when asked to,
+# see cache.py. Models with a temperature above 0 are never cached.
+SLEEPMATE_LLM_CACHE = os.environ.get("SLEEPMATE_LLM_CACHE", "")
+SLEEPMATE_LLM_CACHE_PATH = os.environ.get("SLEEPMATE_LLM_CACHE_PATH", ".langchain.db")
+SLEEPMATE_LLM_CACHE_TTL = int(
+    os.environ.get("SLEEPMATE_LLM_CACHE_TTL", 60 * 60 * 24 * 7)
+)
+SLEEPMATE_LLM_CACHE_SIZE = int(os.environ.get("SLEEPMATE_LLM_CACHE_SIZE", 1024))
+SLEEPMATE_LLM_CACHE_MAX_ROWS = int(
+    os.environ.get("SLEEPMATE_LLM_CACHE_MAX_ROWS", 100000)
+)
 if DEBUG:
     import langchain
 
@@ -55,6 +113,12 @@ SLEEPMATE_DISCORD_CHANNEL_EXCLUDE = ["general"]
 PINECONE_INDEX_NAME = os.environ.get("PINECONE_INDEX_NAME", "sleepmate")
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# longest a worker can hold a user's turn lock without making progress, see
+# turns.py
+SLEEPMATE_TURN_LOCK_TIMEOUT = int(os.environ.get("SLEEPMATE_TURN_LOCK_TIMEOUT", 300))
+# attempts at a turn, including ones cut short by a crash or timeout, before it
+# is moved to the user's dead letter list, see turns.py
+SLEEPMATE_TURN_RETRIES = int(os.environ.get("SLEEPMATE_TURN_RETRIES", 3))
 
 DISCOURSE_USERNAME = os.environ.get("DISCOURSE_USERNAME", "sleepmate")
 DISCOURSE_BASE_URL = os.environ.get(
@@ -4,7 +4,8 @@ from mongoengine import connect
 
 from .config import MONGODB_NAME, MONGODB_URI
 
-db = connect(host=MONGODB_URI)
+# don't connect until the first query, importing shouldn't touch the network
+db = connect(host=MONGODB_URI, connect=False)
 
 log = logging.getLogger(__name__)
 
@@ -5,7 +5,8 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     get_start_end,
@@ -16,7 +17,8 @@ from .helpful_scripts import (
 )
 from .mi import get_completion, get_template
 from .prompt import get_template
-from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
+from .rules import parse_count, parse_duration, parse_time
+from .structured import fix_schema, pydantic_to_mongoengine
 from .user import DBUser
 from .wearable import user_integrated_supported_wearable
 
@@ -53,8 +55,8 @@ class SleepDiaryEntry(SleepDiaryEntry_):
 
 
 def get_sleep_diary_entry_from_memory(x: BaseAgent) -> SleepDiaryEntry:
-    return get_parsed_output(
-        "summarise the last sleep diary entry", x.get_latest_messages, SleepDiaryEntry
+    return get_captured_output(
+        x, "summarise the last sleep diary entry", SleepDiaryEntry
     )
 
 
@@ -104,7 +106,9 @@ def save_sleep_diary_entry_to_db(
     (start, end) = get_start_end(entry["date"])
     DBSleepDiaryEntry.objects(user=db_user_id, date__gte=start, date__lte=end).delete()
     # save the new entry
-    return DBSleepDiaryEntry(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBSleepDiaryEntry(**{"user": db_user_id, **entry}).save()
+    )
 
 
 def get_json_diary_entry(entry: dict) -> str:
@@ -124,6 +128,7 @@ def save_sleep_diary_entry(x: BaseAgent, utterance: str):
         return
     log.info(f"save_sleep_diary_entry {entry=}")
     save_sleep_diary_entry_to_db(x.db_user_id, entry)
+    commit_draft(x)
 
 
 @set_attribute("return_direct", False)
@@ -164,7 +169,8 @@ def get_date_sleep_diary_entry(x: BaseAgent, utterance: str):
 def diary_entry(db_user_id: str):
     """Returns True if it's time to ask the human to record a sleep diary
     entry."""
-    if goal_refused(db_user_id, "diary_entry"):
+    state = get_goal_state(db_user_id)
+    if state.refused("diary_entry"):
         return False
 
     # don't ask if the user has integrated a supported wearable device
@@ -174,8 +180,10 @@ def diary_entry(db_user_id: str):
     end = datetime.combine(date.today(), time())
     start = end - timedelta(days=1)
 
-    return DBSleepDiaryEntry.objects(user=db_user_id, date__gte=start).count() == 0
+    return not state.has(DBSleepDiaryEntry, since=start)
+
 
+GOAL_DOCUMENTS = [DBSleepDiaryEntry]
 
 GOAL_HANDLERS = [
     {
@@ -183,6 +191,28 @@ GOAL_HANDLERS = [
     },
 ]
 
+DIARY_RULES = {
+    "in_bed": parse_time(night=True),
+    "tried_to_fall_asleep": parse_time(night=True),
+    "time_to_fall_asleep": parse_duration,
+    "times_awake": parse_count,
+    "time_awake": parse_duration,
+    "final_wake_up": parse_time(),
+    "out_of_bed": parse_time(),
+}
+
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [
+    {
+        "diary_entry": {
+            "capture": SleepDiaryEntry,
+            "rules": DIARY_RULES,
+            # one entry a day, an unfinished one isn't carried over
+            "recurs": True,
+        }
+    }
+]
+
 SLEEP_EFFICIENCY = """
 Very important! Include sleep sleep duration in hours and minutes and efficiency
 as a percentage.
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import warnings
 from typing import Callable, List
@@ -6,19 +7,14 @@ from langchain.agents import AgentExecutor, OpenAIFunctionsAgent
 from langchain.callbacks.streaming_stdout_final_only import (
     FinalStreamingStdOutCallbackHandler,
 )
-from langchain.chat_models import ChatOpenAI
-from langchain.memory import (
-    ConversationBufferWindowMemory,
-    MongoDBChatMessageHistory,
-    ReadOnlySharedMemory,
-)
+from langchain.memory import ConversationBufferWindowMemory, ReadOnlySharedMemory
 from langchain.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
-from langchain.schema import AgentAction, BaseMessage
+from langchain.schema import AgentAction, AIMessage, BaseMessage, HumanMessage
 from tqdm import TqdmExperimentalWarning
 
 with warnings.catch_warnings():
@@ -28,22 +24,14 @@ with warnings.catch_warnings():
 from .agent import BaseAgent
 from .audio import play
 from .cache import setup_cache
-from .config import (
-    MONGODB_URI,
-    SLEEPMATE_AGENT_MODEL_NAME,
-    SLEEPMATE_DEFAULT_MODEL_NAME,
-    SLEEPMATE_MEMORY_LENGTH,
-    SLEEPMATE_SAMPLING_TEMPERATURE,
-)
+from .capture import await_capture, clear_draft, start_capture, wait_for_capture
+from .chat import WindowedChatMessageHistory
+from .config import SLEEPMATE_LLM_CACHE, SLEEPMATE_MEMORY_LENGTH
 from .db import *
-from .goal import add_goal_refused
-from .helpful_scripts import (
-    Goal,
-    display_markdown,
-    flatten_dict,
-    import_attrs,
-    setup_logging,
-)
+from .goal import GoalState, add_goal_refused, use_goal_state
+from .helpful_scripts import Goal, display_markdown, setup_logging
+from .models import get_model
+from .pool import TurnGate, XPool
 from .prompt import (
     GoalRefusedHandler,
     MessageHandler,
@@ -51,6 +39,7 @@ from .prompt import (
     get_system_prompt,
     get_tools,
 )
+from .registry import get_registry
 from .user import clear_db_for_user, get_user_from_id, get_user_from_username
 
 log = logging.getLogger(__name__)
@@ -100,16 +89,15 @@ class X(BaseAgent):
             self.log = log
         else:
             self.log = log_
-        if cache:
+        if cache or SLEEPMATE_LLM_CACHE:
             setup_cache()
         self.fixed_goal = False
         self.goal_list = goal_list or X.DEFAULT_GOAL_LIST
         self.memory = None
-        self.tools = import_attrs(["TOOLS"])["TOOLS"]
+        self.goal_state = None
+        self.goals = get_registry()
+        self.tools = self.goals["TOOLS"]
         self.log.debug(f"X() len(self.tools)={len(self.tools)}")
-        self.goals = flatten_dict(
-            import_attrs(["GOALS", "GOAL_HANDLERS", "GOAL_OPTIONS"])
-        )
         assert set(self.goal_list).issubset(set(self.goals["GOAL_HANDLERS"].keys()))
 
         self.audio = audio
@@ -120,6 +108,7 @@ class X(BaseAgent):
         self.callbacks = [
             GoalRefusedHandler(self.set_goal_refused),
             MessageHandler(self.set_chat_model_start),
+            FinalStreamingStdOutCallbackHandler(),
         ]
         self.fixed_goal = fixed_goal
         self.goal = None
@@ -130,36 +119,40 @@ class X(BaseAgent):
         if hello is not None:
             self(hello)
 
-    def get_next_goal(self) -> str:
+    def get_next_goal(self, reuse: bool = False) -> str:
         """Returns the next goal. Calls a function in each of the goal modules
-        in a predefined order and return the first goal that returns True."""
+        in a predefined order and return the first goal that returns True. With
+        reuse, the goal state snapshot from the last call is used if nothing
+        has been written since."""
         if self.fixed_goal:
             return self.goal
 
-        goal = next(
-            (
-                goal_
-                for goal_ in self.goal_list
-                if self.goals["GOAL_HANDLERS"][goal_](self.db_user_id)
-            ),
-            "",
-        )
+        # the handlers share one snapshot of the user's goal state
+        with use_goal_state(self.get_goal_state(reuse)):
+            goal = next(
+                (
+                    goal_
+                    for goal_ in self.goal_list
+                    if self.goals["GOAL_HANDLERS"][goal_](self.db_user_id)
+                ),
+                "",
+            )
         return Goal(key=goal, description=self.goals["GOALS"][goal]) if goal else None
 
+    def get_goal_state(self, reuse: bool = False) -> GoalState:
+        if not reuse or self.goal_state is None or self.goal_state.stale:
+            self.goal_state = GoalState(self.db_user_id, self.goals["GOAL_DOCUMENTS"])
+        return self.goal_state
+
     def set_agent(self):
         agent = OpenAIFunctionsAgent(
-            llm=ChatOpenAI(
-                temperature=0,
-                model=SLEEPMATE_AGENT_MODEL_NAME,
-                callbacks=[FinalStreamingStdOutCallbackHandler()],
-                streaming=True,
-            ),
+            llm=get_model("agent"),
             tools=get_tools(self),
             prompt=self.get_agent_prompt(),
         )
-        self.agent_executor = AgentExecutor(
-            agent=agent, tools=agent.tools, memory=self.memory
-        )
+        # no memory here, the turn loads and saves the chat history itself so
+        # that arun can keep the database calls off the event loop
+        self.agent_executor = AgentExecutor(agent=agent, tools=agent.tools)
 
     def set_goal_refused(self, action: AgentAction, goal_refused: bool = True) -> None:
         self.goal_refused = goal_refused
@@ -171,13 +164,17 @@ class X(BaseAgent):
 
     def proceed(self, utterance: str = "") -> Goal:
         """Returns the next goal. If the goal has changed, then the agent is
-        reset."""
+        reset. A goal that starts after another one starts without a draft, a
+        fresh agent, e.g. after a restart, carries on with it."""
         log.info(f"proceed: {utterance=}")
         self.goal_refused = False
         goal = self.get_next_goal()
         if goal != self.goal:
             self.log.info(f"{self.db_user_id} {self.goal} -> {goal}")
+            if self.goal is not None and goal is not None:
+                clear_draft(self.db_user_id, goal.key)
             self.goal = goal
+            self.memory.chat_memory.set_goal(goal.key if goal else "")
             self.set_agent()
         return goal
 
@@ -193,16 +190,48 @@ class X(BaseAgent):
         log.debug(f"set_chat_model_start: {self.last_message=}")
 
     def get_latest_messages(self, k: int) -> List[BaseMessage]:
-        return self.memory.chat_memory.messages[-k:] + [self.last_message]
+        return self.memory.chat_memory.get_messages(k) + [self.last_message]
+
+    def get_chat_history(self) -> List[BaseMessage]:
+        return self.memory.load_memory_variables({})[self.memory.memory_key]
+
+    def capture_answer(self, utterance: str) -> None:
+        """For goals with a capture option, extract the answer in utterance
+        into the goal's draft while the agent runs. Rules are tried first.
+        Drafts belong to a user, without one the answers are only extracted
+        when the entry is saved."""
+        if not utterance or self.goal is None or self.db_user_id is None:
+            return
+        options = self.goals["GOAL_OPTIONS"].get(self.goal.key, {})
+        if "capture" in options:
+            start_capture(self, options["capture"], utterance, options.get("rules"))
+
+    def save_turn(self, utterance: str, output: str) -> None:
+        """Called once this turn's capture is done, so a refused goal's draft
+        stays cleared."""
+        self.memory.chat_memory.add_messages(
+            [HumanMessage(content=utterance), AIMessage(content=output)]
+        )
+        if self.goal_refused and self.goal is not None:
+            clear_draft(self.db_user_id, self.goal.key)
 
     def run(self, utterance: str = "") -> str:
+        with TURNS.turn(self.db_user_id):
+            return self.run_turn(utterance)
+
+    def run_turn(self, utterance: str = "") -> str:
+        self.memory.chat_memory.start_turn()
         goal = self.proceed(utterance)
+        self.capture_answer(utterance)
         if not utterance:
             utterance = goal.key
         output = self.agent_executor.run(
             input=utterance,
+            chat_history=self.get_chat_history(),
             callbacks=self.callbacks,
         )
+        wait_for_capture(self)
+        self.save_turn(utterance, output)
         # print(output)
         if self.audio:
             play(output)
@@ -212,14 +241,28 @@ class X(BaseAgent):
         return output
 
     async def arun(self, utterance: str = "") -> str:
-        goal = self.proceed(utterance)
+        """Like run, but everything that blocks (goal evaluation, the chat
+        history and the tools) runs in worker threads so the event loop is free
+        to serve other conversations. Turns for the same user run one at a
+        time."""
+        async with TURNS.aturn(self.db_user_id):
+            return await self.arun_turn(utterance)
+
+    async def arun_turn(self, utterance: str = "") -> str:
+        self.memory.chat_memory.start_turn()
+        goal = await asyncio.to_thread(self.proceed, utterance)
+        await asyncio.to_thread(self.capture_answer, utterance)
         if not utterance:
             utterance = goal.key
+        chat_history = await asyncio.to_thread(self.get_chat_history)
         output = await self.agent_executor.arun(
             input=utterance,
+            chat_history=chat_history,
             callbacks=self.callbacks,
         )
-        self.clear_old_goal_chat_history()
+        await await_capture(self)
+        await asyncio.to_thread(self.save_turn, utterance, output)
+        await asyncio.to_thread(self.clear_old_goal_chat_history)
         return output
 
     def load_memory(
@@ -228,42 +271,32 @@ class X(BaseAgent):
         memory_key: str = "chat_history",
     ) -> None:
         self.memory = ConversationBufferWindowMemory(
-            llm=ChatOpenAI(
-                temperature=SLEEPMATE_SAMPLING_TEMPERATURE,
-                model_name=SLEEPMATE_DEFAULT_MODEL_NAME,
-            ),
+            llm=get_model("gpt"),
             memory_key=memory_key,
             return_messages=True,
             k=k,
-            chat_memory=MongoDBChatMessageHistory(
-                MONGODB_URI,
-                self.db_user_id,
-                database_name=MONGODB_NAME,
+            chat_memory=WindowedChatMessageHistory(
+                self.db_user_id, window=k * 2, goal=self.goal.key if self.goal else ""
             ),
         )
         self.ro_memory = ReadOnlySharedMemory(memory=self.memory)
 
     def clear_old_goal_chat_history(self):
-        goal = self.get_next_goal()
-        # clear the chat history if the goal has changed
+        goal = self.get_next_goal(reuse=True)
+        # start the next goal with an empty chat history if the goal has changed
         if self.goal is not None and self.goal != goal:
             log.info(
-                f"clear_chat_history: {self.goal} -> {goal} ({self.db_user_id} cleared)"
+                f"clear_chat_history: {self.goal} -> {goal} ({self.db_user_id})"
             )
-            self.memory.clear()
+            self.memory.chat_memory.archive(goal.key if goal else "")
 
     def clear_chat_history_tail(self, N=10):
         """Delete the last N chat history entries."""
-        collection = self.memory.chat_memory.collection
-        cursor = (
-            collection.find({"SessionId": self.db_user_id}).sort([("_id", -1)]).limit(N)
-        )
-        ids_to_delete = [doc["_id"] for doc in cursor]
-        log.info(f"clear_chat_history_tail: deleting {ids_to_delete=}")
-        collection.delete_many({"_id": {"$in": ids_to_delete}})
+        self.memory.chat_memory.delete_last(N)
 
     def clear_db(self):
         clear_db_for_user(self.db_user_id)
+        POOL.invalidate(self.db_user_id)
 
     def get_agent_prompt(self, rigid=None) -> ChatPromptTemplate:
         system = get_system_prompt(self)
@@ -285,3 +318,13 @@ class X(BaseAgent):
             )
 
         return ChatPromptTemplate.from_messages(messages)
+
+
+POOL = XPool(X)
+TURNS = TurnGate()
+
+
+def get_x(db_user, **kwargs) -> X:
+    """Returns a warm agent for db_user from the process-wide pool, building a
+    new one with X(**kwargs) if needed."""
+    return POOL.get(db_user.id, username=db_user.username, hello=None, **kwargs)
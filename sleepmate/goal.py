@@ -1,11 +1,15 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from typing import Callable, Iterable, List
 
 from langchain.pydantic_v1 import BaseModel, Field, validator
-from mongoengine import ReferenceField
+from mongoengine import DictField, Document, ListField, ReferenceField, StringField
+from pymongo.errors import DuplicateKeyError
 
 from .helpful_scripts import get_date_fields, parse_date
 from .structured import fix_schema, pydantic_to_mongoengine
-from .user import DBUser
+from .user import DBUser, get_object_id
 
 
 class GoalRefusal_(BaseModel):
@@ -27,7 +31,9 @@ class GoalRefusal(GoalRefusal_):
 
 
 DBGoalRefusal = pydantic_to_mongoengine(
-    GoalRefusal, extra_fields={"user": ReferenceField(DBUser, required=True)}
+    GoalRefusal,
+    extra_fields={"user": ReferenceField(DBUser, required=True)},
+    indexes=[("user", "goal", "-date")],
 )
 
 
@@ -41,11 +47,322 @@ def goal_refused(db_user_id: str, goal: str, days: int = 1) -> DBGoalRefusal:
 
 
 def add_goal_refused(db_user_id: str, goal: str) -> DBGoalRefusal:
-    return DBGoalRefusal(
+    db_entry = DBGoalRefusal(
         **{"user": db_user_id, "goal": goal, "date": datetime.now()}
     ).save()
+    update_progress(db_user_id, {"$max": {f"refusals.{goal}": db_entry.date}})
+    return db_entry
 
 
 def clear_goal_refused(db_user_id: str, goal: str) -> None:
     """Clears goal refusal for the given user and goal."""
     DBGoalRefusal.objects(user=db_user_id, goal=goal).delete()
+    update_progress(db_user_id, {"$unset": {f"refusals.{goal}": ""}})
+
+
+######################################################################
+# UserProgress - the goal state materialised per user, updated on write
+######################################################################
+
+
+class UserProgress(BaseModel):
+    date: datetime = Field(description="date of last update")
+    version: int = Field(default=0, description="bumped on every write")
+
+
+# refusals maps goal -> date of the last refusal, summaries maps collection name
+# -> {"date": newest date, "last": most recent entry} for each of collections.
+# The document is built on first read, see GoalState.load, until then it only
+# has a version
+DBUserProgress = pydantic_to_mongoengine(
+    UserProgress,
+    extra_fields={
+        "user": ReferenceField(DBUser, required=True, unique=True),
+        "refusals": DictField(),
+        "summaries": DictField(),
+        "collections": ListField(StringField()),
+    },
+)
+
+
+def get_progress_version(db_user_id: str) -> int:
+    progress = DBUserProgress._get_collection().find_one(
+        {"user": get_object_id(db_user_id)}, {"version": 1}
+    )
+    return (progress or {}).get("version", 0)
+
+
+def invalidate_goal_state(db_user_id: str) -> None:
+    """Call after writing anything else the goal handlers read."""
+    update_progress(db_user_id, {})
+
+
+def update_progress(db_user_id: str, update: dict, filter: dict = None) -> None:
+    """Apply update to the user's progress document if it has been built, and
+    bump its version either way. The version tells every process that its
+    snapshot is stale, and stops a build that read the data before this write
+    from saving, see GoalState.load."""
+    if db_user_id is None:
+        return
+    collection = DBUserProgress._get_collection()
+    match = {"user": get_object_id(db_user_id)}
+    bump = {"$set": {"date": datetime.now()}, "$inc": {"version": 1}}
+    if update:
+        update.setdefault("$set", {}).update(bump["$set"])
+        update["$inc"] = bump["$inc"]
+        built = {**match, "collections": {"$exists": True}, **(filter or {})}
+        if collection.update_one(built, update).matched_count:
+            return
+    try:
+        collection.update_one(match, bump, upsert=True)
+    except DuplicateKeyError:
+        collection.update_one(match, bump)  # created concurrently
+
+
+def record_progress(db_user_id: str, db_entry: Document) -> Document:
+    """Call with each entry saved for a goal document. Returns db_entry."""
+    name = db_entry._get_collection_name()
+    update = {"$set": {f"summaries.{name}.last": db_entry.to_mongo().to_dict()}}
+    date = getattr(db_entry, "date", None)
+    if date is not None:
+        update["$max"] = {f"summaries.{name}.date": date}
+    # only touch summaries that are complete, the rest get built on next read
+    update_progress(db_user_id, update, filter={"collections": name})
+    return db_entry
+
+
+def refresh_progress(db_user_id: str, *documents: Document) -> None:
+    """Call after deleting entries for a goal document, the summaries are
+    rebuilt the next time they're read."""
+    names = [d._get_collection_name() for d in documents]
+    update_progress(
+        db_user_id,
+        {
+            "$unset": {f"summaries.{name}": "" for name in names},
+            "$pull": {"collections": {"$in": names}},
+        },
+    )
+
+
+def get_summary_pipeline(match: dict, name: str) -> list:
+    """Summarise one collection for a user as a single row: the newest date and
+    the most recently inserted document."""
+    return [
+        {"$match": match},
+        {"$sort": {"_id": -1}},
+        {
+            "$group": {
+                "_id": None,
+                "date": {"$max": "$date"},
+                "last": {"$first": "$$ROOT"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "collection": {"$literal": name},
+                "date": 1,
+                "last": 1,
+            }
+        },
+    ]
+
+
+def aggregate_progress(
+    db_user_id: str, names: List[str], refusals: bool = False
+) -> (dict, dict):
+    """Compute the goal refusals (optionally) and a summary of each of the named
+    collections for a user in one aggregation."""
+    match = {"user": get_object_id(db_user_id)}
+    db_ = DBGoalRefusal._get_db()
+    if refusals:
+        collection = DBGoalRefusal._get_collection()
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": "$goal", "date": {"$max": "$date"}}},
+            {"$project": {"_id": 0, "goal": "$_id", "date": 1}},
+        ]
+    else:
+        collection = db_[names[0]]
+        pipeline = get_summary_pipeline(match, names[0])
+        names = names[1:]
+    for name in names:
+        pipeline.append(
+            {
+                "$unionWith": {
+                    "coll": name,
+                    "pipeline": get_summary_pipeline(match, name),
+                }
+            }
+        )
+    refusals_, summaries = {}, {}
+    for row in collection.aggregate(pipeline):
+        if "goal" in row:
+            refusals_[row["goal"]] = row["date"]
+        else:
+            summaries[row.pop("collection")] = row
+    return refusals_, summaries
+
+
+######################################################################
+# GoalState - a per-user snapshot read by the goal handlers
+######################################################################
+
+
+class GoalState(object):
+    """Everything the goal handlers need to know about a user, read from their
+    UserProgress document in one query. The first time a user (or a collection)
+    is seen, the goal refusals and a summary of the given documents are built in
+    one aggregation and saved for next time."""
+
+    def __init__(self, db_user_id: str, documents: Iterable[Document] = ()) -> None:
+        self.db_user_id = db_user_id
+        self.documents = {d._get_collection_name(): d for d in documents}
+        # the version of the progress document the snapshot was read from
+        self.version = None
+        self.refusals = None
+        self.summaries = None
+        self.collections = None
+        self.memo = {}
+
+    @property
+    def stale(self) -> bool:
+        """True if goal state for the user has been written, by any process,
+        since the snapshot was read."""
+        if self.db_user_id is None:
+            return False
+        if self.version is None:
+            return True  # nothing read yet, a new snapshot costs nothing
+        return self.version != get_progress_version(self.db_user_id)
+
+    def load(self) -> None:
+        if self.db_user_id is None:
+            # an agent without a user has no progress
+            self.refusals, self.summaries, self.collections = {}, {}, set()
+            return
+        collection = DBUserProgress._get_collection()
+        match = {"user": get_object_id(self.db_user_id)}
+        progress = collection.find_one(match) or {}
+        version = progress.get("version", 0)
+        if self.version is None:
+            self.version = version
+        if "collections" not in progress:
+            names = list(self.documents.keys())
+            self.refusals, self.summaries = aggregate_progress(
+                self.db_user_id, names, refusals=True
+            )
+            self.collections = set(names)
+            # saved only if nothing was written since the version was read,
+            # otherwise the aggregation may have missed it and the next read
+            # builds it again
+            try:
+                collection.update_one(
+                    {
+                        **match,
+                        "version": version,
+                        "collections": {"$exists": False},
+                    },
+                    {
+                        "$set": {
+                            "date": datetime.now(),
+                            "refusals": self.refusals,
+                            "summaries": self.summaries,
+                            "collections": names,
+                        }
+                    },
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                pass  # written to or built by another worker
+            return
+        self.refusals = progress.get("refusals", {})
+        self.summaries = progress.get("summaries", {})
+        self.collections = set(progress.get("collections", []))
+        self.add_collections(
+            [name for name in self.documents.keys() if name not in self.collections]
+        )
+
+    def add_collections(self, names: List[str]) -> None:
+        """Summarise collections that aren't in the progress document yet."""
+        if not names or self.db_user_id is None:
+            return
+        _, summaries = aggregate_progress(self.db_user_id, names)
+        self.summaries.update(summaries)
+        self.collections.update(names)
+        update = {"$addToSet": {"collections": {"$each": names}}}
+        if summaries:
+            update["$set"] = {
+                f"summaries.{name}": summary for (name, summary) in summaries.items()
+            }
+        # as in load, a write since the snapshot was read means these may be
+        # out of date already, so they're left for the next read to build.
+        # Adding them doesn't change the data, so the version stays
+        DBUserProgress._get_collection().update_one(
+            {"user": get_object_id(self.db_user_id), "version": self.version}, update
+        )
+
+    def get_summary(self, document: Document) -> dict:
+        if self.summaries is None:
+            self.load()
+        name = document._get_collection_name()
+        if name not in self.collections:
+            self.documents[name] = document
+            self.add_collections([name])
+        return self.summaries.get(name)
+
+    def refused(self, goal: str, days: int = 1) -> bool:
+        """Same as goal_refused, from the snapshot."""
+        if self.refusals is None:
+            self.load()
+        date = self.refusals.get(goal)
+        if date is None:
+            return False
+        return days is None or date >= datetime.now() - timedelta(days=days)
+
+    def has(self, document: Document, since: datetime = None) -> bool:
+        """Returns True if the user has any entries in the document's collection,
+        dated on or after since if given."""
+        summary = self.get_summary(document)
+        if summary is None:
+            return False
+        if since is None:
+            return True
+        date = summary.get("date")
+        return date is not None and date >= since
+
+    def last(self, document: Document) -> Document:
+        """Returns the user's most recent entry for the document."""
+        summary = self.get_summary(document)
+        if summary is None:
+            return None
+        return document._from_son(summary["last"])
+
+    def memoize(self, key: str, func: Callable[[], object]) -> object:
+        """Remember the result of an ad-hoc query for the life of the snapshot."""
+        if self.version is None and self.db_user_id is not None:
+            self.version = get_progress_version(self.db_user_id)
+        if key not in self.memo:
+            self.memo[key] = func()
+        return self.memo[key]
+
+
+_goal_state = ContextVar("goal_state", default=None)
+
+
+@contextmanager
+def use_goal_state(state: GoalState):
+    """Make state the snapshot returned by get_goal_state in this context."""
+    token = _goal_state.set(state)
+    try:
+        yield state
+    finally:
+        _goal_state.reset(token)
+
+
+def get_goal_state(db_user_id: str) -> GoalState:
+    """Returns the snapshot in use for db_user_id, or a new one if the handler
+    was called on its own."""
+    state = _goal_state.get()
+    if state is None or str(state.db_user_id) != str(db_user_id):
+        return GoalState(db_user_id)
+    return state
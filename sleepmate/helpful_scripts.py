@@ -88,13 +88,13 @@ def import_attrs(attrs: List[str], dir: str = None) -> dict:
         try:
             import_path = f"{dir.name}.{p.stem}"
             # print(f"{import_path=}")
-            for attr in attrs:
-                imported[attr].extend(
-                    getattr(importlib.import_module(import_path), attr)
-                )
+            module = importlib.import_module(import_path)
         except AttributeError as e:
             # print(f"import_attrs {e=}")
             continue
+        # a module may define some of the attributes but not others
+        for attr in attrs:
+            imported[attr].extend(getattr(module, attr, []))
     return imported
 
 
@@ -5,7 +5,8 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     get_start_end,
@@ -17,7 +18,6 @@ from .helpful_scripts import (
 from .structured import (
     fix_schema,
     get_document_summary,
-    get_parsed_output,
     pydantic_to_mongoengine,
 )
 from .user import DBUser
@@ -80,9 +80,9 @@ DBHealthHistory = pydantic_to_mongoengine(
 
 
 def get_health_history_from_memory(x: BaseAgent) -> HealthHistory:
-    return get_parsed_output(
+    return get_captured_output(
+        x,
         "summarise the answers the human gave for their health history",
-        x.get_latest_messages,
         HealthHistory,
     )
 
@@ -93,7 +93,9 @@ def save_health_history_to_db(db_user_id: str, entry: HealthHistory) -> DBHealth
     (start, end) = get_start_end(entry["date"])
     DBHealthHistory.objects(user=db_user_id, date__gte=start, date__lte=end).delete()
     # save the new entry
-    return DBHealthHistory(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBHealthHistory(**{"user": db_user_id, **entry}).save()
+    )
 
 
 def get_json_health_history(entry: dict) -> str:
@@ -118,6 +120,7 @@ def save_health_history(x: BaseAgent, utterance: str):
     if entry is not None:
         log.info(f"save_health_history {entry=}")
         save_health_history_to_db(x.db_user_id, entry)
+        commit_draft(x)
 
 
 @set_attribute("return_direct", False)
@@ -153,10 +156,13 @@ def get_is_hypertensive(x: BaseAgent, utterance: str):
 
 def health_history(db_user_id: str):
     """Returns True if a Health History should happen."""
-    if goal_refused(db_user_id, "health_history"):
+    state = get_goal_state(db_user_id)
+    if state.refused("health_history"):
         return False
-    return DBHealthHistory.objects(user=db_user_id).count() == 0
+    return not state.has(DBHealthHistory)
+
 
+GOAL_DOCUMENTS = [DBHealthHistory]
 
 GOAL_HANDLERS = [
     {
@@ -164,6 +170,9 @@ GOAL_HANDLERS = [
     },
 ]
 
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [{"health_history": {"capture": HealthHistory}}]
+
 GOALS = [
     {
         "health_history": """
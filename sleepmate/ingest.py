@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+
+from .config import SLEEPMATE_EMBEDDING_BATCH_SIZE, SLEEPMATE_EMBEDDING_WORKERS
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".manifest.json"
+
+
+def get_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_chunk_id(chunk: Document) -> str:
+    """Chunks are keyed by content, so unchanged text keeps its vector."""
+    return get_hash(chunk.page_content.encode("utf-8"))
+
+
+class Manifest(object):
+    """What's already in the vector store: the content hash of every file and
+    the ids of its chunks, plus the token count of every embedded chunk. It's
+    written after every batch so a crashed run picks up where it stopped. This
+    one is a JSON file at path, subclasses keep it elsewhere by overriding read
+    and write."""
+
+    def __init__(self, path: Path = None) -> None:
+        self.path = Path(path) if path is not None else None
+        self.files: Dict[str, dict] = {}
+        self.chunks: Dict[str, dict] = {}
+        data = self.read()
+        # False for a vector store nothing has been recorded for
+        self.found = data is not None
+        if data is not None:
+            self.files = data.get("files", {})
+            self.chunks = data.get("chunks", {})
+
+    def read(self) -> Optional[dict]:
+        if self.path is None or not self.path.exists():
+            return None
+        return json.loads(self.path.read_text())
+
+    def write(self, data: dict) -> None:
+        # write then rename, a crash mid-write mustn't lose the manifest
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, self.path)
+
+    def save(self) -> None:
+        self.write(
+            {"files": self.files, "chunks": self.chunks, "version": self.version}
+        )
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the set of chunks in the vector store does."""
+        return get_hash("\n".join(sorted(self.chunks)).encode("utf-8"))
+
+    def clear(self) -> None:
+        self.files = {}
+        self.chunks = {}
+        self.save()
+
+    def is_current(self, name: str, file_hash: str) -> bool:
+        entry = self.files.get(name)
+        return (
+            entry is not None
+            and entry["sha256"] == file_hash
+            and all(id in self.chunks for id in entry["chunks"])
+        )
+
+    def get_orphans(self, ids: List[str]) -> List[str]:
+        """Returns the ids that no file refers to any more."""
+        used = {id for entry in self.files.values() for id in entry["chunks"]}
+        return [id for id in ids if id not in used and id in self.chunks]
+
+
+def get_batches(items: List, size: int) -> Iterator[List]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def upsert_chunks(
+    index,
+    embeddings: Embeddings,
+    manifest: Manifest,
+    chunks: Dict[str, Document],
+    count_tokens: Callable[[str], int],
+    batch_size: int = SLEEPMATE_EMBEDDING_BATCH_SIZE,
+    max_workers: int = SLEEPMATE_EMBEDDING_WORKERS,
+) -> None:
+    """Embed chunks in batches, at most max_workers at a time, and upsert each
+    batch as soon as it's done."""
+    batches = list(get_batches(list(chunks.items()), batch_size))
+
+    def embed(batch):
+        return embeddings.embed_documents([chunk.page_content for _, chunk in batch])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, vectors in zip(batches, executor.map(embed, batches)):
+            records = []
+            for (id, chunk), vector in zip(batch, vectors):
+                tokens = count_tokens(chunk.page_content)
+                metadata = {**chunk.metadata, "text": chunk.page_content}
+                records.append((id, vector, {**metadata, "tokens": tokens}))
+                manifest.chunks[id] = {
+                    "source": chunk.metadata.get("source"),
+                    "tokens": tokens,
+                }
+            index.upsert(vectors=records)
+            manifest.save()
+            log.info(f"upsert_chunks {len(records)=}")
+
+
+def ingest_file(
+    path: Path,
+    index,
+    embeddings: Embeddings,
+    manifest: Manifest,
+    load: Callable[[Path], List[Document]],
+    count_tokens: Callable[[str], int],
+    **kwargs,
+) -> List[str]:
+    """Embed the new or changed chunks in path and drop the ones that have gone
+    away. Returns the ids of the file's chunks."""
+    path = Path(path)
+    name = str(path)
+    file_hash = get_file_hash(path)
+    if manifest.is_current(name, file_hash):
+        log.info(f"skipping unchanged `{path}'")
+        return manifest.files[name]["chunks"]
+    log.info(f"loading `{path}'")
+    chunks = {get_chunk_id(chunk): chunk for chunk in load(path)}
+    new = {id: chunk for id, chunk in chunks.items() if id not in manifest.chunks}
+    log.info(f"ingest_file {len(chunks)=} {len(new)=}")
+    upsert_chunks(index, embeddings, manifest, new, count_tokens, **kwargs)
+    old = manifest.files.get(name, {}).get("chunks", [])
+    manifest.files[name] = {"sha256": file_hash, "chunks": list(chunks)}
+    delete_chunks(index, manifest, [id for id in old if id not in chunks])
+    manifest.save()
+    return list(chunks)
+
+
+def delete_chunks(index, manifest: Manifest, ids: List[str]) -> None:
+    orphans = manifest.get_orphans(ids)
+    if orphans:
+        log.info(f"delete_chunks {len(orphans)=}")
+        index.delete(ids=orphans)
+        for id in orphans:
+            del manifest.chunks[id]
+
+
+def ingest(
+    path: Path,
+    index,
+    embeddings: Embeddings,
+    loaders: Dict[str, Callable[[Path], List[Document]]],
+    count_tokens: Callable[[str], int],
+    reset: bool = False,
+    manifest: Manifest = None,
+    **kwargs,
+) -> Manifest:
+    """Bring the vector store in line with the files in path. Only chunks the
+    manifest hasn't seen are embedded, and chunks from files that have changed
+    or been removed are deleted. The manifest defaults to a file in path."""
+    dir = Path(path)
+    if manifest is None:
+        manifest = Manifest(dir / MANIFEST_NAME)
+    if reset:
+        manifest.clear()
+    seen = set()
+    for file in sorted(dir.iterdir()):
+        load = loaders.get(file.suffix)
+        if load is None:
+            log.info(f"skipping `{file}'")
+            continue
+        ingest_file(file, index, embeddings, manifest, load, count_tokens, **kwargs)
+        seen.add(str(file))
+    # files added from elsewhere with add_to_knowledge are left alone
+    removed = [
+        name
+        for name in manifest.files
+        if Path(name).parent == dir and name not in seen
+    ]
+    for name in removed:
+        log.info(f"removing `{name}'")
+        ids = manifest.files.pop(name)["chunks"]
+        delete_chunks(index, manifest, ids)
+    manifest.save()
+    return manifest
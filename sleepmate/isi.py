@@ -5,7 +5,8 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     json_dumps,
@@ -13,8 +14,9 @@ from .helpful_scripts import (
     parse_date,
     set_attribute,
 )
-from .sleep50 import get_last_sleep50_entry_from_db, sum_category
-from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
+from .rules import parse_score
+from .sleep50 import DBSleep50Entry, sum_category
+from .structured import fix_schema, pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
@@ -52,9 +54,9 @@ DBISIEntry = pydantic_to_mongoengine(
 
 
 def get_isi_entry_from_memory(x: BaseAgent) -> ISIEntry:
-    return get_parsed_output(
+    return get_captured_output(
+        x,
         "summarise the last Insomnia Severity Index entry",
-        x.get_latest_messages,
         ISIEntry,
     )
 
@@ -64,7 +66,7 @@ def save_isi_entry_to_db(user: str, entry: ISIEntry) -> DBISIEntry:
     entry = entry.dict()
     DBISIEntry.objects(user=user, date=entry["date"]).delete()
     # save the new entry
-    return DBISIEntry(**{"user": user, **entry}).save()
+    return record_progress(user, DBISIEntry(**{"user": user, **entry}).save())
 
 
 def get_json_isi_entry(entry: dict) -> str:
@@ -80,6 +82,7 @@ def save_isi_entry(x: BaseAgent, utterance: str):
     if entry is not None:
         log.info(f"save_isi_entry {entry=}")
         save_isi_entry_to_db(x.db_user_id, entry)
+        commit_draft(x)
 
 
 @set_attribute("return_direct", False)
@@ -112,24 +115,36 @@ def get_isi_dates(x: BaseAgent, utterance: str):
 
 def insomnia_severity_index(db_user_id: str) -> bool:
     # get the results of the SLEEP-50 questionnaire
-    db_entry = get_last_sleep50_entry_from_db(db_user_id)
+    state = get_goal_state(db_user_id)
+    db_entry = state.last(DBSleep50Entry)
     if db_entry is None:
         return False
     # check the insomnia questions
     (n, total) = sum_category(db_entry, "insomnia")
     if n == total:
         return False  # no problem here
-    if goal_refused(db_user_id, "insomnia_severity_index"):
+    if state.refused("insomnia_severity_index"):
         return False
-    return DBISIEntry.objects(user=db_user_id).count() == 0
+    return not state.has(DBISIEntry)
 
 
+GOAL_DOCUMENTS = [DBISIEntry]
+
 GOAL_HANDLERS = [
     {
         "insomnia_severity_index": insomnia_severity_index,
     },
 ]
 
+ISI_RULES = {
+    field: parse_score(0, 4) for field in ISIEntry_.__fields__ if field != "date"
+}
+
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [
+    {"insomnia_severity_index": {"capture": ISIEntry, "rules": ISI_RULES}},
+]
+
 GOALS = [
     {
         "insomnia_severity_index": """
@@ -1,8 +1,12 @@
+import json
 import logging
 import os
+import threading
+import time
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import pinecone
 import tiktoken
@@ -15,33 +19,60 @@ from langchain.prompts import (
     SystemMessagePromptTemplate,
 )
 from langchain.pydantic_v1 import BaseModel, Field
+from langchain.schema import Document
 from langchain.vectorstores import Pinecone
+from langchain.vectorstores.base import VectorStore
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
+from .answer_cache import SemanticCache
 from .config import (
     PINECONE_INDEX_NAME,
+    SLEEPMATE_CORPUS_VERSION_CHECK,
     SLEEPMATE_DATADIR,
     SLEEPMATE_DEFAULT_MODEL_NAME,
+    SLEEPMATE_INDEX_DIR,
+    SLEEPMATE_KNOWLEDGE_TOP_K,
     SLEEPMATE_MAX_TOKENS,
+    SLEEPMATE_VECTORSTORE,
 )
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_confirmation_str,
     mongo_to_json,
     set_attribute,
     strip_all_whitespace,
 )
+from .ingest import MANIFEST_NAME, Manifest, ingest, ingest_file
 from .mi import get_completion
 from .structured import pydantic_to_mongoengine
 from .user import DBUser
+from .vectorstore import LocalVectorStore, get_local_index
 
 log = logging.getLogger(__name__)
 
-pinecone.init(
-    api_key=os.getenv("PINECONE_API_KEY"),  # find at app.pinecone.io
-    environment=os.getenv("PINECONE_ENVIRONMENT"),  # next to api key in console
-)
+# the vector store is set up on first use rather than on import, so processes
+# that never answer knowledge questions don't pay for it
+_lock = threading.RLock()
+_pinecone_ready = False
+_db = None
+# corpus version when the local index was last refreshed, see get_db
+_db_version = None
+# (version, when it was read), see get_corpus_version
+_corpus_version = (None, float("-inf"))
+
+ANSWER_CACHE = SemanticCache()
+
+
+def init_pinecone() -> None:
+    global _pinecone_ready
+    with _lock:
+        if not _pinecone_ready:
+            pinecone.init(
+                api_key=os.getenv("PINECONE_API_KEY"),  # find at app.pinecone.io
+                environment=os.getenv("PINECONE_ENVIRONMENT"),  # next to api key
+            )
+            _pinecone_ready = True
 
 
 class DailyRoutineSeen(BaseModel):
@@ -59,7 +90,9 @@ def save_daily_routine_seen_to_db(
     # delete any existing entries for this date
     DBDailyRoutineSeen.objects(user=db_user_id).delete()
     # save the new entry
-    return DBDailyRoutineSeen(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBDailyRoutineSeen(**{"user": db_user_id, **entry}).save()
+    )
 
 
 @set_attribute("return_direct", False)
@@ -98,12 +131,27 @@ GOALS = [
 
 
 def daily_routine(db_user_id: str) -> bool:
-    return (
-        not goal_refused(db_user_id, "daily_routine")
-        and DBDailyRoutineSeen.objects(user=db_user_id).count() == 0
-    )
+    state = get_goal_state(db_user_id)
+    return not state.refused("daily_routine") and not state.has(DBDailyRoutineSeen)
+
+
+# the version of the corpus in each index, written by whichever process ingests
+# it so that the servers querying the index can tell when it has changed. The
+# manifest is kept with it so that every host ingesting into the index agrees
+# on what's in it, see IndexManifest
+class CorpusVersion(BaseModel):
+    date: datetime = Field(description="date of ingestion")
+    index: str = Field(description="name of the index")
+    version: str = Field(description="version of the ingested corpus")
+    manifest: str = Field(default=None, description="ingest.Manifest as JSON")
 
 
+DBCorpusVersion = pydantic_to_mongoengine(
+    CorpusVersion, indexes=[{"fields": ["index"], "unique": True}]
+)
+
+GOAL_DOCUMENTS = [DBDailyRoutineSeen]
+
 GOAL_HANDLERS = [
     {
         "daily_routine": daily_routine,
@@ -116,68 +164,223 @@ loader_map = {
 }
 
 
+def load_file(path: Path) -> List[Document]:
+    # the split part is important, otherwise we get similarity search results
+    # that are too long for the model context window
+    return loader_map[path.suffix](str(path)).load_and_split()
+
+
 def download_files(path="data"):
     """Stub for S3 download"""
     pass
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = SLEEPMATE_DEFAULT_MODEL_NAME) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model_name)
+
+
+# the same chunks come back from retrieval over and over, so remember their
+# counts, keyed by content
+@lru_cache(maxsize=4096)
 def count_tokens(text: str) -> int:
-    encoding = tiktoken.encoding_for_model(SLEEPMATE_DEFAULT_MODEL_NAME)
-    return len(encoding.encode(text))
+    return len(get_encoding().encode(text))
+
+
+def get_index_name() -> str:
+    if SLEEPMATE_VECTORSTORE == "local":
+        return str(SLEEPMATE_INDEX_DIR)
+    return PINECONE_INDEX_NAME
+
+
+def get_index():
+    """Returns the raw index for the configured backend, a pinecone.Index or a
+    LocalIndex, they share the upsert/delete API the ingestion uses."""
+    if SLEEPMATE_VECTORSTORE == "local":
+        return get_local_index(SLEEPMATE_INDEX_DIR)
+    init_pinecone()
+    return pinecone.Index(PINECONE_INDEX_NAME)
+
+
+def get_vectorstore(index, embeddings: OpenAIEmbeddings) -> VectorStore:
+    if SLEEPMATE_VECTORSTORE == "local":
+        return LocalVectorStore(index, embeddings, "text")
+    return Pinecone(index, embeddings, "text")
+
+
+def has_index() -> bool:
+    if SLEEPMATE_VECTORSTORE == "local":
+        return len(get_local_index(SLEEPMATE_INDEX_DIR)) > 0
+    init_pinecone()
+    return PINECONE_INDEX_NAME in pinecone.list_indexes()
+
+
+class IndexManifest(Manifest):
+    """The manifest of the configured index, kept in its CorpusVersion. A
+    manifest file at path, from before it moved there, is read the first
+    time."""
+
+    def __init__(self, path: Path = None) -> None:
+        self.index_name = get_index_name()
+        super().__init__(path)
+
+    def read(self) -> Optional[dict]:
+        db_entry = DBCorpusVersion.objects(index=self.index_name).first()
+        if db_entry is not None and db_entry.manifest:
+            return json.loads(db_entry.manifest)
+        return super().read()
+
+    def write(self, data: dict) -> None:
+        save_corpus_version(data["version"], manifest=json.dumps(data))
 
 
 def add_to_knowledge(path: str) -> List[str]:
     """load a single PDF/text file into the knowledge base"""
     file = Path(path)
     assert file.exists(), f"{file} does not exist"
-    loader_cls = loader_map.get(file.suffix)
-    assert loader_cls is not None, f"no loader for {file}"
-    log.info(f"loading `{file}'")
-    pages = loader_cls(str(file)).load_and_split()
-    assert pages, "no pages loaded"
-    index = pinecone.Index(PINECONE_INDEX_NAME)
-    embeddings = OpenAIEmbeddings()
-    vectorstore = Pinecone(index, embeddings, "text")
-    return vectorstore.add_documents(pages)
+    assert file.suffix in loader_map, f"no loader for {file}"
+    manifest = IndexManifest(Path(SLEEPMATE_DATADIR) / MANIFEST_NAME)
+    ids = ingest_file(
+        file, get_index(), OpenAIEmbeddings(), manifest, load_file, count_tokens
+    )
+    manifest.save()
+    return ids
+
+
+def check_manifest(manifest: IndexManifest) -> None:
+    """An index with no manifest may hold chunks stored under the random ids
+    used before ingestion was incremental, which would come back twice from
+    retrieval. Only an explicit overwrite deletes the index."""
+    if not manifest.found:
+        raise ValueError(
+            f"no manifest for index `{manifest.index_name}', rebuild it with "
+            "load_knowledge(overwrite=True)"
+        )
 
 
 def load_knowledge(path="data", overwrite=False, metric="cosine", dimension=1536):
-    """load all the PDF/text files in path"""
+    """load all the new or changed PDF/text files in path, see ingest.py. With
+    overwrite the index is emptied and everything is embedded again."""
+    manifest = IndexManifest(Path(path) / MANIFEST_NAME)
+    if SLEEPMATE_VECTORSTORE == "local":
+        index = get_index()
+        index.refresh()
+        if overwrite:
+            index.delete(ids=index.ids)
+        elif not len(index):
+            overwrite = True
+        else:
+            check_manifest(manifest)
+    else:
+        init_pinecone()
+        exists = PINECONE_INDEX_NAME in pinecone.list_indexes()
+        if overwrite and exists:
+            pinecone.delete_index(PINECONE_INDEX_NAME)
+        elif exists:
+            check_manifest(manifest)
+        if overwrite or not exists:
+            pinecone.create_index(
+                name=PINECONE_INDEX_NAME, metric=metric, dimension=dimension
+            )
+            overwrite = True
+        index = get_index()
+    download_files(path)
     embeddings = OpenAIEmbeddings()
-    if PINECONE_INDEX_NAME not in pinecone.list_indexes() or overwrite:
-        pinecone.create_index(
-            name=PINECONE_INDEX_NAME, metric=metric, dimension=dimension
+    loaders = {suffix: load_file for suffix in loader_map}
+    ingest(
+        path,
+        index,
+        embeddings,
+        loaders,
+        count_tokens,
+        reset=overwrite,
+        manifest=manifest,
+    )
+    return get_vectorstore(index, embeddings)
+
+
+def get_db() -> VectorStore:
+    """Returns the knowledge base vector store, loading it on first use. Safe to
+    call from multiple threads. A local index is reloaded when the corpus
+    version changes, i.e. after an ingestion in another process."""
+    global _db, _db_version
+    if _db is None:
+        with _lock:
+            if _db is None:
+                if has_index():
+                    _db = get_vectorstore(get_index(), OpenAIEmbeddings())
+                else:
+                    _db = load_knowledge(SLEEPMATE_DATADIR)
+                _db_version = get_corpus_version()
+    if isinstance(_db, LocalVectorStore):
+        version = get_corpus_version()
+        if version != _db_version:
+            _db.index.refresh()
+            _db_version = version
+    return _db
+
+
+def get_chunk_tokens(doc: Document) -> int:
+    """Token count recorded at ingestion time, see ingest.py."""
+    tokens = doc.metadata.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(doc.page_content)
+    return int(tokens)
+
+
+def pack_context(docs: List[Document], budget: int) -> List[Document]:
+    """Greedily take the best ranked chunks that fit in budget tokens."""
+    packed = []
+    for doc in docs:
+        tokens = get_chunk_tokens(doc) + 1  # the joining space
+        if tokens <= budget:
+            packed.append(doc)
+            budget -= tokens
+    return packed
+
+
+def save_corpus_version(version: str, manifest: str = None) -> None:
+    global _corpus_version
+    update = {"set__version": version, "set__date": datetime.now()}
+    if manifest is not None:
+        update["set__manifest"] = manifest
+    DBCorpusVersion.objects(index=get_index_name()).update_one(upsert=True, **update)
+    _corpus_version = (version, time.monotonic())
+
+
+def get_corpus_version() -> Optional[str]:
+    """Version of the ingested corpus, cached answers from another version are
+    ignored. It's read from the database at most every
+    SLEEPMATE_CORPUS_VERSION_CHECK seconds. None if no ingestion has recorded
+    one, answers aren't cached then."""
+    global _corpus_version
+    version, checked = _corpus_version
+    now = time.monotonic()
+    if now - checked > SLEEPMATE_CORPUS_VERSION_CHECK:
+        db_entry = (
+            DBCorpusVersion.objects(index=get_index_name()).only("version").first()
         )
+        version = db_entry.version if db_entry is not None else None
+        _corpus_version = (version, now)
+    return version
+
+
+def get_context(utterance: str, embedding: List[float] = None) -> str:
+    db = get_db()
+    if embedding is None:
+        docs = db.similarity_search(utterance, k=SLEEPMATE_KNOWLEDGE_TOP_K)
     else:
-        return Pinecone.from_existing_index(PINECONE_INDEX_NAME, embeddings)
-    dir = Path(path)
-    download_files(path)
-    pages = []
-    for file in dir.iterdir():
-        loader_cls = loader_map.get(file.suffix)
-        if loader_cls is None:
-            log.info(f"skipping `{file}'")
-            continue
-        log.info(f"loading `{file}'")
-        # the split part is important, otherwise we get similarity search
-        # results that are too long for the model context window
-        pages.extend(loader_cls(str(file)).load_and_split())
-    assert pages, "no pages loaded"
-    return Pinecone.from_documents(pages, embeddings, index_name=PINECONE_INDEX_NAME)
-
-
-db = load_knowledge(SLEEPMATE_DATADIR)
-
-
-def get_context(utterance: str) -> str:
-    for k in range(8, 0, -1):
-        docs = db.similarity_search(utterance, k=k)
-        context = " ".join([d.page_content for d in docs])
-        if count_tokens(context) < (
-            SLEEPMATE_MAX_TOKENS - 100
-        ):  # leave some room for the prompt TODO
-            return context
-    assert False, "similarity search failed"
+        # langchain's Pinecone only implements the with_score variant
+        docs = [
+            doc
+            for doc, _ in db.similarity_search_by_vector_with_score(
+                embedding, k=SLEEPMATE_KNOWLEDGE_TOP_K
+            )
+        ]
+    # leave some room for the prompt TODO
+    packed = pack_context(docs, SLEEPMATE_MAX_TOKENS - 100)
+    assert packed or not docs, "similarity search failed"
+    return " ".join([d.page_content for d in packed])
 
 
 @set_attribute("return_direct", False)
@@ -186,7 +389,13 @@ def get_knowledge_answer(x: BaseAgent, utterance: str):
     Use this more than the other tools. If the question is about sleep, and the
     answer is "Sorry I'm not sure." then try and answer the question another
     way."""
-    context = get_context(utterance)
+    embedding = get_db().embeddings.embed_query(utterance)
+    version = get_corpus_version()
+    answer = ANSWER_CACHE.get(embedding, version) if version else None
+    if answer is not None:
+        log.info(f"get_knowledge_answer cache hit {ANSWER_CACHE.stats()=}")
+        return answer
+    context = get_context(utterance, embedding)
     prompt = ChatPromptTemplate(
         messages=[
             SystemMessagePromptTemplate.from_template(
@@ -216,7 +425,10 @@ def get_knowledge_answer(x: BaseAgent, utterance: str):
             HumanMessagePromptTemplate.from_template("{input}"),
         ]
     )
-    return get_completion(x.ro_memory, utterance, prompt)
+    answer = get_completion(x.ro_memory, utterance, prompt)
+    if version:
+        ANSWER_CACHE.put(embedding, version, answer)
+    return answer
 
 
 TOOLS = [get_knowledge_answer, get_daily_routine_seen, save_daily_routine_seen]
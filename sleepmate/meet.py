@@ -1,7 +1,7 @@
 import logging
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, invalidate_goal_state
 from .helpful_scripts import get_confirmation_str, set_attribute
 from .structured import get_parsed_output
 from .user import User, get_user_from_id
@@ -20,6 +20,7 @@ def edit_user_(db_user_id: str, key: str, utterance: str):
     setattr(db_user, key, utterance)
     log.info(f"edit_user {db_user.to_mongo().to_dict()=}")
     db_user.save()
+    invalidate_goal_state(db_user_id)
 
 
 @set_attribute("return_direct", False)
@@ -49,12 +50,14 @@ def save_user(x: BaseAgent, utterance: str):
         if db_user.email is None:
             db_user.email = entry.email
         db_user.save()
+        invalidate_goal_state(x.db_user_id)
 
 
 def meet(db_user_id: str) -> bool:
-    if goal_refused(db_user_id, "meet", days=7):
+    state = get_goal_state(db_user_id)
+    if state.refused("meet", days=7):
         return False
-    db_user = get_user_from_id(db_user_id)
+    db_user = state.memoize("user", lambda: get_user_from_id(db_user_id))
     return db_user.name is None or db_user.email is None
 
 
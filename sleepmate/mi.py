@@ -5,7 +5,8 @@ from langchain.memory import ConversationBufferMemory, ReadOnlySharedMemory
 from langchain.prompts import ChatPromptTemplate
 
 from .agent import BaseAgent
-from .models import MODELS
+from .cache import no_cache
+from .models import get_model
 from .prompt import get_template
 
 log = logging.getLogger(__name__)
@@ -17,7 +18,7 @@ def get_completion(
     template: ChatPromptTemplate,
     model_name: str = "gpt",
 ) -> str:
-    chain = LLMChain(llm=MODELS[model_name], prompt=template, memory=memory)
+    chain = LLMChain(llm=get_model(model_name), prompt=template, memory=memory)
     return chain.run(utterance)
 
 
@@ -41,15 +42,17 @@ def get_greeting(x: BaseAgent, utterance: str) -> str:
 def get_greeting_no_memory(x: BaseAgent, utterance: str) -> str:
     """Reach out and great the human by name after a short break. Be brief.
     Fewer words are better."""
-    return get_completion(
-        ReadOnlySharedMemory(
-            memory=ConversationBufferMemory(
-                memory_key="chat_history", return_messages=True
-            )
-        ),
-        utterance,
-        get_template(x, get_greeting_no_memory.__doc__),
-    )
+    # a cached greeting would be the same one every time
+    with no_cache():
+        return get_completion(
+            ReadOnlySharedMemory(
+                memory=ConversationBufferMemory(
+                    memory_key="chat_history", return_messages=True
+                )
+            ),
+            utterance,
+            get_template(x, get_greeting_no_memory.__doc__),
+        )
 
 
 def get_affirmation(x: BaseAgent, utterance: str) -> str:
@@ -0,0 +1,67 @@
+"""One-off data migrations, run by hand:
+
+    python -m sleepmate.migrate           # count what would change
+    python -m sleepmate.migrate --apply   # change it
+"""
+import argparse
+import logging
+from typing import Dict, List
+
+from mongoengine import Document
+
+from .structured import DOCUMENTS
+
+log = logging.getLogger(__name__)
+
+
+def remove_duplicates(
+    document: Document, fields: List[str], dry_run: bool = True
+) -> int:
+    """Delete all but the newest of the documents that share fields, so that a
+    unique index on them can be built. Returns the number of duplicates, which
+    are only deleted without dry_run."""
+    pipeline = [
+        {
+            "$group": {
+                "_id": {field: f"${field}" for field in fields},
+                "ids": {"$push": "$_id"},
+                "n": {"$sum": 1},
+            }
+        },
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    collection = document._get_collection()
+    ids = [
+        id
+        for group in collection.aggregate(pipeline, allowDiskUse=True)
+        for id in sorted(group["ids"])[:-1]
+    ]
+    if ids:
+        log.warning(f"remove_duplicates {document.__name__} {fields=} {len(ids)=}")
+        if not dry_run:
+            collection.delete_many({"_id": {"$in": ids}})
+    return len(ids)
+
+
+def remove_unique_index_duplicates(dry_run: bool = True) -> Dict[str, int]:
+    """Duplicates of every unique index on the generated documents, by
+    document name."""
+    from .registry import get_registry
+
+    get_registry()  # imports all the goal modules
+    removed = {}
+    for document in DOCUMENTS:
+        for index in document._meta["indexes"]:
+            if isinstance(index, dict) and index.get("unique"):
+                n = remove_duplicates(document, index["fields"], dry_run=dry_run)
+                removed[document.__name__] = removed.get(document.__name__, 0) + n
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--apply", action="store_true", help="delete duplicates")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for name, n in remove_unique_index_duplicates(dry_run=not args.apply).items():
+        print(f"{name}: {n} {'deleted' if args.apply else 'duplicates'}")
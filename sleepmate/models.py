@@ -1,11 +1,86 @@
+import logging
+import threading
+from collections.abc import Mapping
+from typing import Callable, Dict
+
 from langchain.chat_models import ChatAnthropic, ChatOpenAI
+from langchain.schema.language_model import BaseLanguageModel
+
+from .config import (
+    SLEEPMATE_AGENT_MODEL_NAME,
+    SLEEPMATE_DEFAULT_MODEL_NAME,
+    SLEEPMATE_PARSER_MODEL_NAME,
+    SLEEPMATE_SAMPLING_TEMPERATURE,
+)
 
-from .config import SLEEPMATE_DEFAULT_MODEL_NAME, SLEEPMATE_SAMPLING_TEMPERATURE
+log = logging.getLogger(__name__)
 
-MODELS = {
-    "claude": ChatAnthropic(temperature=SLEEPMATE_SAMPLING_TEMPERATURE),
-    "gpt": ChatOpenAI(
+# name -> factory, clients are built on first use and shared between threads,
+# so per-conversation callbacks are passed when the model is run
+MODEL_FACTORIES: Dict[str, Callable[[], BaseLanguageModel]] = {
+    "agent": lambda: ChatOpenAI(
+        model_name=SLEEPMATE_AGENT_MODEL_NAME, temperature=0, streaming=True
+    ),
+    "claude": lambda: ChatAnthropic(temperature=SLEEPMATE_SAMPLING_TEMPERATURE),
+    "gpt": lambda: ChatOpenAI(
         model_name=SLEEPMATE_DEFAULT_MODEL_NAME,
         temperature=SLEEPMATE_SAMPLING_TEMPERATURE,
     ),
+    "parser": lambda: ChatOpenAI(
+        model_name=SLEEPMATE_PARSER_MODEL_NAME, temperature=0.0
+    ),
 }
+
+_lock = threading.Lock()
+_models: Dict[str, BaseLanguageModel] = {}
+
+
+def register_model(
+    name: str, factory: Callable[[], BaseLanguageModel], replace: bool = False
+) -> None:
+    """Add a named model. The factory isn't called until the model is first
+    used."""
+    with _lock:
+        if name in MODEL_FACTORIES and not replace:
+            raise ValueError(f"model {name} is already registered")
+        MODEL_FACTORIES[name] = factory
+        _models.pop(name, None)
+
+
+def is_sampled(model: BaseLanguageModel) -> bool:
+    """True unless the model runs at temperature 0, None is the provider's
+    default, which isn't."""
+    temperature = getattr(model, "temperature", 0)
+    return temperature is None or temperature > 0
+
+
+def get_model(name: str) -> BaseLanguageModel:
+    """Returns the shared client for the named model, building it on first
+    use."""
+    model = _models.get(name)
+    if model is None:
+        with _lock:
+            model = _models.get(name)
+            if model is None:
+                log.debug(f"get_model building {name=}")
+                model = _models[name] = MODEL_FACTORIES[name]()
+                if is_sampled(model) and model.cache is None:
+                    # a cached completion would be served as the only answer
+                    model.cache = False
+    return model
+
+
+class LazyModels(Mapping):
+    """Read-only dict view of the registry, kept so MODELS[name] still works."""
+
+    def __getitem__(self, name: str) -> BaseLanguageModel:
+        return get_model(name)
+
+    def __iter__(self):
+        return iter(list(MODEL_FACTORIES))
+
+    def __len__(self) -> int:
+        return len(MODEL_FACTORIES)
+
+
+MODELS = LazyModels()
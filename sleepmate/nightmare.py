@@ -6,14 +6,13 @@ from mongoengine import ReferenceField
 
 from .agent import BaseAgent
 from .diary import DBSleepDiaryEntry
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import mongo_to_json, set_attribute
-from .sleep50 import get_last_sleep50_entry_from_db, sum_category
+from .sleep50 import DBSleep50Entry, sum_category
 from .structured import pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
-from .goal import goal_refused
 from .structured import SummaryResult, get_document_summary
 
 
@@ -39,7 +38,7 @@ DBNightmareSummary = pydantic_to_mongoengine(
 
 def save_nightmare_seen_to_db(user: str, entry: NightmareSeen) -> DBNightmareSeen:
     # save the new entry
-    return DBNightmareSeen(**{"user": user, **entry}).save()
+    return record_progress(user, DBNightmareSeen(**{"user": user, **entry}).save())
 
 
 @set_attribute("return_direct", False)
@@ -63,13 +62,16 @@ def save_nightmare_seen(x: BaseAgent, utterance: str):
 def nightmare(db_user_id: str):
     """Returns True if nightmare recommendations should happen."""
     # check the frightening dreams questions
-    db_entry = get_last_sleep50_entry_from_db(db_user_id)
+    state = get_goal_state(db_user_id)
+    db_entry = state.last(DBSleep50Entry)
+    if db_entry is None:
+        return False
     (n, total) = sum_category(db_entry, "nightmares")
     if n == total:
         return False  # no problem here
-    if goal_refused(db_user_id, "nightmare"):
+    if state.refused("nightmare"):
         return False
-    return DBNightmareSeen.objects(user=db_user_id).count() == 0
+    return not state.has(DBNightmareSeen)
 
 
 def get_nightmare_summary_(db_user_id: str) -> DBNightmareSummary:
@@ -88,12 +90,13 @@ def get_nightmare_summary_(db_user_id: str) -> DBNightmareSummary:
 def nightmare_daily(db_user_id: str):
     """Returns True if nightmare recommendations should happen."""
     # check for nightmares in the last sleep diary entry
-    if goal_refused(db_user_id, "nightmare_daily"):
+    state = get_goal_state(db_user_id)
+    if state.refused("nightmare_daily"):
         return False
 
     end = datetime.combine(date.today(), time())
     start = end - timedelta(days=1)
-    if DBNightmareSeen.objects(user=db_user_id, date__gte=start).count() > 0:
+    if state.has(DBNightmareSeen, since=start):
         return False
 
     db_entry = get_nightmare_summary_(db_user_id)
@@ -102,6 +105,8 @@ def nightmare_daily(db_user_id: str):
     return db_entry.found
 
 
+GOAL_DOCUMENTS = [DBNightmareSeen]
+
 GOAL_HANDLERS = [
     {
         "nightmare": nightmare,
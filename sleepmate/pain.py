@@ -5,13 +5,12 @@ from langchain.pydantic_v1 import BaseModel, Field
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state
 from .helpful_scripts import mongo_to_json, set_attribute
 from .structured import pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
-from .goal import goal_refused
 from .history import DBHealthHistory
 from .structured import SummaryResult, get_document_summary
 
@@ -83,7 +82,7 @@ def get_back_pain_summary_(db_user_id: str) -> DBBackPainSummary:
 
 def back_pain(db_user_id: str):
     """Returns True if back pain recommendations should happen."""
-    if goal_refused(db_user_id, "back_pain"):
+    if get_goal_state(db_user_id).refused("back_pain"):
         return False
     db_entry = get_back_pain_summary_(db_user_id)
     if db_entry is None:
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable
+
+from .config import SLEEPMATE_POOL_IDLE_SECONDS, SLEEPMATE_POOL_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class XPool(object):
+    """A bounded LRU pool of live agents keyed by db_user_id. Building an agent
+    re-runs the goal handler chain and sets up the model clients and tools, so
+    returning users get the one they had last time. Entries that haven't been
+    used for idle_seconds are dropped on the next access."""
+
+    def __init__(
+        self,
+        factory: Callable[..., object],
+        size: int = SLEEPMATE_POOL_SIZE,
+        idle_seconds: int = SLEEPMATE_POOL_IDLE_SECONDS,
+    ) -> None:
+        self.factory = factory
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, db_user_id) -> bool:
+        return str(db_user_id) in self.entries
+
+    def evict_idle(self, now: float = None) -> None:
+        """Drop every entry that has been idle for longer than idle_seconds."""
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            for key in [
+                key
+                for key, (_, last_used) in self.entries.items()
+                if now - last_used > self.idle_seconds
+            ]:
+                log.debug(f"evict_idle {key=}")
+                del self.entries[key]
+
+    def get(self, db_user_id, **kwargs) -> object:
+        """Returns the live agent for db_user_id, building one with
+        factory(**kwargs) if there isn't one."""
+        key = str(db_user_id)
+        now = time.monotonic()
+        self.evict_idle(now)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (entry[0], now)
+                self.entries.move_to_end(key)
+                return entry[0]
+        # build outside the lock, it's slow
+        x = self.factory(**kwargs)
+        with self.lock:
+            # another thread may have beaten us to it
+            entry = self.entries.get(key)
+            if entry is not None:
+                x = entry[0]
+            self.entries[key] = (x, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                log.debug(f"get evicted {evicted=}")
+        return x
+
+    def invalidate(self, db_user_id) -> None:
+        """Drop the agent for db_user_id, e.g. when their goal state has changed
+        outside of the agent."""
+        with self.lock:
+            self.entries.pop(str(db_user_id), None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class TurnGate(object):
+    """Runs one turn at a time per user, so two quick messages can't interleave
+    their chat history writes, while different users run in parallel. Sync and
+    async turns share one lock per user, they run on the same pooled agent.
+    Across processes the Redis lock in turns.py does the same job."""
+
+    def __init__(self) -> None:
+        self.locks = {}
+        self.depths = Counter()
+        self.lock = threading.Lock()
+
+    def enter(self, key: str) -> threading.Lock:
+        with self.lock:
+            self.depths[key] += 1
+            if self.depths[key] > 1:
+                log.info(f"enter waiting {key=} {self.depths[key]=}")
+            return self.locks.setdefault(key, threading.Lock())
+
+    def exit(self, key: str) -> None:
+        with self.lock:
+            self.depths[key] -= 1
+            if not self.depths[key]:
+                del self.depths[key]
+                self.locks.pop(key, None)
+
+    @contextmanager
+    def turn(self, db_user_id):
+        key = str(db_user_id)
+        lock = self.enter(key)
+        try:
+            with lock:
+                yield
+        finally:
+            self.exit(key)
+
+    @asynccontextmanager
+    async def aturn(self, db_user_id):
+        key = str(db_user_id)
+        lock = self.enter(key)
+        try:
+            await acquire(lock)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self.exit(key)
+
+    def depth(self, db_user_id) -> int:
+        """Turns running or waiting for db_user_id."""
+        return self.depths.get(str(db_user_id), 0)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "users": len(self.depths),
+                "turns": sum(self.depths.values()),
+                "max_depth": max(self.depths.values(), default=0),
+            }
+
+
+async def acquire(lock: threading.Lock) -> None:
+    """Acquire lock without blocking the event loop. If the caller is cancelled
+    while waiting, the lock is released as soon as the thread gets it."""
+    if lock.acquire(blocking=False):
+        return
+    acquired = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        acquired.add_done_callback(lambda _: lock.release())
+        raise
@@ -1,7 +1,8 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from functools import partial
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Union
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.prompts import (
@@ -72,10 +73,21 @@ class CustomTool(Tool):
         return tuple(all_args), {}
 
 
+def to_thread(func: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+    """Async version of func that runs it in a worker thread, the tools talk to
+    the database and the LLMs synchronously."""
+
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    return wrapper
+
+
 def get_tools(x: object) -> list[Tool]:
     return [
         CustomTool.from_function(
             func=partial(f, x),
+            coroutine=to_thread(partial(f, x)),
             name=f.__name__,
             description=f.__doc__,
             return_direct=getattr(f, "return_direct", True),
@@ -0,0 +1,53 @@
+import importlib
+import logging
+import threading
+from pathlib import Path
+from types import MappingProxyType
+
+from .helpful_scripts import flatten_list_of_dicts, import_attrs
+
+log = logging.getLogger(__name__)
+
+# lists are concatenated, lists of dicts are merged
+LIST_ATTRS = ["TOOLS", "GOAL_DOCUMENTS"]
+DICT_ATTRS = ["GOALS", "GOAL_HANDLERS", "GOAL_OPTIONS"]
+REGISTRY_ATTRS = LIST_ATTRS + DICT_ATTRS
+
+_lock = threading.Lock()
+_registry = None
+
+
+def build_registry() -> MappingProxyType:
+    """Scan the goal modules once and return a read-only view of the tools, the
+    goal tables and the documents the goal handlers look at."""
+    imported = import_attrs(REGISTRY_ATTRS)
+    registry = {attr: tuple(imported[attr]) for attr in LIST_ATTRS}
+    for attr in DICT_ATTRS:
+        registry[attr] = MappingProxyType(flatten_list_of_dicts(imported[attr]))
+    log.debug(f"build_registry {len(registry['TOOLS'])=}")
+    return MappingProxyType(registry)
+
+
+def get_registry() -> MappingProxyType:
+    """Returns the process-wide registry, building it on first use."""
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = build_registry()
+    return _registry
+
+
+def reload_registry(reload_modules: bool = True) -> MappingProxyType:
+    """Development hook, re-imports the goal modules so edits are picked up and
+    rebuilds the registry. Agents built before the reload keep the old one."""
+    global _registry
+    with _lock:
+        if reload_modules:
+            dir = Path(__file__).parent
+            for p in dir.glob("*.py"):
+                module = importlib.import_module(f"{dir.name}.{p.stem}")
+                if any(hasattr(module, attr) for attr in REGISTRY_ATTRS):
+                    importlib.reload(module)
+        _registry = build_registry()
+    return _registry
@@ -0,0 +1,326 @@
+import re
+from typing import Callable, Dict, List, Optional
+
+# Rules fill questionnaire fields from the human's answers without calling a
+# model. A rule takes the answer and returns the value, or None if it can't
+# parse it, in which case the model takes over. Goals list their rules in
+# GOAL_OPTIONS alongside "capture", see capture.py.
+
+Rule = Callable[[str], Optional[object]]
+
+NUMBER_WORDS = {
+    "zero": 0,
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6,
+    "seven": 7,
+    "eight": 8,
+    "nine": 9,
+    "ten": 10,
+    "eleven": 11,
+    "twelve": 12,
+}
+YES = {"yes", "y", "yeah", "yep", "yup", "i do", "definitely", "true"}
+NO = {"no", "n", "nope", "never", "i don't", "i do not", "not really", "false"}
+FILLER = re.compile(
+    r"^(?:i'?d say|i think|about|around|roughly|approximately|maybe|probably|"
+    r"usually|like|um+|uh+|er+)[\s,]+"
+)
+NUMBER = r"\d+(?:\.\d+)?|" + "|".join(NUMBER_WORDS)
+
+# left out when matching a question to a field description
+STOPWORDS = {
+    "a",
+    "am",
+    "an",
+    "are",
+    "at",
+    "did",
+    "do",
+    "does",
+    "for",
+    "how",
+    "i",
+    "in",
+    "is",
+    "it",
+    "me",
+    "my",
+    "of",
+    "often",
+    "that",
+    "the",
+    "to",
+    "was",
+    "were",
+    "what",
+    "when",
+    "you",
+    "your",
+}
+
+KG_PER_LB = 0.45359237
+CM_PER_INCH = 2.54
+
+
+def normalise(text: str) -> str:
+    text = text.strip().lower().rstrip(".!")
+    while True:
+        stripped = FILLER.sub("", text)
+        if stripped == text:
+            return text
+        text = stripped
+
+
+def get_number(text: str) -> Optional[float]:
+    text = text.strip()
+    if text in NUMBER_WORDS:
+        return NUMBER_WORDS[text]
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_score(low: int, high: int) -> Rule:
+    """Rule for a score on a scale from low to high, optionally followed by
+    its label, e.g. "3", "three" or "3 - rather much"."""
+
+    def rule(text: str) -> Optional[int]:
+        match = re.fullmatch(rf"({NUMBER})\s*(?:[-:(].*)?", normalise(text))
+        if match is None:
+            return None
+        value = get_number(match.group(1))
+        if value is None or value != int(value) or not low <= value <= high:
+            return None
+        return int(value)
+
+    return rule
+
+
+def parse_count(text: str) -> Optional[int]:
+    """A number of times, e.g. "2", "twice" or "none"."""
+    text = normalise(text)
+    words = {"none": 0, "never": 0, "once": 1, "twice": 2}
+    if text in words:
+        return words[text]
+    match = re.fullmatch(rf"({NUMBER})(?:\s*times?)?", text)
+    value = get_number(match.group(1)) if match else None
+    if value is None or value != int(value):
+        return None
+    return int(value)
+
+
+def parse_yes_no(text: str) -> Optional[bool]:
+    text = normalise(text).rstrip(",")
+    if text in YES:
+        return True
+    if text in NO:
+        return False
+    return None
+
+
+def parse_time(night: bool = False) -> Rule:
+    """Rule for a clock time, e.g. "9:15", "9.15pm" or "10 pm", as HH:MM. The
+    date is filled in when the entry is saved. Without am or pm, 6 to 12
+    o'clock is taken as the evening for night, e.g. going to bed, and as the
+    morning otherwise."""
+
+    def rule(text: str) -> Optional[str]:
+        text = normalise(text)
+        if text in ("midnight", "noon"):
+            return "00:00" if text == "midnight" else "12:00"
+        match = re.fullmatch(
+            r"(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm|a\.m|p\.m|o'?clock)?", text
+        )
+        if match is None:
+            return None
+        hour, minute, suffix = match.groups()
+        if minute is None and suffix is None:
+            return None  # a bare number could be anything
+        hour, minute = int(hour), int(minute or 0)
+        if suffix in ("am", "a.m", "pm", "p.m"):
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if suffix.startswith("p") else 0)
+        elif night and 6 <= hour <= 12:
+            hour = (hour + 12) % 24
+        if hour > 23 or minute > 59:
+            return None
+        return f"{hour:02d}:{minute:02d}"
+
+    return rule
+
+
+def parse_duration(text: str) -> Optional[int]:
+    """A duration in minutes, e.g. "20", "20 mins", "1.5 hours" or "1h30". A
+    bare number is taken as minutes if it's whole, "1.5" is probably hours."""
+    text = normalise(text)
+    words = {"none": 0, "half an hour": 30, "a quarter of an hour": 15}
+    if text in words:
+        return words[text]
+    match = re.fullmatch(
+        rf"(?:({NUMBER}|an?)\s*(?:h|hrs?|hours?))?\s*(?:and\s*)?"
+        rf"(?:({NUMBER})\s*(m|mins?|minutes?)?)?",
+        text,
+    )
+    if match is None or not any(match.groups()):
+        return None
+    hours, minutes, unit = match.groups()
+    hours = 1 if hours in ("a", "an") else get_number(hours or "0")
+    minutes = get_number(minutes or "0")
+    if hours is None or minutes is None:
+        return None
+    if match.group(1) is None and unit is None and minutes != int(minutes):
+        return None
+    return round(hours * 60 + minutes)
+
+
+def parse_height(text: str) -> Optional[float]:
+    """A height in metres, from e.g. "5'10", "5 ft 10 in", "178 cm" or "1.78m".
+    Bare numbers are taken as metres or centimetres if they look like one."""
+    text = normalise(text)
+    match = re.fullmatch(
+        r"(\d)\s*(?:'|ft|feet|foot)\s*"
+        r"(?:(\d{1,2}(?:\.\d+)?)\s*(?:\"|''|in|inch|inches)?)?",
+        text,
+    )
+    if match is not None:
+        inches = int(match.group(1)) * 12 + float(match.group(2) or 0)
+        return round(inches * CM_PER_INCH / 100, 2)
+    match = re.fullmatch(
+        r"(\d+(?:\.\d+)?)\s*(m|metres?|meters?|cm|\"|in|inches)?", text
+    )
+    if match is None:
+        return None
+    value, unit = float(match.group(1)), match.group(2)
+    if unit in ("\"", "in", "inches"):
+        value = value * CM_PER_INCH / 100
+    elif unit == "cm" or (unit is None and 120 <= value <= 230):
+        value = value / 100
+    elif unit is None and not 1.2 <= value <= 2.3:
+        return None
+    return round(value, 2)
+
+
+def parse_weight(text: str) -> Optional[float]:
+    """A weight in kilograms, from e.g. "82 kg", "180 lbs" or "12 st 6". Bare
+    numbers could be either, so they're left to the model."""
+    text = normalise(text)
+    match = re.fullmatch(
+        r"(\d+(?:\.\d+)?)\s*(?:st|stone)\s*"
+        r"(?:(\d+(?:\.\d+)?)\s*(?:lbs?|pounds?)?)?",
+        text,
+    )
+    if match is not None:
+        pounds = float(match.group(1)) * 14 + float(match.group(2) or 0)
+        return round(pounds * KG_PER_LB, 1)
+    match = re.fullmatch(
+        r"(\d+(?:\.\d+)?)\s*(kgs?|kilos?|kilograms?|lbs?|pounds?)", text
+    )
+    if match is None:
+        return None
+    value, unit = float(match.group(1)), match.group(2)
+    if unit.startswith(("lb", "pound")):
+        value = value * KG_PER_LB
+    return round(value, 1)
+
+
+def parse_length(text: str) -> Optional[float]:
+    """A length in centimetres, from e.g. "41 cm" or "16 inches"."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*(cm|\"|in|inches)", normalise(text))
+    if match is None:
+        return None
+    value, unit = float(match.group(1)), match.group(2)
+    return round(value if unit == "cm" else value * CM_PER_INCH, 1)
+
+
+# these are told apart by their units, so they can fill fields the question
+# doesn't name, as long as the answer has a unit
+UNIT_RULES = (parse_height, parse_weight, parse_length)
+
+
+def get_words(text: str) -> List[str]:
+    return [
+        word[:-1] if len(word) > 3 and word.endswith("s") else word
+        for word in re.findall(r"[a-z]+", text.lower())
+        if word not in STOPWORDS
+    ]
+
+
+def is_subsequence(words: List[str], sentence: List[str]) -> bool:
+    it = iter(sentence)
+    return all(word in it for word in words)
+
+
+def get_asked_fields(descriptions: Dict[str, str], question: str) -> List[str]:
+    """The fields question asks about, in order. A field is asked about when the
+    words of its description appear in order in a sentence of the question."""
+    descriptions = {
+        field: get_words(description) for field, description in descriptions.items()
+    }
+    asked = []
+    for sentence in re.split(r"[.?!\n]+", question):
+        words = get_words(sentence)
+        matches = {
+            field: description
+            for field, description in descriptions.items()
+            if description and is_subsequence(description, words)
+        }
+        # e.g. "wake up during the night" in "wake up during the night while
+        # coughing", the longer one is the one being asked
+        for field, description in matches.items():
+            if field not in asked and not any(
+                len(other) > len(description) and is_subsequence(description, other)
+                for other in matches.values()
+            ):
+                asked.append(field)
+    return asked
+
+
+def get_parts(text: str) -> List[str]:
+    return [p for p in re.split(r"\s*(?:[,;\n]|\band\b)\s*", text.strip()) if p]
+
+
+def split_answer(text: str, n: int) -> Optional[List[str]]:
+    """Split an answer to n questions into n parts, or None if it doesn't
+    split that way."""
+    if n == 1:
+        return [text]
+    parts = get_parts(text)
+    if len(parts) == 1:
+        parts = text.split()
+    return parts if len(parts) == n else None
+
+
+def apply_rules(
+    rules: Dict[str, Rule], descriptions: Dict[str, str], question: str, answer: str
+) -> dict:
+    """Fill the fields question asks about from answer. Returns {} unless
+    every one of them can be parsed, there's no guessing here."""
+    fields = get_asked_fields({f: descriptions[f] for f in rules}, question)
+    if fields:
+        parts = split_answer(answer, len(fields))
+        if parts is None:
+            return {}
+        values = {field: rules[field](part) for field, part in zip(fields, parts)}
+        return values if None not in values.values() else {}
+    # otherwise answers with units, e.g. "5'10 and 180 lbs", say what they are.
+    # Bare numbers don't, once fillers like "about" are stripped
+    values = {}
+    for part in get_parts(answer):
+        if not re.search(r"[a-z'\"]", normalise(part)):
+            return {}
+        found = {
+            field: rule(part)
+            for field, rule in rules.items()
+            if rule in UNIT_RULES and field not in values
+        }
+        found = {field: value for field, value in found.items() if value is not None}
+        if len(found) != 1:
+            return {}
+        values.update(found)
+    return values
@@ -5,7 +5,7 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_confirmation_str,
     get_date_fields,
@@ -60,7 +60,7 @@ def get_seed_pod_from_memory(x: BaseAgent) -> SeedPod:
 
 
 def save_seed_pod_to_db(user: str, entry: SeedPod) -> DBSeedPod:
-    return DBSeedPod(**{"user": user, **entry.dict()}).save()
+    return record_progress(user, DBSeedPod(**{"user": user, **entry.dict()}).save())
 
 
 def get_json_seed_pod(entry: dict) -> str:
@@ -211,28 +211,25 @@ def get_seeds_diary_entry_score(x: BaseAgent, utterance: str):
 
 
 def seeds_entry(db_user_id: str) -> bool:
-    if goal_refused(db_user_id, "seeds_probe", days=None) or goal_refused(
-        db_user_id, "seeds_entry"
-    ):
+    state = get_goal_state(db_user_id)
+    if state.refused("seeds_probe", days=None) or state.refused("seeds_entry"):
         return False
 
     end = datetime.combine(date.today(), time())
     start = end - timedelta(days=1)
 
     return (
-        DBSeedsDiaryEntry.objects(
-            pod=get_current_seed_pod(db_user_id), date__gte=start
-        ).count()
+        DBSeedsDiaryEntry.objects(pod=state.last(DBSeedPod), date__gte=start).count()
         == 0
     )
 
 
 def seeds_probe(db_user_id: str) -> bool:
-    return (
-        not goal_refused(db_user_id, "seeds_probe", days=7)
-        and DBSeedPod.objects(user=db_user_id).count() == 0
-    )
+    state = get_goal_state(db_user_id)
+    return not state.refused("seeds_probe", days=7) and not state.has(DBSeedPod)
+
 
+GOAL_DOCUMENTS = [DBSeedPod]
 
 GOAL_HANDLERS = [
     {
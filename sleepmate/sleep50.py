@@ -5,7 +5,8 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     json_dumps,
@@ -13,7 +14,8 @@ from .helpful_scripts import (
     parse_date,
     set_attribute,
 )
-from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
+from .rules import parse_score
+from .structured import fix_schema, pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
@@ -131,9 +133,9 @@ def sum_category(db_entry: DBSleep50Entry, category: str) -> int:
 
 
 def get_sleep50_entry_from_memory(x: BaseAgent) -> Sleep50Entry:
-    return get_parsed_output(
+    return get_captured_output(
+        x,
         "summarise the last sleep history entry",
-        x.get_latest_messages,
         Sleep50Entry,
     )
 
@@ -143,7 +145,7 @@ def save_sleep50_entry_to_db(user: str, entry: Sleep50Entry) -> DBSleep50Entry:
     entry = entry.dict()
     DBSleep50Entry.objects(user=user, date=entry["date"]).delete()
     # save the new entry
-    return DBSleep50Entry(**{"user": user, **entry}).save()
+    return record_progress(user, DBSleep50Entry(**{"user": user, **entry}).save())
 
 
 def get_json_sleep50_entry(entry: dict) -> str:
@@ -159,6 +161,7 @@ def save_sleep50_entry(x: BaseAgent, utterance: str):
     if entry is not None:
         log.info(f"save_sleep50_entry {entry=}")
         save_sleep50_entry_to_db(x.db_user_id, entry)
+        commit_draft(x)
 
 
 def get_last_sleep50_entry_from_db(db_user_id: str) -> DBSleep50Entry:
@@ -195,17 +198,30 @@ def get_sleep50_dates(x: BaseAgent, utterance: str):
 
 
 def sleep50(db_user_id: str) -> bool:
-    if goal_refused(db_user_id, "sleep50"):
+    state = get_goal_state(db_user_id)
+    if state.refused("sleep50"):
         return False
-    return DBSleep50Entry.objects(user=db_user_id).count() == 0
+    return not state.has(DBSleep50Entry)
 
 
+GOAL_DOCUMENTS = [DBSleep50Entry]
+
 GOAL_HANDLERS = [
     {
         "sleep50": sleep50,
     },
 ]
 
+# the numbered items are all scored 1 to 4
+SLEEP50_RULES = {
+    field: parse_score(1, 4)
+    for field in Sleep50Entry_.__fields__
+    if field[-1].isdigit()
+}
+
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [{"sleep50": {"capture": Sleep50Entry, "rules": SLEEP50_RULES}}]
+
 GOALS = [
     {
         "sleep50": """
@@ -5,7 +5,7 @@ from langchain.pydantic_v1 import BaseModel, Field
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import mongo_to_json, set_attribute
 from .structured import pydantic_to_mongoengine
 from .user import DBUser
@@ -28,7 +28,9 @@ def save_stimulus_control_seen_to_db(
     # delete any existing entries for this date
     DBStimulusControlSeen.objects(user=user).delete()
     # save the new entry
-    return DBStimulusControlSeen(**{"user": user, **entry}).save()
+    return record_progress(
+        user, DBStimulusControlSeen(**{"user": user, **entry}).save()
+    )
 
 
 @set_attribute("return_direct", False)
@@ -51,12 +53,14 @@ def save_stimulus_control_seen(x: BaseAgent, utterance: str):
 
 
 def stimulus_control(db_user_id: str) -> bool:
-    return (
-        not goal_refused(db_user_id, "stimulus_control")
-        and DBStimulusControlSeen.objects(user=db_user_id).count() == 0
+    state = get_goal_state(db_user_id)
+    return not state.refused("stimulus_control") and not state.has(
+        DBStimulusControlSeen
     )
 
 
+GOAL_DOCUMENTS = [DBStimulusControlSeen]
+
 GOAL_HANDLERS = [
     {
         "stimulus_control": stimulus_control,
@@ -6,7 +6,8 @@ from mongoengine import ReferenceField
 
 from .agent import BaseAgent
 from .bmi import calculate_bmi
-from .goal import goal_refused
+from .capture import commit_draft, get_captured_output
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import (
     get_date_fields,
     get_start_end,
@@ -14,8 +15,9 @@ from .helpful_scripts import (
     set_attribute,
 )
 from .history import calculate_age_in_years, get_is_hypertensive, get_is_male
-from .sleep50 import get_last_sleep50_entry_from_db, sum_category
-from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
+from .rules import parse_length, parse_yes_no
+from .sleep50 import DBSleep50Entry, sum_category
+from .structured import fix_schema, pydantic_to_mongoengine
 from .user import DBUser
 
 log = logging.getLogger(__name__)
@@ -48,9 +50,9 @@ DBStopBang = pydantic_to_mongoengine(
 
 
 def get_stop_bang_from_memory(x: BaseAgent) -> StopBang:
-    return get_parsed_output(
+    return get_captured_output(
+        x,
         "summarise the answers the human gave for the STOP-Bang Questionnaire",
-        x.get_latest_messages,
         StopBang,
     )
 
@@ -61,7 +63,9 @@ def save_stop_bang_to_db(db_user_id: str, entry: StopBang) -> DBStopBang:
     (start, end) = get_start_end(entry["date"])
     DBStopBang.objects(user=db_user_id, date__gte=start, date__lte=end).delete()
     # save the new entry
-    return DBStopBang(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBStopBang(**{"user": db_user_id, **entry}).save()
+    )
 
 
 def get_json_stop_bang(entry: dict) -> str:
@@ -77,6 +81,7 @@ def save_stop_bang(x: BaseAgent, utterance: str):
     if entry is not None:
         log.info(f"save_stop_bang {entry=}")
         save_stop_bang_to_db(x.db_user_id, entry)
+        commit_draft(x)
 
 
 @set_attribute("return_direct", False)
@@ -93,16 +98,17 @@ def get_last_stop_bang(x: BaseAgent, utterance: str):
 def stop_bang(db_user_id: str):
     """Returns True if StopBang should be collected."""
     # get the results of the SLEEP-50 questionnaire
-    db_entry = get_last_sleep50_entry_from_db(db_user_id)
+    state = get_goal_state(db_user_id)
+    db_entry = state.last(DBSleep50Entry)
     if db_entry is None:
         return False
     # check the apnea questions
     (n, total) = sum_category(db_entry, "sleep_apnea")
     if n == total:
         return False  # no problem here
-    if goal_refused(db_user_id, "stop_bang"):
+    if state.refused("stop_bang"):
         return False
-    return DBStopBang.objects(user=db_user_id).count() == 0
+    return not state.has(DBStopBang)
 
 
 @set_attribute("return_direct", False)
@@ -138,12 +144,24 @@ def calculate_stop_bang(x: BaseAgent, utterance: str):
     return score
 
 
+GOAL_DOCUMENTS = [DBStopBang]
+
 GOAL_HANDLERS = [
     {
         "stop_bang": stop_bang,
     },
 ]
 
+STOP_BANG_RULES = {
+    "snoring": parse_yes_no,
+    "tired": parse_yes_no,
+    "observed": parse_yes_no,
+    "neck": parse_length,
+}
+
+# answers are captured turn by turn, see capture.py
+GOAL_OPTIONS = [{"stop_bang": {"capture": StopBang, "rules": STOP_BANG_RULES}}]
+
 GOALS = [
     {
         "stop_bang": """
@@ -6,7 +6,7 @@ from langchain.pydantic_v1 import BaseModel, Field, validator
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress
 from .helpful_scripts import get_date_fields, mongo_to_json, set_attribute
 from .structured import fix_schema, get_parsed_output, pydantic_to_mongoengine
 from .user import DBUser
@@ -48,7 +48,9 @@ def get_stress_audit_from_memory(x: BaseAgent) -> StressAudit:
 
 
 def save_stress_audit_to_db(user: str, entry: StressAudit) -> DBStressAudit:
-    return DBStressAudit(**{"user": user, **entry.dict()}).save()
+    return record_progress(
+        user, DBStressAudit(**{"user": user, **entry.dict()}).save()
+    )
 
 
 def get_json_stress_audit(entry: dict) -> str:
@@ -81,11 +83,11 @@ def get_stress_audit(x: BaseAgent, utterance: str):
 
 
 def stress_audit(db_user_id: str) -> bool:
-    return (
-        not goal_refused(db_user_id, "stress_audit")
-        and DBStressAudit.objects(user=db_user_id).count() == 0
-    )
+    state = get_goal_state(db_user_id)
+    return not state.refused("stress_audit") and not state.has(DBStressAudit)
+
 
+GOAL_DOCUMENTS = [DBStressAudit]
 
 GOAL_HANDLERS = [
     {
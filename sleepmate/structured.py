@@ -1,18 +1,23 @@
+import json
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from typing import Callable, Dict, List, Tuple
 
 from langchain.chains import LLMChain
-
-# kinda almost works with davinci
-# model_name = "text-davinci-003"
-# from langchain.llms import OpenAI
-from langchain.chat_models import ChatAnthropic, ChatOpenAI
-from langchain.memory import ConversationBufferWindowMemory
+from langchain.chat_models import ChatAnthropic
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import PromptTemplate
-from langchain.pydantic_v1 import BaseModel, Field
-from langchain.schema import BaseMessage, OutputParserException
+from langchain.pydantic_v1 import BaseModel, Field, ValidationError
+from langchain.schema import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    OutputParserException,
+    get_buffer_string,
+)
 from mongoengine import (
     BooleanField,
     DateTimeField,
@@ -20,11 +25,18 @@ from mongoengine import (
     FloatField,
     IntField,
     ListField,
+    ReferenceField,
     StringField,
 )
+from pymongo.errors import OperationFailure
 
-from .config import SLEEPMATE_PARSER_MODEL_NAME
+from .config import (
+    SLEEPMATE_EXTRACTION_REPAIRS,
+    SLEEPMATE_EXTRACTION_SPLIT_OVER,
+    SLEEPMATE_EXTRACTION_WORKERS,
+)
 from .helpful_scripts import json_dumps
+from .models import get_model
 
 log = logging.getLogger(__name__)
 
@@ -114,7 +126,7 @@ def get_document_summary(query: str, document: Document) -> SummaryResult:
         "- `summary` the text summary",
         input_variables=["query", "data"],
     )
-    llm = ChatOpenAI(model_name=SLEEPMATE_PARSER_MODEL_NAME, temperature=0.0)
+    llm = get_model("parser")
     chain = LLMChain(llm=llm, prompt=prompt)
     output = chain(
         {
@@ -129,8 +141,8 @@ def get_document_summary(query: str, document: Document) -> SummaryResult:
 
 
 def fix_schema(cls, date_fields):
-    """Remove the format from date fields to keep the PydanticOutputParser
-    happy."""
+    """Remove the format from date fields so the model can write dates any way
+    it likes, the validators parse them."""
     s = cls.schema()
     for key in date_fields:
         try:
@@ -140,14 +152,179 @@ def fix_schema(cls, date_fields):
     return s
 
 
-def get_memory_from_messages(
-    messages: List[BaseMessage], k: int
-) -> ConversationBufferWindowMemory:
-    memory = ConversationBufferWindowMemory(
-        memory_key="chat_history", k=k, return_messages=False
-    )
-    memory.chat_memory.messages = messages
-    return memory
+def get_function(
+    cls: BaseModel, fields: List[str] = None, partial: bool = False
+) -> dict:
+    """OpenAI function definition for cls, or just the given fields of it. With
+    partial nothing is required."""
+    schema = cls.schema()
+    properties = schema["properties"]
+    required = [] if partial else schema.get("required", [])
+    if fields is not None:
+        properties = {key: properties[key] for key in fields if key in properties}
+        required = [key for key in required if key in properties]
+    parameters = {"type": "object", "properties": properties, "required": required}
+    if "definitions" in schema:
+        parameters["definitions"] = schema["definitions"]
+    return {
+        "name": cls.__name__,
+        "description": f"Record the {cls.__name__} from the conversation",
+        "parameters": parameters,
+    }
+
+
+def get_field_groups(
+    cls: BaseModel, split_over: int = SLEEPMATE_EXTRACTION_SPLIT_OVER
+) -> List[List[str]]:
+    """Split wide schemas into groups of fields by category prefix, e.g.
+    sleep_apnea_1, sleep_apnea_2, ... insomnia_9, ... for SLEEP-50. Fields
+    without a numbered suffix go in a group of their own."""
+    fields = list(cls.__fields__)
+    if len(fields) <= split_over:
+        return [fields]
+    groups = {}
+    for field in fields:
+        match = re.match(r"(.+)_(\d+|[a-z])$", field)
+        groups.setdefault(match.group(1) if match else "", []).append(field)
+    return list(groups.values())
+
+
+def get_slice(
+    messages: List[BaseMessage], start: int, end: int, n: int
+) -> List[BaseMessage]:
+    """The part of a questionnaire conversation about fields start to end of n,
+    assuming they were asked in order, with some slack either side."""
+    m = len(messages)
+    margin = max(4, m // 10)
+    return messages[
+        max(0, start * m // n - margin) : min(m, -(-end * m // n) + margin)
+    ]
+
+
+def get_invalid_fields(cls: BaseModel, e: ValidationError) -> Dict[str, str]:
+    """Field -> error. Errors from root validators aren't against a field, so
+    they go against the fields they mention, or all of them."""
+    invalid = {}
+    for error in e.errors():
+        field = str(error["loc"][0])
+        fields = [field]
+        if field == "__root__":
+            fields = [
+                key for key in cls.__fields__ if re.search(rf"\b{key}\b", error["msg"])
+            ] or list(cls.__fields__)
+        invalid.update({key: error["msg"] for key in fields})
+    return invalid
+
+
+def get_prompt(query: str, history: List[BaseMessage]) -> List[BaseMessage]:
+    chat_history = get_buffer_string(history)
+    return [
+        HumanMessage(
+            content=f"Answer the user query.\n{query}\n"
+            f"Previous conversation:\n{chat_history}"
+        )
+    ]
+
+
+class Extractor(object):
+    """Extracts a cls from the chat history with a function call and validates
+    it. Instead of failing on invalid or missing fields, the model is asked
+    again for just those fields. Wide schemas are extracted in groups of
+    fields, concurrently, each from its own slice of the conversation. Built
+    once per cls, see get_extractor."""
+
+    def __init__(self, cls: BaseModel, repairs: int = SLEEPMATE_EXTRACTION_REPAIRS):
+        self.cls = cls
+        self.repairs = repairs
+        # if we're going to extract all the fields from the chat history, we
+        # need to make sure the history is at least twice as long in order to
+        # extract them all
+        self.k = (len(cls.__fields__) * 2) + 5
+        self.function = get_function(cls)
+        self.groups = get_field_groups(cls)
+        self.group_functions = [get_function(cls, group) for group in self.groups]
+        self.partial_function = get_function(cls, partial=True)
+
+    def call(self, messages: List[BaseMessage], function: dict) -> dict:
+        message = get_model("parser").predict_messages(
+            messages, functions=[function], function_call={"name": function["name"]}
+        )
+        try:
+            return json.loads(message.additional_kwargs["function_call"]["arguments"])
+        except (KeyError, ValueError) as e:
+            log.error(f"call {self.cls.__name__} {e=}")
+            return {}
+
+    def repair(
+        self, messages: List[BaseMessage], values: dict, invalid: Dict[str, str]
+    ) -> dict:
+        """Ask again for only the invalid fields."""
+        log.info(f"repair {self.cls.__name__} {invalid=}")
+        messages = messages + [
+            AIMessage(content=json_dumps(values)),
+            HumanMessage(
+                content="These fields are missing or invalid: "
+                f"{json_dumps(invalid)}. Fill in just these fields from the "
+                "previous conversation."
+            ),
+        ]
+        return self.call(messages, get_function(self.cls, list(invalid)))
+
+    def call_groups(self, query: str, history: List[BaseMessage]) -> dict:
+        n = sum(len(group) for group in self.groups)
+        jobs, start = [], 0
+        for group, function in zip(self.groups, self.group_functions):
+            end = start + len(group)
+            messages = get_prompt(query, get_slice(history, start, end, n))
+            jobs.append((messages, function))
+            start = end
+        with ThreadPoolExecutor(max_workers=SLEEPMATE_EXTRACTION_WORKERS) as executor:
+            parts = executor.map(lambda job: self.call(*job), jobs)
+            return {key: value for part in parts for key, value in part.items()}
+
+    def validate(self, values: dict) -> Tuple[BaseModel, Dict[str, str]]:
+        try:
+            return self.cls(**values), {}
+        except ValidationError as e:
+            return None, get_invalid_fields(self.cls, e)
+
+    def __call__(
+        self,
+        query: str,
+        get_messages_func: Callable[[int], List[BaseMessage]],
+        k: int = None,
+        values: dict = None,
+    ) -> BaseModel:
+        """With values, e.g. answers captured as the conversation went along,
+        the chat history is only read to repair the fields that are invalid or
+        missing."""
+        if k is None:
+            k = self.k
+        if values is not None:
+            obj, invalid = self.validate(values)
+            if obj is not None:
+                return obj
+        history = get_messages_func(k=k)
+        messages = get_prompt(query, history)
+        if values is None:
+            if len(self.groups) == 1:
+                values = self.call(messages, self.function)
+            else:
+                values = self.call_groups(query, history)
+            obj, invalid = self.validate(values)
+        for _ in range(self.repairs):
+            if obj is not None:
+                break
+            values = {**values, **self.repair(messages, values, invalid)}
+            obj, invalid = self.validate(values)
+        if obj is None:
+            log.error(f"get_parsed_output {self.cls.__name__} {invalid=}")
+        return obj
+
+
+@lru_cache(maxsize=None)
+def get_extractor(cls: BaseModel) -> Extractor:
+    return Extractor(cls)
 
 
 def get_parsed_output(
@@ -155,34 +332,54 @@ def get_parsed_output(
     get_messages_func: Callable[[int], List[BaseMessage]],
     cls: BaseModel,
     k: int = None,
+    values: dict = None,
 ) -> BaseModel:
     """Get the parsed output from chat_history"""
-    # Set up a parser + inject instructions into the prompt template.
-    parser = PydanticOutputParser(pydantic_object=cls)
-    # if we're going to extract all the fields from the chat history, we need to
-    # make sure the history is at least twice as long in order to extract them all
-    if k is None:
-        k = k = (len(cls.__fields__) * 2) + 5
-    memory = get_memory_from_messages(get_messages_func(k=k), k=k + 1)
+    return get_extractor(cls)(query, get_messages_func, k=k, values=values)
 
-    prompt = PromptTemplate(
-        template="Answer the user query.\n{format_instructions}\n{query}\n"
-        "Previous conversation:\n{chat_history}",
-        input_variables=["query", "chat_history"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
-    )
-    # llm = OpenAI(model_name=model_name, temperature=0.0)
-    llm = ChatOpenAI(model_name=SLEEPMATE_PARSER_MODEL_NAME, temperature=0.0)
-    try:
-        chain = LLMChain(llm=llm, prompt=prompt, memory=memory)
-        output = chain({"query": query})
-        return parser.parse(output["text"])
-    except OutputParserException as e:
-        log.error(f"get_parsed_output: {e=}")
+
+# every document made by pydantic_to_mongoengine, see ensure_indexes
+DOCUMENTS = []
+
+
+def get_indexes(fields: dict) -> list:
+    """Derive index specs for a generated document. Entries are almost always
+    looked up by the document they belong to (usually the user), then sorted
+    by -id or filtered on a date range."""
+    indexes = []
+    for name, field in fields.items():
+        if not isinstance(field, ReferenceField) or field.unique:
+            continue
+        indexes.append((name, "-id"))
+        if "date" in fields:
+            indexes.append((name, "-date"))
+    return indexes
+
+
+def ensure_indexes() -> None:
+    """Create the indexes for every generated document. Call once at startup,
+    rather than paying for it on first use of each collection. A unique index
+    that can't be built because of duplicates written before it existed is
+    logged and skipped, see migrate.py to remove them."""
+    from .chat import ensure_chat_indexes
+    from .registry import get_registry
+
+    get_registry()  # imports all the goal modules
+    for document in DOCUMENTS:
+        log.debug(f"ensure_indexes {document.__name__}")
+        try:
+            document.ensure_indexes()
+        except OperationFailure as e:
+            log.error(
+                f"ensure_indexes {document.__name__} {e=}, run "
+                "python -m sleepmate.migrate to find duplicates"
+            )
+    ensure_chat_indexes()
 
 
-def pydantic_to_mongoengine(pydantic_model, extra_fields=None):
-    """Convert a pydantic model to a mongoengine model."""
+def pydantic_to_mongoengine(pydantic_model, extra_fields=None, indexes=None):
+    """Convert a pydantic model to a mongoengine model. Indexes are derived for
+    reference fields, indexes adds any others the queries need."""
     fields = {}
     type_map = {
         str: StringField,
@@ -200,4 +397,7 @@ def pydantic_to_mongoengine(pydantic_model, extra_fields=None):
     if extra_fields is not None:
         for name, field in extra_fields.items():
             fields[name] = field
-    return type(pydantic_model.__name__, (Document,), fields)
+    fields["meta"] = {"indexes": get_indexes(fields) + (indexes or [])}
+    document = type(pydantic_model.__name__, (Document,), fields)
+    DOCUMENTS.append(document)
+    return document
@@ -0,0 +1,102 @@
+import logging
+from typing import Awaitable, Callable
+
+from saq import Queue
+
+from .config import (
+    REDIS_URL,
+    SLEEPMATE_TURN_LOCK_TIMEOUT,
+    SLEEPMATE_TURN_RETRIES,
+)
+from .helpful_scripts import json_dumps, json_loads
+
+log = logging.getLogger(__name__)
+
+# Webhooks push each message onto a per-user mailbox in Redis and enqueue a
+# process_turns job on the server's SAQ queue. Whichever worker holds the
+# user's lock drains their mailbox in order, so one user's turns never race
+# each other while different users are processed in parallel. A message stays
+# at the head of the mailbox until it has been handled, so a worker that dies
+# mid-turn leaves it for the job's retry. Turns that keep failing are moved to
+# the :dead list for someone to look at.
+
+
+def get_mailbox_key(name: str, db_user_id: str) -> str:
+    return f"sleepmate:{name}:turns:{db_user_id}"
+
+
+async def enqueue_turn(name: str, db_user_id: str, **message) -> None:
+    """Called from a webhook, add message to the user's mailbox and wake a
+    worker on the name queue."""
+    # a fresh connection each time, Flask runs every async view on a new loop
+    queue = Queue.from_url(REDIS_URL, name=name)
+    try:
+        await queue.redis.rpush(
+            get_mailbox_key(name, db_user_id), json_dumps(message)
+        )
+        # retried if the worker dies or the job times out, the turn is still
+        # in the mailbox
+        await queue.enqueue(
+            "process_turns",
+            db_user_id=str(db_user_id),
+            timeout=SLEEPMATE_TURN_LOCK_TIMEOUT,
+            retries=SLEEPMATE_TURN_RETRIES,
+        )
+    finally:
+        await queue.disconnect()
+
+
+async def drain_turns(
+    queue: Queue,
+    db_user_id: str,
+    handle: Callable[[dict], Awaitable[None]],
+    lock_timeout: int = SLEEPMATE_TURN_LOCK_TIMEOUT,
+    retries: int = SLEEPMATE_TURN_RETRIES,
+) -> int:
+    """Process the user's messages in order with handle, unless another worker
+    is already doing so. Each message is removed once handle returns, or after
+    retries attempts. Returns the number of messages handled."""
+    redis = queue.redis
+    key = get_mailbox_key(queue.name, db_user_id)
+    n = 0
+    while True:
+        lock = redis.lock(f"{key}:lock", timeout=lock_timeout, blocking=False)
+        if not await lock.acquire():
+            # the lock holder will get to our message
+            return n
+        try:
+            while (message := await redis.lindex(key, 0)) is not None:
+                await lock.reacquire()
+                log.info(f"drain_turns {key=} waiting={await redis.llen(key)}")
+                # counted before handle, so attempts that never return count
+                attempts = await redis.incr(f"{key}:attempts")
+                if attempts > retries:
+                    log.error(f"drain_turns dead letter {db_user_id=} {message=}")
+                    await redis.rpush(f"{key}:dead", message)
+                else:
+                    try:
+                        await handle(json_loads(message))
+                    except Exception as e:
+                        log.exception(f"drain_turns {db_user_id=} {attempts=} {e=}")
+                        continue
+                    n += 1
+                # only the lock holder pops, so the head is still message
+                await redis.lpop(key)
+                await redis.delete(f"{key}:attempts")
+        finally:
+            await lock.release()
+        # a message may have arrived after the last pop but before the release
+        if not await redis.llen(key):
+            return n
+
+
+async def get_queue_depths(queue: Queue) -> dict:
+    """Messages waiting per user on queue, for monitoring."""
+    prefix = get_mailbox_key(queue.name, "")
+    depths = {}
+    async for key in queue.redis.scan_iter(match=f"{prefix}*"):
+        key = key.decode() if isinstance(key, bytes) else key
+        db_user_id = key[len(prefix) :]
+        if ":" not in db_user_id:  # not the :lock, :attempts or :dead keys
+            depths[db_user_id] = await queue.redis.llen(key)
+    return depths
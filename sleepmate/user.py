@@ -16,7 +16,15 @@ class User(BaseModel):
     username: Optional[str] = Field(description="username")
 
 
-DBUser = pydantic_to_mongoengine(User)
+DBUser = pydantic_to_mongoengine(User, indexes=["username", "email"])
+
+
+def get_object_id(db_user_id) -> Optional[ObjectId]:
+    """db_user_id for raw pymongo queries, which don't convert ids the way
+    mongoengine does. None, e.g. an agent without a user, is passed through."""
+    if db_user_id is None or isinstance(db_user_id, ObjectId):
+        return db_user_id
+    return ObjectId(str(db_user_id))
 
 
 def get_user_from_email(email: str) -> DBUser:
@@ -0,0 +1,255 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+
+from .config import SLEEPMATE_INDEX_DIR
+
+log = logging.getLogger(__name__)
+
+
+class LocalIndex(object):
+    """A small on-disk vector index with the parts of the pinecone.Index API
+    that we use. Embeddings are stored normalised in a NumPy matrix that's
+    memory-mapped for reads, so a query is a single dot product.
+
+    Use get_local_index to share one instance per directory. Writes hold a lock
+    file, so other instances and processes wait, and start from what's on disk;
+    refresh picks up their writes."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.load()
+
+    @property
+    def matrix_path(self) -> Path:
+        return self.path / "vectors.npy"
+
+    @property
+    def metadata_path(self) -> Path:
+        return self.path / "metadata.json"
+
+    @property
+    def lock_path(self) -> Path:
+        return self.path / "lock"
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get_stamp(self) -> Optional[Tuple[int, int, int]]:
+        """Changes whenever a save replaces the metadata file."""
+        try:
+            stat = self.metadata_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> None:
+        matrix, ids, metadata = None, [], []
+        self.stamp = self.get_stamp()
+        if self.stamp is not None:
+            data = json.loads(self.metadata_path.read_text())
+            ids, metadata = data["ids"], data["metadata"]
+            matrix = np.load(self.matrix_path, mmap_mode="r")
+            if len(matrix) != len(ids):
+                raise ValueError(f"{self.path} is inconsistent, rebuild it")
+        # swapped in one go so readers never see a half updated index
+        self.state = (matrix, ids, metadata)
+
+    def refresh(self) -> bool:
+        """Reload if the index has been saved since it was loaded, e.g. by an
+        ingestion in another process. Returns True if it was."""
+        with self.lock:
+            if self.get_stamp() == self.stamp:
+                return False
+            log.info(f"refresh reloading {self.path}")
+            self.load()
+            return True
+
+    @contextmanager
+    def writing(self):
+        """Hold the index for a read-modify-write, starting from what's on
+        disk."""
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self.get_stamp() != self.stamp:
+                    self.load()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def ids(self) -> List[str]:
+        return self.state[1]
+
+    def save(self, matrix: np.ndarray, ids: List[str], metadata: List[dict]) -> None:
+        tmp = self.matrix_path.with_suffix(".tmp.npy")
+        np.save(tmp, matrix)
+        os.replace(tmp, self.matrix_path)
+        tmp = self.metadata_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"ids": ids, "metadata": metadata}))
+        os.replace(tmp, self.metadata_path)
+        self.load()
+
+    def upsert(self, vectors: List[Tuple[str, List[float], dict]]) -> None:
+        with self.writing():
+            matrix, ids, metadata = self.state
+            rows = {id: i for i, id in enumerate(ids)}
+            new = normalise(np.array([values for _, values, _ in vectors]))
+            if matrix is None:
+                matrix = np.empty((0, new.shape[1]), dtype=np.float32)
+            matrix, ids, metadata = np.array(matrix), list(ids), list(metadata)
+            extra = []
+            for (id, _, meta), row in zip(vectors, new):
+                if id in rows:
+                    matrix[rows[id]] = row
+                    metadata[rows[id]] = meta
+                else:
+                    rows[id] = len(ids)
+                    ids.append(id)
+                    metadata.append(meta)
+                    extra.append(row)
+            if extra:
+                matrix = np.vstack([matrix, np.array(extra, dtype=np.float32)])
+            self.save(matrix, ids, metadata)
+
+    def delete(self, ids: List[str]) -> None:
+        with self.writing():
+            matrix, old_ids, metadata = self.state
+            drop = set(ids)
+            keep = [i for i, id in enumerate(old_ids) if id not in drop]
+            if matrix is None or len(keep) == len(old_ids):
+                return
+            self.save(
+                np.array(matrix[keep]),
+                [old_ids[i] for i in keep],
+                [metadata[i] for i in keep],
+            )
+
+    def query(self, vector: List[float], top_k: int) -> List[Tuple[str, float, dict]]:
+        """Returns up to top_k (id, score, metadata), best first."""
+        matrix, ids, metadata = self.state
+        if not ids:
+            return []
+        scores = matrix @ normalise(np.array([vector]))[0]
+        top_k = min(top_k, len(ids))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i]), metadata[i]) for i in top]
+
+
+_indexes: Dict[Path, LocalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_local_index(path: Path = SLEEPMATE_INDEX_DIR) -> LocalIndex:
+    """Returns the process's LocalIndex for path, so that ingestion and the
+    vector store serving queries see the same state."""
+    key = Path(path).resolve()
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LocalIndex(key)
+        return _indexes[key]
+
+
+def normalise(matrix: np.ndarray) -> np.ndarray:
+    matrix = matrix.astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class LocalVectorStore(VectorStore):
+    """Langchain vector store over a LocalIndex, a drop-in for Pinecone when
+    the corpus is small enough to keep next to the data."""
+
+    def __init__(
+        self, index: LocalIndex, embedding: Embeddings, text_key: str = "text"
+    ) -> None:
+        self.index = index
+        self._embedding = embedding
+        self.text_key = text_key
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        self.index.upsert(
+            vectors=[
+                (id, vector, {**metadata, self.text_key: text})
+                for id, vector, metadata, text in zip(ids, vectors, metadatas, texts)
+            ]
+        )
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self.index.delete(ids=ids or [])
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        results = []
+        for _, score, metadata in self.index.query(embedding, top_k=k):
+            metadata = dict(metadata)
+            text = metadata.pop(self.text_key)
+            results.append((Document(page_content=text, metadata=metadata), score))
+        return results
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self._embedding.embed_query(query), k=k
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def _select_relevance_score_fn(self):
+        # scores are cosine similarities already
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        path: Path = SLEEPMATE_INDEX_DIR,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(get_local_index(path), embedding)
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store
@@ -4,7 +4,7 @@ from langchain.pydantic_v1 import BaseModel, Field
 from mongoengine import ReferenceField
 
 from .agent import BaseAgent
-from .goal import goal_refused
+from .goal import get_goal_state, record_progress, refresh_progress
 from .helpful_scripts import mongo_to_json, set_attribute
 from .structured import get_parsed_output, pydantic_to_mongoengine
 from .user import DBUser
@@ -37,7 +37,9 @@ DBWearables = pydantic_to_mongoengine(
 
 def user_integrated_supported_wearable(db_user_id: str) -> bool:
     """Returns True if the user has integrated a supported wearable device."""
-    db_entry = DBWearables.objects(user=db_user_id).first()
+    db_entry = get_goal_state(db_user_id).memoize(
+        "wearables", lambda: DBWearables.objects(user=db_user_id).first()
+    )
     if db_entry is None:
         return False
     return any(getattr(db_entry, wearable) for wearable in SUPPORTED_WEARABLES)
@@ -65,6 +67,7 @@ def remove_wearable(x: BaseAgent, utterance: str):
     log.info(f"remove_wearable {x.db_user_id=} {utterance=}")
     # it'd be nice to just update the record but this'll do for now
     DBWearables.objects(user=x.db_user_id).delete()
+    refresh_progress(x.db_user_id, DBWearables)
 
 
 def get_wearables_from_memory(x: BaseAgent) -> Wearables:
@@ -78,7 +81,7 @@ def save_wearables_to_db(user: str, entry: Wearables) -> DBWearables:
     # delete any existing entry
     DBWearables.objects(user=user).delete()
     # save the new entry
-    return DBWearables(**{"user": user, **entry}).save()
+    return record_progress(user, DBWearables(**{"user": user, **entry}).save())
 
 
 @set_attribute("return_direct", False)
@@ -91,10 +94,11 @@ def save_wearables(x: BaseAgent, utterance: str):
 
 
 def wearable_probe(db_user_id: str) -> bool:
-    return not goal_refused(db_user_id, "wearable_probe") and (
-        DBWearables.objects(user=db_user_id).count() == 0
-    )
+    state = get_goal_state(db_user_id)
+    return not state.refused("wearable_probe") and not state.has(DBWearables)
+
 
+GOAL_DOCUMENTS = [DBWearables]
 
 GOAL_HANDLERS = [
     {
@@ -16,7 +16,12 @@ from .config import (
     WHOOP_REDIRECT_URI,
     WHOOP_SCOPE,
 )
-from .goal import clear_goal_refused, goal_refused
+from .goal import (
+    clear_goal_refused,
+    get_goal_state,
+    record_progress,
+    refresh_progress,
+)
 from .helpful_scripts import (
     get_date_fields,
     get_start_end,
@@ -47,7 +52,9 @@ class WhoopToken(BaseModel):
 
 
 DBWhoopToken = pydantic_to_mongoengine(
-    WhoopToken, extra_fields={"user": ReferenceField(DBUser, required=True)}
+    WhoopToken,
+    extra_fields={"user": ReferenceField(DBUser, required=True)},
+    indexes=["state"],
 )
 
 
@@ -79,7 +86,9 @@ class WhoopUser(BaseModel):
 
 
 DBWhoopUser = pydantic_to_mongoengine(
-    WhoopUser, extra_fields={"user": ReferenceField(DBUser, required=True)}
+    WhoopUser,
+    extra_fields={"user": ReferenceField(DBUser, required=True)},
+    indexes=["whoop_user_id"],
 )
 
 
@@ -93,7 +102,10 @@ class WhoopSleep(BaseModel):
     json_dumps: str = Field(description="JSON representation of the sleep activity")
 
 
-DBWhoopSleep = pydantic_to_mongoengine(WhoopSleep)
+DBWhoopSleep = pydantic_to_mongoengine(
+    WhoopSleep,
+    indexes=[{"fields": ["whoop_id"], "unique": True}, ("whoop_user_id", "-id")],
+)
 
 
 class WhoopSleepDiaryEntry_(BaseModel):
@@ -150,6 +162,7 @@ def clear_whoop_data(db_user_id: str) -> None:
     [clear_goal_refused(db_user_id, goal) for goal in GOAL_HANDLERS[0].keys()]
     DBWhoopSleepDiaryEntry.objects(user=db_user_id).delete()
     DBWhoopImportEntry.objects(user=db_user_id).delete()
+    refresh_progress(db_user_id, DBWhoopSleepDiaryEntry, DBWhoopImportEntry)
 
 
 def update_user_from_whoop(db_user_id: str) -> DBUser:
@@ -196,6 +209,17 @@ def import_whoop_sleep_by_id(db_user_id: str, whoop_sleep_id: int) -> DBWhoopSle
     )
 
 
+def save_whoop_sleep(db_entry: DBWhoopSleep) -> DBWhoopSleep:
+    """Insert or update the sleep by whoop_id, WHOOP sends an update for the
+    same sleep more than once."""
+    DBWhoopSleep.objects(whoop_id=db_entry.whoop_id).update_one(
+        upsert=True,
+        set__whoop_user_id=db_entry.whoop_user_id,
+        set__json_dumps=db_entry.json_dumps,
+    )
+    return DBWhoopSleep.objects(whoop_id=db_entry.whoop_id).first()
+
+
 def get_user_by_whoop_id(whoop_user_id: int) -> DBUser:
     db_entry = DBWhoopUser.objects(whoop_user_id=whoop_user_id).first()
     if db_entry is None:
@@ -264,7 +288,7 @@ def import_whoop_sleep_data_(db_user_id: str) -> str:
     db_entries = import_whoop_sleep(db_user_id)
     log.info(f"import_whoop_sleep_data: {len(db_entries)=}")
     # save the oldest first the order is important later
-    [db_entry.save() for db_entry in reversed(db_entries)]
+    [save_whoop_sleep(db_entry) for db_entry in reversed(db_entries)]
     return "Success!"
 
 
@@ -281,8 +305,10 @@ def import_whoop_user_data_(db_user_id: str) -> str:
     db_user.save()
     db_entry = get_whoop_body_measures(db_user_id)
     log.info(f"import_whoop_user_data: {db_entry.to_mongo()=}")
-    db_entry.save()
-    DBWhoopImportEntry(user=db_user_id, date=datetime.now()).save()
+    record_progress(db_user_id, db_entry.save())
+    record_progress(
+        db_user_id, DBWhoopImportEntry(user=db_user_id, date=datetime.now()).save()
+    )
     return "Success!"
 
 
@@ -346,7 +372,9 @@ def save_whoop_sleep_diary_entry_to_db(
         user=db_user_id, date__gte=start, date__lte=end
     ).delete()
     # save the new entry
-    return DBWhoopSleepDiaryEntry(**{"user": db_user_id, **entry}).save()
+    return record_progress(
+        db_user_id, DBWhoopSleepDiaryEntry(**{"user": db_user_id, **entry}).save()
+    )
 
 
 @set_attribute("return_direct", False)
@@ -362,31 +390,39 @@ def save_whoop_sleep_diary_entry(x: BaseAgent, utterance: str):
 
 
 def has_whoop(db_user_id: str) -> bool:
-    return DBWearables.objects(user=db_user_id, whoop=True).count() > 0
+    """True if any of the user's wearables records has WHOOP."""
+    return get_goal_state(db_user_id).memoize(
+        "has_whoop",
+        lambda: DBWearables.objects(user=db_user_id, whoop=True).count() > 0,
+    )
 
 
 def whoop_import(db_user_id: str) -> bool:
     if not has_whoop(db_user_id):
         return False
 
-    if goal_refused(db_user_id, "whoop_import"):
+    state = get_goal_state(db_user_id)
+    if state.refused("whoop_import"):
         return False
 
-    return DBWhoopImportEntry.objects(user=db_user_id).count() == 0
+    return not state.has(DBWhoopImportEntry)
 
 
 def whoop_sleep(db_user_id: str) -> bool:
     if not has_whoop(db_user_id):
         return False
 
-    if goal_refused(db_user_id, "whoop_sleep"):
+    state = get_goal_state(db_user_id)
+    if state.refused("whoop_sleep"):
         return False
 
     end = datetime.combine(date.today(), time())
     start = end - timedelta(days=0)
 
-    return DBWhoopSleepDiaryEntry.objects(user=db_user_id, date__gte=start).count() == 0
+    return not state.has(DBWhoopSleepDiaryEntry, since=start)
+
 
+GOAL_DOCUMENTS = [DBWhoopImportEntry, DBWhoopSleepDiaryEntry]
 
 GOAL_HANDLERS = [
     {
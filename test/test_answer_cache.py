@@ -0,0 +1,40 @@
+from sleepmate.answer_cache import SemanticCache
+
+
+def test_should_serve_similar_questions():
+    cache = SemanticCache(threshold=0.9, ttl=60, size=2)
+    assert cache.get([1.0, 0.0], "v1") is None
+    cache.put([1.0, 0.0], "v1", "keep a sleep diary")
+    assert cache.get([0.99, 0.05], "v1") == "keep a sleep diary"
+    assert cache.get([0.0, 1.0], "v1") is None
+    # answers from another version of the corpus aren't served
+    assert cache.get([1.0, 0.0], "v2") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["hit_rate"] == 0.25
+
+
+def test_should_expire_and_evict():
+    cache = SemanticCache(threshold=0.9, ttl=-1, size=1)
+    cache.put([1.0, 0.0], "v1", "a")
+    assert cache.get([1.0, 0.0], "v1") is None
+    cache = SemanticCache(threshold=0.9, ttl=60, size=1)
+    cache.put([1.0, 0.0], "v1", "a")
+    cache.put([0.0, 1.0], "v1", "b")
+    assert len(cache) == 1
+    assert cache.get([1.0, 0.0], "v1") is None
+
+
+def test_should_reuse_rows():
+    cache = SemanticCache(threshold=0.9, ttl=60, size=2)
+    cache.put([1.0, 0.0], "v1", "a")
+    cache.put([0.0, 1.0], "v1", "b")
+    # a is used, so b is evicted
+    assert cache.get([1.0, 0.0], "v1") == "a"
+    cache.put([1.0, 1.0], "v1", "c")
+    assert cache.matrix.shape == (2, 2)
+    assert cache.get([0.0, 1.0], "v1") is None
+    assert [cache.get(e, "v1") for e in ([1.0, 0.0], [1.0, 1.0])] == ["a", "c"]
+    # a new embedding model starts afresh
+    cache.put([1.0, 0.0, 0.0], "v1", "d")
+    assert len(cache) == 1
+    assert cache.get([1.0, 0.0], "v1") is None
@@ -0,0 +1,40 @@
+from langchain.schema import Generation
+
+from sleepmate.cache import FileTier, MemoryTier, TieredCache, no_cache
+
+
+def test_should_fill_memory_from_shared_tier(tmp_path):
+    path = str(tmp_path / "llm.db")
+    cache = TieredCache(MemoryTier(2, 60), FileTier(path, 60, 10))
+    cache.update("prompt", "llm", [Generation(text="hello")])
+    # another worker only sees the shared tier
+    other = TieredCache(MemoryTier(2, 60), FileTier(path, 60, 10))
+    assert other.lookup("prompt", "llm")[0].text == "hello"
+    assert other.memory.get(next(iter(other.memory.entries)))[0].text == "hello"
+    assert other.lookup("prompt", "other llm") is None
+
+
+def test_should_expire_and_limit_size(tmp_path):
+    memory = MemoryTier(1, 60)
+    memory.set("a", [Generation(text="a")])
+    memory.set("b", [Generation(text="b")])
+    assert memory.get("a") is None
+    shared = FileTier(str(tmp_path / "llm.db"), -1, 10)
+    shared.set("a", [Generation(text="a")])
+    assert shared.get("a") is None
+    shared = FileTier(str(tmp_path / "rows.db"), 60, 2, prune_every=1)
+    for key in "abcb":
+        shared.set(key, [Generation(text=key)])
+    assert shared.get("a") is None
+    assert [shared.get(key)[0].text for key in "bc"] == ["b", "c"]
+
+
+def test_should_opt_out_per_call():
+    cache = TieredCache(MemoryTier(2, 60))
+    with no_cache():
+        cache.update("prompt", "llm", [Generation(text="hello")])
+    assert cache.lookup("prompt", "llm") is None
+    cache.update("prompt", "llm", [Generation(text="hello")])
+    with no_cache():
+        assert cache.lookup("prompt", "llm") is None
+    assert cache.lookup("prompt", "llm")[0].text == "hello"
@@ -0,0 +1,43 @@
+import pytest
+
+from sleepmate.capture import clear_draft, get_draft, update_draft
+from sleepmate.isi import ISIEntry
+from sleepmate.structured import get_extractor
+
+
+@pytest.mark.usefixtures("user")
+class TestDraft:
+    def test_should_merge_answers(self, user):
+        assert get_draft(user.id, "insomnia_severity_index") == {}
+        update_draft(user.id, "insomnia_severity_index", {"date": "today"})
+        update_draft(
+            user.id,
+            "insomnia_severity_index",
+            {"difficulty_falling_asleep": 2, "difficulty_staying_asleep": 1},
+        )
+        # corrections overwrite earlier answers
+        update_draft(
+            user.id, "insomnia_severity_index", {"difficulty_falling_asleep": 3}
+        )
+        assert get_draft(user.id, "insomnia_severity_index") == {
+            "date": "today",
+            "difficulty_falling_asleep": 3,
+            "difficulty_staying_asleep": 1,
+        }
+        assert get_draft(user.id, "stop_bang") == {}
+        clear_draft(user.id, "insomnia_severity_index")
+        assert get_draft(user.id, "insomnia_severity_index") == {}
+
+    def test_should_not_carry_over_yesterdays_draft(self, user):
+        update_draft(user.id, "diary_entry", {"in_bed": "22:30"}, "2023-12-01")
+        update_draft(user.id, "diary_entry", {"awakenings": 2}, "2023-12-02")
+        assert get_draft(user.id, "diary_entry", "2023-12-01") == {}
+        assert get_draft(user.id, "diary_entry", "2023-12-02") == {"awakenings": 2}
+        clear_draft(user.id, "diary_entry")
+        assert get_draft(user.id, "diary_entry", "2023-12-02") == {}
+
+
+def test_should_capture_partial_answers():
+    function = get_extractor(ISIEntry).partial_function
+    assert function["parameters"]["required"] == []
+    assert "sleep_problem_worry" in function["parameters"]["properties"]
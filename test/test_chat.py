@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from langchain.schema import AIMessage, HumanMessage
+from langchain.schema.messages import message_to_dict
+
+from sleepmate.chat import WindowedChatMessageHistory
+
+
+@pytest.mark.usefixtures("user")
+class TestWindowedChatMessageHistory:
+    def test_should_load_last_window(self, user):
+        history = WindowedChatMessageHistory(user.id, window=2)
+        for n in range(3):
+            history.add_message(HumanMessage(content=f"human {n}"))
+            history.add_message(AIMessage(content=f"ai {n}"))
+        history.start_turn()
+        assert [m.content for m in history.messages] == ["human 2", "ai 2"]
+        assert [m.content for m in history.get_messages(3)] == [
+            "ai 1",
+            "human 2",
+            "ai 2",
+        ]
+        assert len(history.get_messages(10)) == 6
+
+    def test_should_append_and_delete(self, user):
+        history = WindowedChatMessageHistory(user.id, window=2)
+        history.add_message(HumanMessage(content="human 3"))
+        assert [m.content for m in history.messages] == ["ai 2", "human 3"]
+        history.delete_last(1)
+        assert [m.content for m in history.messages] == ["human 2", "ai 2"]
+        history.clear()
+        history.start_turn()
+        assert history.messages == []
+
+    def test_should_share_one_snapshot_per_turn(self, user):
+        history = WindowedChatMessageHistory(user.id, window=2)
+        history.add_message(HumanMessage(content="human 4"))
+        assert [m.content for m in history.messages] == ["human 4"]
+        # reads within the turn come from the snapshot, not the database
+        history.collection.delete_many({"SessionId": user.id})
+        version = history.version
+        assert [m.content for m in history.get_messages(1)] == ["human 4"]
+        assert history.version == version
+        history.add_message(AIMessage(content="ai 4"))
+        assert history.version > version
+        assert [m.content for m in history.messages] == ["human 4", "ai 4"]
+        history.start_turn()
+        assert [m.content for m in history.messages] == ["ai 4"]
+
+    def test_should_read_both_storage_versions(self, user):
+        history = WindowedChatMessageHistory(user.id, window=4)
+        history.clear()
+        # written by langchain's MongoDBChatMessageHistory
+        history.collection.insert_one(
+            {
+                "SessionId": user.id,
+                "History": json.dumps(message_to_dict(HumanMessage(content="old"))),
+            }
+        )
+        # untagged messages are adopted by the goal the user is on
+        history.set_goal("meet").result()
+        long = "zzz " * 1000
+        history.add_messages([HumanMessage(content="new"), AIMessage(content=long)])
+        doc = history.collection.find_one({"SessionId": user.id, "v": 2})
+        assert doc["Message"]["type"] == "human"
+        history.start_turn()
+        assert [m.content for m in history.messages] == ["old", "new", long]
+
+    def test_should_archive_old_goal_messages(self, user):
+        history = WindowedChatMessageHistory(user.id, window=4, goal="meet")
+        history.clear()
+        history.add_messages([HumanMessage(content="hi"), AIMessage(content="hello")])
+        history.archive("bmi").result()
+        assert history.messages == []
+        history.add_message(HumanMessage(content="I'm 180cm"))
+        history.start_turn()
+        assert [m.content for m in history.messages] == ["I'm 180cm"]
+        # archived, not deleted, the TTL index removes them later
+        assert history.collection.count_documents(
+            {"SessionId": user.id, "Archived": {"$ne": None}}
+        ) == 2
+        history.set_goal("meet")
+        assert history.messages == []
+
+    def test_should_archive_on_goal_change(self, user):
+        history = WindowedChatMessageHistory(user.id, window=4, goal="meet")
+        history.clear()
+        history.add_message(HumanMessage(content="diary today"))
+        history.set_goal("bmi").result()
+        assert history.messages == []
+        history.add_message(HumanMessage(content="I'm 180cm"))
+        # the old goal's messages don't come back when it recurs
+        history.set_goal("meet").result()
+        assert history.messages == []
+        assert history.collection.count_documents(
+            {"SessionId": user.id, "Archived": {"$ne": None}}
+        ) == 2
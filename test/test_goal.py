@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import sleepmate.goal
+from sleepmate.goal import DBUserProgress, GoalState, add_goal_refused
+from sleepmate.wearable import (
+    DBWearables,
+    Wearables,
+    remove_wearable,
+    save_wearables_to_db,
+    user_integrated_supported_wearable,
+)
+from sleepmate.whoop import has_whoop
+
+from .helpful_scripts import get_X
+
+
+@pytest.mark.usefixtures("user")
+class TestGoalState:
+    def test_should_see_goal_refusals(self, user):
+        assert not GoalState(user.id).refused("bmi")
+        add_goal_refused(user.id, "bmi")
+        state = GoalState(user.id, [DBWearables])
+        assert state.refused("bmi")
+        assert state.refused("bmi", days=None)
+        assert not state.refused("sleep50")
+
+    def test_should_summarise_documents(self, user):
+        assert not GoalState(user.id, [DBWearables]).has(DBWearables)
+        save_wearables_to_db(user.id, Wearables(whoop=True))
+        state = GoalState(user.id, [DBWearables])
+        assert state.has(DBWearables)
+        assert state.last(DBWearables).whoop
+        # documents outside the batch are summarised on demand
+        state = GoalState(user.id)
+        assert state.has(DBWearables)
+        assert not state.has(DBWearables, since=datetime.now() + timedelta(days=1))
+
+    def test_should_keep_progress_up_to_date(self, user):
+        state = GoalState(user.id, [DBWearables])
+        assert state.has(DBWearables)
+        assert not state.stale
+        remove_wearable(get_X(user, "wearable_probe"), "")
+        assert state.stale
+        assert not GoalState(user.id, [DBWearables]).has(DBWearables)
+        save_wearables_to_db(user.id, Wearables(fitbit=True))
+        state = GoalState(user.id)
+        assert state.has(DBWearables)
+        assert not state.last(DBWearables).whoop
+
+
+@pytest.mark.usefixtures("user")
+class TestProgressRaces:
+    def test_should_not_lose_writes_while_building(self, user, monkeypatch):
+        aggregate_progress = sleepmate.goal.aggregate_progress
+
+        def aggregate_then_save(*args, **kwargs):
+            progress = aggregate_progress(*args, **kwargs)
+            save_wearables_to_db(user.id, Wearables(whoop=True))
+            return progress
+
+        monkeypatch.setattr(sleepmate.goal, "aggregate_progress", aggregate_then_save)
+        state = GoalState(user.id, [DBWearables])
+        # the snapshot is from before the save, but the save isn't lost
+        assert not state.has(DBWearables)
+        assert state.stale
+        monkeypatch.undo()
+        assert GoalState(user.id, [DBWearables]).has(DBWearables)
+
+    def test_should_see_writes_from_other_processes(self, user):
+        state = GoalState(user.id, [DBWearables])
+        assert state.has(DBWearables)
+        assert not state.stale
+        DBUserProgress._get_collection().update_one(
+            {"user": user.id}, {"$inc": {"version": 1}}
+        )
+        assert state.stale
+
+    def test_should_check_every_wearables_record(self, user):
+        DBWearables.objects(user=user.id).delete()
+        DBWearables(user=user.id, whoop=True).save()
+        DBWearables(user=user.id, fitbit=True).save()
+        assert has_whoop(user.id)
+        assert user_integrated_supported_wearable(user.id)
+
+
+def test_should_have_no_progress_without_a_user():
+    state = GoalState(None, [DBWearables])
+    assert not state.has(DBWearables)
+    assert not state.refused("bmi")
+    assert state.last(DBWearables) is None
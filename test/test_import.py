@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+
+# importing the package, including every goal module, must stay cheap: no
+# network I/O and no index builds
+IMPORT_BUDGET_MS = 5000
+
+SCRIPT = """
+import json
+import socket
+import time
+
+connects = []
+
+
+def connect(self, address, *args, **kwargs):
+    connects.append(str(address))
+    raise OSError("network I/O at import time")
+
+
+socket.socket.connect = connect
+socket.socket.connect_ex = connect
+start = time.perf_counter()
+import sleepmate.executor
+from sleepmate.registry import get_registry
+
+get_registry()
+print(json.dumps({"ms": (time.perf_counter() - start) * 1000, "connects": connects}))
+"""
+
+
+def test_should_import_executor_quickly_without_network():
+    out = subprocess.run(
+        [sys.executable, "-c", SCRIPT], capture_output=True, text=True, check=True
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert not result["connects"]
+    assert result["ms"] < IMPORT_BUDGET_MS
@@ -0,0 +1,73 @@
+from langchain.schema import Document
+
+from sleepmate.ingest import MANIFEST_NAME, Manifest, ingest
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+
+class FakeIndex:
+    def __init__(self):
+        self.vectors = {}
+
+    def upsert(self, vectors):
+        for id, values, metadata in vectors:
+            self.vectors[id] = (values, metadata)
+
+    def delete(self, ids):
+        for id in ids:
+            del self.vectors[id]
+
+
+def load_lines(path):
+    return [
+        Document(page_content=line, metadata={"source": str(path)})
+        for line in path.read_text().splitlines()
+    ]
+
+
+def run_ingest(path, index, embeddings):
+    loaders = {".txt": load_lines}
+    return ingest(path, index, embeddings, loaders, len, batch_size=1)
+
+
+def test_should_only_embed_new_chunks(tmp_path):
+    (tmp_path / "a.txt").write_text("one\ntwo\n")
+    index, embeddings = FakeIndex(), FakeEmbeddings()
+    run_ingest(tmp_path, index, embeddings)
+    assert sorted(embeddings.texts) == ["one", "two"]
+    assert len(index.vectors) == 2
+    # unchanged files aren't even loaded
+    embeddings.texts = []
+    run_ingest(tmp_path, index, embeddings)
+    assert embeddings.texts == []
+    # changed files only embed the new chunks and drop the old ones
+    (tmp_path / "a.txt").write_text("one\nthree\n")
+    manifest = run_ingest(tmp_path, index, embeddings)
+    assert embeddings.texts == ["three"]
+    assert sorted(v[1]["text"] for v in index.vectors.values()) == ["one", "three"]
+    assert sorted(c["tokens"] for c in manifest.chunks.values()) == [3, 5]
+
+
+def test_should_resume_and_prune(tmp_path):
+    (tmp_path / "a.txt").write_text("one\ntwo\n")
+    (tmp_path / "b.txt").write_text("two\n")
+    index, embeddings = FakeIndex(), FakeEmbeddings()
+    run_ingest(tmp_path, index, embeddings)
+    # forget a.txt as if the run had crashed before finishing it
+    manifest = Manifest(tmp_path / MANIFEST_NAME)
+    del manifest.files[str(tmp_path / "a.txt")]
+    manifest.save()
+    embeddings.texts = []
+    run_ingest(tmp_path, index, embeddings)
+    assert embeddings.texts == []
+    # chunks shared with another file are kept
+    (tmp_path / "a.txt").unlink()
+    run_ingest(tmp_path, index, embeddings)
+    assert [v[1]["text"] for v in index.vectors.values()] == ["two"]
@@ -0,0 +1,97 @@
+import pinecone
+import pytest
+from langchain.schema import Document
+from langchain.vectorstores import Pinecone
+
+from sleepmate import knowledge
+from sleepmate.ingest import MANIFEST_NAME
+from sleepmate.knowledge import count_tokens, get_encoding, pack_context
+from sleepmate.vectorstore import LocalIndex
+
+
+def test_should_pack_best_chunks_into_budget():
+    docs = [
+        Document(page_content="a", metadata={"tokens": 5}),
+        Document(page_content="b", metadata={"tokens": 10}),
+        Document(page_content="c", metadata={"tokens": 2}),
+    ]
+    assert [d.page_content for d in pack_context(docs, 10)] == ["a", "c"]
+    assert pack_context(docs, 3) == [docs[2]]
+
+
+def test_should_cache_token_counts():
+    count_tokens.cache_clear()
+    assert count_tokens("how do I sleep better?") == count_tokens(
+        "how do I sleep better?"
+    )
+    assert count_tokens.cache_info().hits == 1
+    assert get_encoding() is get_encoding()
+
+
+class FakeEmbeddings:
+    def embed_documents(self, texts):
+        return [[1.0, float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return [1.0, float(len(text))]
+
+
+def test_should_only_rebuild_index_when_asked(tmp_path, monkeypatch):
+    index_dir = tmp_path / "index"
+    monkeypatch.setattr(knowledge, "SLEEPMATE_VECTORSTORE", "local")
+    monkeypatch.setattr(knowledge, "SLEEPMATE_INDEX_DIR", index_dir)
+    monkeypatch.setattr(knowledge, "OpenAIEmbeddings", FakeEmbeddings)
+    # written before chunk ids were content hashes
+    LocalIndex(index_dir).upsert([("legacy-uuid", [1.0, 2.0], {"text": "zz"})])
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "sleep.txt").write_text("sleep is good")
+    with pytest.raises(ValueError):
+        knowledge.load_knowledge(str(data))
+    assert "legacy-uuid" in LocalIndex(index_dir).ids
+    knowledge.load_knowledge(str(data), overwrite=True)
+    assert "legacy-uuid" not in LocalIndex(index_dir).ids
+    assert len(LocalIndex(index_dir)) == 1
+    # the manifest is in the database, not next to the files, so ingesting
+    # from another host carries on from it
+    assert not (data / MANIFEST_NAME).exists()
+    assert str(data / "sleep.txt") in knowledge.IndexManifest().files
+    knowledge.load_knowledge(str(data))
+    assert len(LocalIndex(index_dir)) == 1
+    knowledge.DBCorpusVersion.objects(index=str(index_dir)).delete()
+
+
+class FakePineconeIndex(pinecone.Index):
+    def __init__(self, texts):
+        self.texts = texts
+        self.queries = []
+
+    def query(self, *args, **kwargs):
+        self.queries.append(kwargs)
+        return {
+            "matches": [
+                {"metadata": {"text": text, "tokens": 1}, "score": 1.0}
+                for text in self.texts
+            ]
+        }
+
+
+def test_should_search_pinecone_by_vector(monkeypatch):
+    index = FakePineconeIndex(["sleep", "well"])
+    db = Pinecone(index, FakeEmbeddings(), "text")
+    monkeypatch.setattr(knowledge, "_db", db)
+    assert knowledge.get_context("how do I sleep?", [1.0, 2.0]) == "sleep well"
+    assert index.queries[0]["top_k"] == knowledge.SLEEPMATE_KNOWLEDGE_TOP_K
+
+
+def test_should_share_corpus_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(knowledge, "SLEEPMATE_VECTORSTORE", "local")
+    monkeypatch.setattr(knowledge, "SLEEPMATE_INDEX_DIR", tmp_path / "index")
+    monkeypatch.setattr(knowledge, "_corpus_version", (None, float("-inf")))
+    # nothing ingested, so nothing to key cached answers on
+    assert knowledge.get_corpus_version() is None
+    knowledge.save_corpus_version("v1")
+    # another process reads it from the database
+    monkeypatch.setattr(knowledge, "_corpus_version", (None, float("-inf")))
+    assert knowledge.get_corpus_version() == "v1"
+    knowledge.DBCorpusVersion.objects(index=knowledge.get_index_name()).delete()
@@ -0,0 +1,30 @@
+from sleepmate.models import MODELS, get_model, register_model
+
+
+class FakeModel:
+    pass
+
+
+def test_should_build_models_once_on_first_use():
+    built = []
+    register_model("fake", lambda: built.append(1) or FakeModel())
+    assert not built
+    model = get_model("fake")
+    assert get_model("fake") is model
+    assert MODELS["fake"] is model
+    assert built == [1]
+    assert "fake" in MODELS
+
+
+def test_should_register_the_agent_and_memory_models():
+    assert {"agent", "gpt", "parser"} <= set(MODELS)
+
+
+class FakeSampledModel:
+    temperature = 0.3
+    cache = None
+
+
+def test_should_only_cache_temperature_0_models():
+    register_model("sampled", FakeSampledModel)
+    assert get_model("sampled").cache is False
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+from sleepmate.pool import TurnGate, XPool, acquire
+
+
+class FakeX:
+    def __init__(self, username=None, **kwargs):
+        self.username = username
+
+
+def test_should_reuse_agent_for_same_user():
+    pool = XPool(FakeX, size=2)
+    x = pool.get("a", username="a")
+    assert pool.get("a", username="a") is x
+    assert pool.get("b", username="b") is not x
+
+
+def test_should_evict_least_recently_used():
+    pool = XPool(FakeX, size=2)
+    pool.get("a", username="a")
+    pool.get("b", username="b")
+    pool.get("a", username="a")
+    pool.get("c", username="c")
+    assert "a" in pool
+    assert "b" not in pool
+    assert len(pool) == 2
+
+
+def test_should_evict_idle_agents():
+    pool = XPool(FakeX, size=2, idle_seconds=0)
+    x = pool.get("a", username="a")
+    pool.evict_idle()
+    assert "a" not in pool
+    assert pool.get("a", username="a") is not x
+
+
+def test_should_invalidate_agent():
+    pool = XPool(FakeX)
+    x = pool.get("a", username="a")
+    pool.invalidate("a")
+    assert pool.get("a", username="a") is not x
+
+
+def test_should_run_one_turn_at_a_time_per_user():
+    gate = TurnGate()
+    order = []
+
+    async def turn(db_user_id, n):
+        async with gate.aturn(db_user_id):
+            order.append((db_user_id, n, "start"))
+            await asyncio.sleep(0)
+            order.append((db_user_id, n, "end"))
+
+    async def main():
+        await asyncio.gather(turn("a", 1), turn("a", 2), turn("b", 1))
+
+    asyncio.run(main())
+    a = [step for step in order if step[0] == "a"]
+    assert a == [("a", 1, "start"), ("a", 1, "end"), ("a", 2, "start"), ("a", 2, "end")]
+    # b didn't wait for a
+    assert order.index(("b", 1, "start")) < order.index(("a", 1, "end"))
+    assert gate.stats() == {"users": 0, "turns": 0, "max_depth": 0}
+
+
+def test_should_share_turns_between_sync_and_async():
+    gate = TurnGate()
+    order = []
+    started = threading.Event()
+
+    def sync_turn():
+        with gate.turn("a"):
+            started.set()
+            time.sleep(0.05)
+            order.append("sync")
+
+    async def main():
+        thread = threading.Thread(target=sync_turn)
+        thread.start()
+        await asyncio.to_thread(started.wait)
+        async with gate.aturn("a"):
+            order.append("async")
+        thread.join()
+
+    asyncio.run(main())
+    assert order == ["sync", "async"]
+    assert gate.stats() == {"users": 0, "turns": 0, "max_depth": 0}
+
+
+def test_should_release_lock_when_cancelled_waiting():
+    async def main():
+        lock = threading.Lock()
+        lock.acquire()
+        waiting = asyncio.ensure_future(acquire(lock))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        lock.release()
+        await asyncio.sleep(0.05)
+        # the waiting thread got it after the cancel and let it go
+        assert not lock.locked()
+
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+from sleepmate.rules import (
+    apply_rules,
+    get_asked_fields,
+    parse_count,
+    parse_duration,
+    parse_height,
+    parse_length,
+    parse_score,
+    parse_time,
+    parse_weight,
+    parse_yes_no,
+)
+
+SLEEP50 = {
+    "sleep_apnea_1": "snore",
+    "sleep_apnea_2": "sweat during the night",
+    "sleep_apnea_6": "wake up during the night while coughing or being short of breath",
+    "insomnia_12": "wake up during the night",
+}
+BODY_MEASURES = {
+    "date": "date of entry",
+    "height": "height in metres",
+    "weight": "weight in kilograms",
+}
+
+
+def test_should_parse_scores_and_counts():
+    score = parse_score(1, 4)
+    assert [score(s) for s in ["3", "three", "3 - rather much", "I'd say 2."]] == [
+        3,
+        3,
+        3,
+        2,
+    ]
+    assert [score(s) for s in ["0", "5", "2.5", "often"]] == [None] * 4
+    assert parse_score(0, 4)("0") == 0
+    assert [parse_count(s) for s in ["2", "twice", "none", "a few"]] == [2, 2, 0, None]
+    assert [parse_yes_no(s) for s in ["Yes", "nope", "maybe"]] == [True, False, None]
+
+
+def test_should_parse_times_and_durations():
+    bedtime = parse_time(night=True)
+    assert [bedtime(s) for s in ["9:15", "9.15pm", "10 pm", "12:30", "1:00"]] == [
+        "21:15",
+        "21:15",
+        "22:00",
+        "00:30",
+        "01:00",
+    ]
+    assert bedtime("11") is None
+    assert [parse_time()(s) for s in ["6:45", "7am", "18:00"]] == [
+        "06:45",
+        "07:00",
+        "18:00",
+    ]
+    durations = ["20", "20 mins", "1.5 hours", "1h30", "an hour", "half an hour"]
+    assert [parse_duration(s) for s in durations] == [20, 20, 90, 90, 60, 30]
+    assert parse_duration("ages") is None
+    # could be hours
+    assert parse_duration("1.5") is None
+    assert parse_duration("1.5 mins") == 2
+
+
+def test_should_convert_units():
+    heights = ["5'10", "5 ft 10 in", "5 feet 10 inches", "178 cm", "1.78m", "178"]
+    assert [parse_height(s) for s in heights] == [1.78] * len(heights)
+    assert parse_height("3") is None
+    assert [parse_weight(s) for s in ["82 kg", "180 lbs", "12 st 6"]] == [
+        82.0,
+        81.6,
+        78.9,
+    ]
+    assert parse_weight("82") is None
+    assert [parse_length(s) for s in ["41 cm", "16 inches", "16"]] == [41.0, 40.6, None]
+
+
+def test_should_find_the_fields_asked():
+    question = "1. I am told that I snore.\n2. I sweat during the night."
+    assert get_asked_fields(SLEEP50, question) == ["sleep_apnea_1", "sleep_apnea_2"]
+    question = "I wake up during the night while coughing or being short of breath?"
+    assert get_asked_fields(SLEEP50, question) == ["sleep_apnea_6"]
+
+
+def test_should_apply_rules_all_or_nothing():
+    rules = {field: parse_score(1, 4) for field in SLEEP50}
+    question = "1. I am told that I snore.\n2. I sweat during the night."
+    expected = {"sleep_apnea_1": 3, "sleep_apnea_2": 1}
+    assert apply_rules(rules, SLEEP50, question, "3, 1") == expected
+    assert apply_rules(rules, SLEEP50, question, "3 1") == expected
+    assert apply_rules(rules, SLEEP50, question, "3") == {}
+    assert apply_rules(rules, SLEEP50, question, "3 and not sure") == {}
+    rules = {"height": parse_height, "weight": parse_weight}
+    question = "What is your height?"
+    assert apply_rules(rules, BODY_MEASURES, question, "5'10 and 180 lbs") == {
+        "height": 1.78,
+        "weight": 81.6,
+    }
+    # without a unit it could be anything
+    assert apply_rules(rules, BODY_MEASURES, question, "180") == {}
+    question = "What's your weight?"
+    for answer in ["about 180", "around 150", "I think 165"]:
+        assert apply_rules(rules, BODY_MEASURES, question, answer) == {}
+    question = "What is your height in metres?"
+    assert apply_rules(rules, BODY_MEASURES, question, "1.78") == {"height": 1.78}
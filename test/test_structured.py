@@ -0,0 +1,137 @@
+from langchain.pydantic_v1 import BaseModel, ValidationError, root_validator
+
+from sleepmate.bmi import BodyMeasures
+from sleepmate.migrate import remove_duplicates
+from sleepmate.goal import DBGoalRefusal
+from sleepmate.seeds import DBSeedsDiaryEntry
+from sleepmate.sleep50 import Sleep50Entry
+from sleepmate.structured import (
+    Extractor,
+    ensure_indexes,
+    get_extractor,
+    get_field_groups,
+    get_invalid_fields,
+    get_slice,
+)
+from sleepmate.wearable import DBWearables, Wearables
+from sleepmate.whoop import DBWhoopSleep, save_whoop_sleep
+
+
+def get_index_keys(document):
+    return [
+        index["key"]
+        for index in document._get_collection().index_information().values()
+    ]
+
+
+def test_should_derive_indexes():
+    assert ("user", "-id") in DBWearables._meta["indexes"]
+    assert ("user", "-date") not in DBWearables._meta["indexes"]
+    assert ("pod", "-date") in DBSeedsDiaryEntry._meta["indexes"]
+    assert ("user", "goal", "-date") in DBGoalRefusal._meta["indexes"]
+
+
+def test_should_ensure_indexes():
+    ensure_indexes()
+    assert [("user", 1), ("goal", 1), ("date", -1)] in get_index_keys(DBGoalRefusal)
+
+
+def test_should_remove_duplicates_only_when_asked():
+    collection = DBWhoopSleep._get_collection()
+    if "whoop_id_1" in collection.index_information():
+        collection.drop_index("whoop_id_1")
+    ids = collection.insert_many(
+        [{"whoop_id": -1, "whoop_user_id": -1, "json_dumps": str(n)} for n in range(3)]
+    ).inserted_ids
+    # startup leaves the data alone and skips the index
+    ensure_indexes()
+    assert "whoop_id_1" not in collection.index_information()
+    assert remove_duplicates(DBWhoopSleep, ["whoop_id"]) == 2
+    assert collection.count_documents({"whoop_id": -1}) == 3
+    assert remove_duplicates(DBWhoopSleep, ["whoop_id"], dry_run=False) == 2
+    assert [d["_id"] for d in collection.find({"whoop_id": -1})] == [ids[-1]]
+    ensure_indexes()
+    assert "whoop_id_1" in collection.index_information()
+    # webhook updates for the same sleep update it in place
+    save_whoop_sleep(DBWhoopSleep(whoop_id=-1, whoop_user_id=-1, json_dumps="new"))
+    assert [d["json_dumps"] for d in collection.find({"whoop_id": -1})] == ["new"]
+    collection.delete_many({"whoop_id": -1})
+
+
+def test_should_reuse_extractors():
+    extractor = get_extractor(Wearables)
+    assert get_extractor(Wearables) is extractor
+    assert "whoop" in extractor.function["parameters"]["properties"]
+
+
+class FakeExtractor(Extractor):
+    def __init__(self, cls, responses):
+        super().__init__(cls)
+        self.responses = responses
+        self.functions = []
+
+    def call(self, messages, function):
+        self.functions.append(function)
+        return self.responses.pop(0)
+
+
+def test_should_repair_only_invalid_fields():
+    invalid = {"date": "today", "height": 1.8, "weight": "heavy"}
+    extractor = FakeExtractor(BodyMeasures, [invalid, {}])
+    assert extractor("", lambda k: []) is None
+    extractor = FakeExtractor(BodyMeasures, [invalid, {"weight": 80}])
+    body_measures = extractor("", lambda k: [])
+    assert (body_measures.height, body_measures.weight) == (1.8, 80)
+    assert list(extractor.functions[1]["parameters"]["properties"]) == ["weight"]
+
+
+class Nap(BaseModel):
+    start: int
+    end: int
+    naps: int
+
+    @root_validator(skip_on_failure=True)
+    def check(cls, values):
+        if values["end"] < values["start"]:
+            raise ValueError("end must be after start")
+        if values["naps"] > values["end"] - values["start"]:
+            raise ValueError("that doesn't add up")
+        return values
+
+
+def test_should_map_root_errors_to_fields():
+    def get_errors(**values):
+        try:
+            Nap(**values)
+        except ValidationError as e:
+            return get_invalid_fields(Nap, e)
+
+    assert list(get_errors(start=2, end=1, naps=1)) == ["start", "end"]
+    assert list(get_errors(start=1, end=2, naps=3)) == ["start", "end", "naps"]
+    assert list(get_errors(start="x", end=2, naps=1)) == ["start"]
+
+
+def test_should_split_wide_schemas():
+    groups = get_field_groups(Sleep50Entry)
+    assert groups[0] == ["date"]
+    assert groups[1] == [f"sleep_apnea_{n}" for n in range(1, 9)]
+    assert groups[-1] == ["additional_a", "additional_b"]
+    assert get_field_groups(BodyMeasures) == [["date", "height", "weight"]]
+    messages = list(range(100))
+    assert get_slice(messages, 0, 10, 50) == list(range(0, 30))
+    assert get_slice(messages, 40, 50, 50) == list(range(70, 100))
+
+
+def test_should_start_from_captured_values():
+    def get_messages(k):
+        assert False, "the chat history shouldn't be read"
+
+    extractor = FakeExtractor(BodyMeasures, [])
+    captured = {"date": "today", "height": 1.8, "weight": 80}
+    assert extractor("", get_messages, values=captured).weight == 80
+    extractor = FakeExtractor(BodyMeasures, [{"weight": 80}])
+    body_measures = extractor("", lambda k: [], values={"date": "today", "height": 1.8})
+    assert body_measures.weight == 80
+    assert [list(f["parameters"]["properties"]) for f in extractor.functions] == [
+        ["weight"]
+    ]
@@ -0,0 +1,103 @@
+import asyncio
+
+from sleepmate.helpful_scripts import json_dumps
+from sleepmate.turns import drain_turns, get_mailbox_key
+
+
+class FakeLock:
+    def __init__(self, redis, name):
+        self.redis = redis
+        self.name = name
+
+    async def acquire(self):
+        if self.name in self.redis.locks:
+            return False
+        self.redis.locks.add(self.name)
+        return True
+
+    async def reacquire(self):
+        pass
+
+    async def release(self):
+        self.redis.locks.discard(self.name)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.lists = {}
+        self.locks = set()
+
+    def lock(self, name, **kwargs):
+        return FakeLock(self, name)
+
+    async def lpop(self, key):
+        items = self.lists.get(key, [])
+        return items.pop(0) if items else None
+
+    async def lindex(self, key, index):
+        items = self.lists.get(key, [])
+        return items[index] if items else None
+
+    async def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    async def incr(self, key):
+        self.lists[key] = self.lists.get(key, 0) + 1
+        return self.lists[key]
+
+    async def delete(self, key):
+        self.lists.pop(key, None)
+
+    async def llen(self, key):
+        return len(self.lists.get(key, []))
+
+
+class FakeQueue:
+    name = "test"
+
+    def __init__(self):
+        self.redis = FakeRedis()
+
+
+def test_should_drain_one_users_turns_in_order():
+    queue = FakeQueue()
+    key = get_mailbox_key(queue.name, "a")
+    queue.redis.lists[key] = [json_dumps({"n": n}) for n in range(3)]
+    handled = []
+
+    async def handle(message):
+        handled.append(message["n"])
+        # a second worker woken for the same user leaves it to us
+        assert await drain_turns(queue, "a", handle) == 0
+
+    assert asyncio.run(drain_turns(queue, "a", handle)) == 3
+    assert handled == [0, 1, 2]
+    assert not queue.redis.locks
+
+
+def test_should_keep_turns_until_handled():
+    queue = FakeQueue()
+    key = get_mailbox_key(queue.name, "a")
+    queue.redis.lists[key] = [json_dumps({"n": n}) for n in range(2)]
+
+    async def crash(message):
+        raise asyncio.CancelledError  # e.g. the job timed out
+
+    try:
+        asyncio.run(drain_turns(queue, "a", crash))
+    except asyncio.CancelledError:
+        pass
+    assert len(queue.redis.lists[key]) == 2
+    assert not queue.redis.locks
+    handled = []
+
+    async def handle(message):
+        handled.append(message["n"])
+        if message["n"] == 1:
+            raise ValueError()
+
+    assert asyncio.run(drain_turns(queue, "a", handle, retries=3)) == 1
+    # the crashed attempt counts towards the retries
+    assert handled == [0, 1, 1, 1]
+    assert queue.redis.lists[key] == []
+    assert queue.redis.lists[f"{key}:dead"] == [json_dumps({"n": 1})]
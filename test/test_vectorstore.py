@@ -0,0 +1,45 @@
+from sleepmate.vectorstore import LocalIndex, LocalVectorStore, get_local_index
+
+
+class FakeEmbeddings:
+    vectors = {"sleep": [1.0, 0.0], "pain": [0.0, 1.0], "nap": [0.9, 0.1]}
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+
+def test_should_query_upsert_and_delete(tmp_path):
+    index = LocalIndex(tmp_path)
+    index.upsert(vectors=[("a", [2.0, 0.0], {"n": 1}), ("b", [0.0, 3.0], {"n": 2})])
+    [(id, score, metadata)] = index.query([1.0, 0.0], top_k=1)
+    assert (id, round(score, 3), metadata) == ("a", 1.0, {"n": 1})
+    index.upsert(vectors=[("a", [0.2, 1.0], {"n": 3})])
+    assert [id for id, _, _ in index.query([0.2, 1.0], top_k=5)] == ["a", "b"]
+    index.delete(ids=["a"])
+    # persisted next to the data
+    assert LocalIndex(tmp_path).ids == ["b"]
+
+
+def test_should_share_and_refresh_index(tmp_path):
+    index = get_local_index(tmp_path)
+    assert get_local_index(tmp_path / ".") is index
+    # another process, with an index loaded before the first write
+    other = LocalIndex(tmp_path)
+    index.upsert(vectors=[("a", [1.0, 0.0], {})])
+    # writes start from what's on disk, nothing is lost
+    other.upsert(vectors=[("b", [0.0, 1.0], {})])
+    assert index.ids == ["a"]
+    assert index.refresh()
+    assert index.ids == ["a", "b"]
+    assert not index.refresh()
+
+
+def test_should_search_like_a_vectorstore(tmp_path):
+    store = LocalVectorStore.from_texts(
+        ["sleep", "pain", "nap"], FakeEmbeddings(), path=tmp_path
+    )
+    docs = store.similarity_search("sleep", k=2)
+    assert [doc.page_content for doc in docs] == ["sleep", "nap"]
@@ -8,8 +8,9 @@ from twilio.rest import Client
 load_dotenv()
 
 from sleepmate.config import TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_NUMBER
-from sleepmate.executor import X
 from sleepmate.helpful_scripts import setup_logging
+from sleepmate.structured import ensure_indexes
+from sleepmate.turns import enqueue_turn
 from sleepmate.user import get_user_from_username
 
 app = Flask(__name__)
@@ -18,10 +19,14 @@ setup_logging()
 
 log = logging.getLogger("twilio.bot")
 
+QUEUE_NAME = "twilio"
+
 log.info(f"starting twilio bot {TWILIO_ACCOUNT_SID=} {TWILIO_NUMBER=}")
 
 client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
+ensure_indexes()
+
 
 def get_db_user():
     return get_user_from_username(
@@ -36,21 +41,12 @@ def twilio_status():
 
 
 @app.route("/twilio", methods=["POST"])
-def twilio():
+async def twilio():
     log.info(f"received webhook {request.form=}")
     db_user = get_db_user()
     log.info(f"{db_user.to_mongo()=}")
-    x = X(username=db_user.username, hello=None, log_=log, display=False)
-    try:
-        reply_content = x.run(request.form["Body"])
-    except Exception as e:
-        log.exception(f"{e}")
-        reply_content = (
-            "Whoops, I had a problem answering that question. Try again later."
-        )
-    message = client.messages.create(
-        from_=TWILIO_NUMBER, body=reply_content, to=request.form["From"]
+    # acknowledge straight away, the turn runs on a worker, see worker.py
+    await enqueue_turn(
+        QUEUE_NAME, db_user.id, to=request.form["From"], body=request.form["Body"]
     )
-    log.info(f"sent message {message=}")
-
     return "Success!", 200
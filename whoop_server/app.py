@@ -10,6 +10,7 @@ load_dotenv()
 
 from sleepmate.db import *
 from sleepmate.helpful_scripts import setup_logging
+from sleepmate.structured import ensure_indexes
 from sleepmate.whoop import (
     WHOOP_CLIENT_ID,
     WHOOP_CLIENT_SECRET,
@@ -19,6 +20,7 @@ from sleepmate.whoop import (
     get_whoop_oauth2_session,
     get_whoop_token,
     import_whoop_sleep_by_id,
+    save_whoop_sleep,
 )
 
 app = Flask(__name__)
@@ -29,6 +31,8 @@ log = logging.getLogger("whoop.app")
 
 log.info(f"starting WHOOP server {WHOOP_CLIENT_ID=} {WHOOP_REDIRECT_URI=}")
 
+ensure_indexes()
+
 
 def check_signature() -> bool:
     """Check the signature of the request to make sure it's from WHOOP."""
@@ -58,7 +62,9 @@ def whoop_update():
     db_entry = import_whoop_sleep_by_id(
         get_user_by_whoop_id(data["user_id"]), int(data["id"])
     )
-    db_entry.save()
+    if db_entry is None:
+        return "Failed to fetch sleep", 500
+    db_entry = save_whoop_sleep(db_entry)
     log.info(f"{db_entry.to_mongo()=}")
     return "Success!", 200
 